@@ -33,7 +33,7 @@ from gi.repository import Gst
 
 from pitivi.effects import EffectsManager
 from pitivi.configure import VERSION, RELEASES_URL
-from pitivi.settings import GlobalSettings, xdg_cache_home, get_dir
+from pitivi.settings import GlobalSettings
 from pitivi.utils.threads import ThreadMaster
 from pitivi.mainwindow import PitiviMainWindow
 from pitivi.project import ProjectManager, ProjectLogObserver
@@ -41,11 +41,14 @@ from pitivi.undo.undo import UndoableActionLog
 from pitivi.undo.timeline import TimelineLogObserver
 from pitivi.dialogs.startupwizard import StartUpWizard
 
+from pitivi.utils.cache import cache_manager
 from pitivi.utils.misc import quote_uri, path_from_uri
 from pitivi.utils.system import getSystem
 from pitivi.utils.loggable import Loggable
 import pitivi.utils.loggable as log
 
+cache_manager.addStore("scenarios")
+
 
 class Pitivi(Gtk.Application, Loggable):
 
@@ -133,6 +136,7 @@ class Pitivi(Gtk.Application, Loggable):
         self.threads = ThreadMaster()
         self.effects = EffectsManager()
         self.system = getSystem()
+        cache_manager.start(self.settings, self.threads)
 
         self.action_log.connect("commit", self._actionLogCommit)
         self.action_log.connect("undo", self._actionLogUndo)
@@ -232,7 +236,7 @@ class Pitivi(Gtk.Application, Loggable):
         if 'PITIVI_SCENARIO_FILE' in os.environ:
             uri = quote_uri(os.environ['PITIVI_SCENARIO_FILE'])
         else:
-            cache_dir = get_dir(os.path.join(xdg_cache_home(), "scenarios"))
+            cache_dir = cache_manager.getStoreDir("scenarios")
             scenario_name = str(time.strftime("%Y%m%d-%H%M%S"))
             project_path = None
             if uri:
@@ -243,6 +247,7 @@ class Pitivi(Gtk.Application, Loggable):
             uri = quote_uri(uri)
 
         self._scenario_file = open(path_from_uri(uri), "w")
+        cache_manager.touch(path_from_uri(uri))
 
         if project_path:
             f = open(project_path)
@@ -24,9 +24,13 @@
 Classes for automatic alignment of L{Clip}s
 """
 
+from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gst
-import array
+import collections
+import multiprocessing
+import queue
+import threading
 import time
 from gi.repository import Gtk
 import os
@@ -37,12 +41,20 @@ try:
 except ImportError:
     numpy = None
 
+try:
+    # Can compute the FFTs of a batch in several threads.
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+from functools import partial
 from gettext import gettext as _
 
 import pitivi.configure as configure
 
+from pitivi.utils.cache import cache_manager
 from pitivi.utils.ui import beautify_ETA
-from pitivi.utils.misc import call_false
+from pitivi.utils.misc import call_false, hash_file
 from pitivi.utils.extract import Extractee
 from pitivi.utils.loggable import Loggable
 
@@ -88,18 +100,44 @@ def submax(left, middle, right):
     # z = (R/L - 1)/(R/L + 1) = (R-L)/(R+L)
 
 
-def rigidalign(reference, targets):
+# The maximum size of the targets transformed at once by rigidalign.
+RIGIDALIGN_BATCH_BYTES = 64 * 1024 * 1024
+
+# Below this normalized correlation, a clip aligned coarse to fine is
+# reported to the user as probably misaligned.
+ALIGNMENT_MIN_CONFIDENCE = 0.5
+
+cache_manager.addStore("envelopes")
+
+
+def _rfft(a, n):
+    if scipy_fft:
+        return scipy_fft.rfft(a, n, workers=-1)
+    return numpy.fft.rfft(a, n)
+
+
+def _irfft(a, n):
+    if scipy_fft:
+        return scipy_fft.irfft(a, n, workers=-1)
+    return numpy.fft.irfft(a, n)
+
+
+def rigidalign(reference, targets, max_offset=None):
     """
     Estimate the relative shift between reference and targets.
 
     The algorithm works by subtracting the mean, and then locating
     the maximum of the cross-correlation.  For inputs of length M{N},
-    the running time is M{O(C{len(targets)}*N*log(N))}.
+    the running time is M{O(C{len(targets)}*N*log(N))}.  The targets are
+    transformed in batches, with a single FFT for each batch.
 
     @param reference: the waveform to regard as fixed
     @type reference: Sequence(Number)
     @param targets: the waveforms that should be aligned to reference
     @type targets: Sequence(Sequence(Number))
+    @param max_offset: the maximum absolute shift to consider, in samples,
+        or None to consider all the shifts.  Allows smaller FFTs.
+    @type max_offset: L{int}
     @returns: The shift necessary to bring each target into alignment
         with the reference.  The returned shift may not be an integer,
         indicating that the best alignment would be achieved by a
@@ -107,77 +145,277 @@ def rigidalign(reference, targets):
     @rtype: Sequence(Number)
 
     """
-    # L is the maximum size of a cross-correlation between the
-    # reference and any of the targets.
-    L = len(reference) + max(len(t) for t in targets) - 1
-    # We round up L to the next power of 2 for speed in the FFT.
-    L = nextpow2(L)
-    reference = reference - numpy.mean(reference)
-    fref = numpy.fft.rfft(reference, L).conj()
     shifts = []
-    for t in targets:
-        t = t - numpy.mean(t)
-        # Compute cross-correlation
-        xcorr = numpy.fft.irfft(fref * numpy.fft.rfft(t, L))
-        # shift maximizes dotproduct(t[shift:],reference)
-        # int() to convert numpy.int32 to python int
-        shift = int(numpy.argmax(xcorr))
+    for t, xcorr, L in _crosscorrelate(reference, targets, max_offset):
+        if max_offset is None:
+            # shift maximizes dotproduct(t[shift:],reference)
+            # int() to convert numpy.int32 to python int
+            shift = int(numpy.argmax(xcorr))
+        else:
+            lags = numpy.arange(-max_offset, max_offset + 1)
+            shift = int(lags[numpy.argmax(xcorr[lags % L])])
         subsample_shift = submax(xcorr[(shift - 1) % L],
-                                 xcorr[shift],
+                                 xcorr[shift % L],
                                  xcorr[(shift + 1) % L])
+        if max_offset is None and shift >= len(t):
+            # Negative shifts appear large and positive
+            shift -= L  # This corrects them to be negative
         shift = shift + subsample_shift
         # shift is now a float indicating the interpolated maximum
-        if shift >= len(t):  # Negative shifts appear large and positive
-            shift -= L       # This corrects them to be negative
         shifts.append(-shift)
         # Sign reversed to move the target instead of the reference
     return shifts
 
 
-def _findslope(a):
-    # Helper function for affinealign
-    # The provided matrix a contains a bright line whose slope we want to know,
-    # against a noisy background.
-    # The line starts at 0,0.  If the slope is positive, it runs toward the
-    # center of the matrix (i.e. toward (-1,-1))
-    # If the slope is negative, it wraps from 0,0 to 0,-1 and continues toward
-    # the center, (i.e. toward (-1,0)).
-    # The line segment terminates at the midline along the X direction.
-    # We locate the line by simply checking the sum along each possible line
-    # up to the Y-max edge of a.  The caller sets the limit by choosing the
-    # size of a.
-    # The function returns a floating-point slope assuming that the matrix
-    # has "square pixels".
-    Y, X = a.shape
-    X /= 2
-    x_pos = numpy.arange(1, X)
-    x_neg = numpy.arange(2 * X - 1, X, -1)
-    best_end = 0
-    max_sum = 0
-    for end in range(Y):
-        y = (x_pos * end) // X
-        s = numpy.sum(a[y, x_pos])
-        if s > max_sum:
-            max_sum = s
-            best_end = end
-        s = numpy.sum(a[y, x_neg])
-        if s > max_sum:
-            max_sum = s
-            best_end = -end
-    return float(best_end) / X
-
-
-def affinealign(reference, targets, max_drift=0.02):
-    """ EXPERIMENTAL FUNCTION.
+def _crosscorrelate(reference, targets, max_offset=None):
+    """
+    Compute the circular cross-correlations of the targets with the
+    reference, in batches.
+
+    @returns: For each target, the target, its cross-correlation and the
+        length of the cross-correlation.
+    @rtype: iter((array, array, int))
+    """
+    max_length = max(len(t) for t in targets)
+    # L is the maximum size of a cross-correlation between the
+    # reference and any of the targets.
+    L = len(reference) + max_length - 1
+    if max_offset is not None:
+        # The circular cross-correlation has no aliasing between the
+        # shifts in [-max_offset, max_offset] if it is at least this long.
+        L = min(L, max(len(reference), max_length) + max_offset)
+    # We round up L to the next power of 2 for speed in the FFT.
+    L = nextpow2(L)
+    reference = reference - numpy.mean(reference)
+    fref = _rfft(reference, L).conj()
+
+    batch_size = max(1, RIGIDALIGN_BATCH_BYTES // (8 * L))
+    for batch_start in range(0, len(targets), batch_size):
+        batch = targets[batch_start:batch_start + batch_size]
+        stacked = numpy.zeros((len(batch), max_length))
+        for i, t in enumerate(batch):
+            stacked[i, :len(t)] = t - numpy.mean(t)
+        xcorrs = _irfft(fref * _rfft(stacked, L), L)
+        del stacked
+        for t, xcorr in zip(batch, xcorrs):
+            yield t, xcorr, L
+
+
+def decimate(envelope, factor):
+    """
+    Downsample an envelope by averaging blocks of samples.
+
+    @param envelope: the envelope to downsample
+    @type envelope: array(number)
+    @param factor: the number of samples averaged per block
+    @type factor: L{int}
+    @returns: the downsampled envelope, without the incomplete last block
+    @rtype: array(number)
+    """
+    n = len(envelope) // factor
+    return numpy.reshape(envelope[:n * factor], (n, factor)).mean(axis=1)
+
+
+def _findpeaks(xcorr, lags, L, count):
+    # Helper function for coarsetofinealign
+    # Returns the count lags with the highest values in xcorr, ignoring the
+    # neighbours of the lags already found.
+    values = xcorr[lags % L].copy()
+    peaks = []
+    for unused_i in range(min(count, len(lags))):
+        best = int(numpy.argmax(values))
+        if values[best] == -numpy.inf:
+            break
+        peaks.append(int(lags[best]))
+        values[max(0, best - 2):best + 3] = -numpy.inf
+    return peaks
+
+
+def _dotsatlags(reference, target, first, last):
+    # Helper function for coarsetofinealign
+    # Returns dotproduct(target[lag:], reference) for each lag from first to
+    # last, computed by a single correlation over the window of the target
+    # covering these lags.
+    start = max(0, -last)
+    end = min(len(reference), len(target) - first)
+    if end <= start:
+        return numpy.zeros(last - first + 1)
+    # The target samples from start + first to end - 1 + last, zero
+    # outside of the target.
+    window_start = start + first
+    window = numpy.zeros(end - start + last - first)
+    valid_start = max(window_start, 0)
+    valid_end = min(end - 1 + last, len(target))
+    window[valid_start - window_start:valid_end - window_start] = \
+        target[valid_start:valid_end]
+    return numpy.correlate(window, reference[start:end], "valid")
+
+
+def _normsatlag(reference, target, lag):
+    # Helper function for coarsetofinealign
+    # Returns the norms of the parts of reference and target[lag:] which
+    # overlap.
+    start = max(0, -lag)
+    end = min(len(reference), len(target) - lag)
+    if end <= start:
+        return 0., 0.
+    return (numpy.linalg.norm(reference[start:end]),
+            numpy.linalg.norm(target[start + lag:end + lag]))
+
+
+def coarsetofinealign(reference, targets, factor=8, candidates=3,
+                      max_offset=None):
+    """
+    Estimate the relative shift between reference and targets, first on
+    decimated signals and then around the best candidates only.
+
+    The cross-correlations are computed by FFT on the signals decimated
+    by factor, which is about factor times faster than L{rigidalign}.
+    Each of the best candidate shifts is then refined by correlating at
+    full resolution the window of the target within factor of it only.
+
+    @param reference: the waveform to regard as fixed
+    @type reference: Sequence(Number)
+    @param targets: the waveforms that should be aligned to reference
+    @type targets: Sequence(Sequence(Number))
+    @param factor: the decimation factor of the coarse search
+    @type factor: L{int}
+    @param candidates: the number of coarse shifts refined per target
+    @type candidates: L{int}
+    @param max_offset: the maximum absolute shift to consider, in samples,
+        or None to consider all the shifts
+    @type max_offset: L{int}
+    @returns: (shifts, confidences).  shifts[i] is the shift necessary to
+        bring targets[i] into alignment with the reference, as returned by
+        L{rigidalign}.  confidences[i] is the normalized correlation of
+        the overlapping parts once aligned, between -1 and 1.
+    @rtype: (Sequence(Number), Sequence(Number))
+    """
+    reference = reference - numpy.mean(reference)
+    coarse_reference = decimate(reference, factor)
+    coarse_targets = [decimate(t - numpy.mean(t), factor) for t in targets]
+    coarse_max_offset = None
+    if max_offset is not None:
+        coarse_max_offset = max_offset // factor + 1
+
+    shifts = []
+    confidences = []
+    coarse_xcorrs = _crosscorrelate(coarse_reference, coarse_targets,
+                                    coarse_max_offset)
+    for target, (coarse_target, xcorr, L) in zip(targets, coarse_xcorrs):
+        if coarse_max_offset is None:
+            # The shifts which can appear in the circular cross-correlation.
+            lags = numpy.arange(-len(coarse_reference) + 1, len(coarse_target))
+        else:
+            lags = numpy.arange(-coarse_max_offset, coarse_max_offset + 1)
+        target = target - numpy.mean(target)
+
+        # Refine each candidate at full resolution.
+        best = None
+        for coarse_shift in _findpeaks(xcorr, lags, L, candidates):
+            first = (coarse_shift - 1) * factor
+            last = (coarse_shift + 1) * factor
+            if max_offset is not None:
+                first = max(first, -max_offset)
+                last = min(last, max_offset)
+            if first > last:
+                continue
+            # One more lag on each side for the subsample interpolation.
+            dots = _dotsatlags(reference, target, first - 1, last + 1)
+            i = int(numpy.argmax(dots[1:-1])) + 1
+            if best is None or dots[i] > best[1]:
+                best = (first - 1 + i, dots[i], dots[i - 1], dots[i + 1])
+        if best is None:
+            shifts.append(0.)
+            confidences.append(0.)
+            continue
+
+        lag, dot, left, right = best
+        norm_r, norm_t = _normsatlag(reference, target, lag)
+        subsample_shift = submax(left, dot, right)
+        shifts.append(-(lag + subsample_shift))
+        if norm_r and norm_t:
+            confidences.append(float(dot / (norm_r * norm_t)))
+        else:
+            confidences.append(0.)
+    return shifts, confidences
+
 
+def _blockpositions(reference, target, offset, block_size, window):
+    # Helper function for affinealign
+    # Locates each block of target in reference, within window of the
+    # position given by offset.  The blocks are cross-correlated in
+    # batches, so the memory used is bounded whatever the length of the
+    # signals.
+    # Returns the centers of the blocks, their positions in reference and
+    # the normalized correlations with which they were found.  A block best
+    # matches the reference where its center is in sync, whatever the drift.
+    num_blocks = len(target) // block_size
+    starts = numpy.arange(num_blocks) * block_size
+    segment_size = block_size + 2 * window
+    L = nextpow2(segment_size + block_size)
+    # Pad the reference so every segment can be sliced from it.
+    pad = window + abs(offset) + len(target)
+    padded = numpy.concatenate((numpy.zeros(pad), reference, numpy.zeros(pad)))
+    segment_offsets = numpy.arange(segment_size)
+    block_offsets = numpy.arange(block_size)
+
+    positions = numpy.zeros(num_blocks)
+    strengths = numpy.zeros(num_blocks)
+    batch_size = max(1, RIGIDALIGN_BATCH_BYTES // (3 * 8 * L))
+    for first in range(0, num_blocks, batch_size):
+        batch_starts = starts[first:first + batch_size]
+        blocks = target[batch_starts[:, None] + block_offsets]
+        blocks = blocks - blocks.mean(axis=1, keepdims=True)
+        segment_starts = batch_starts + offset - window
+        segments = padded[(segment_starts + pad)[:, None] + segment_offsets]
+        segments = segments - segments.mean(axis=1, keepdims=True)
+
+        # xcorr[:, k] is dotproduct(segments[:, k:k + block_size], blocks)
+        xcorr = _irfft(_rfft(segments, L) * _rfft(blocks, L).conj(), L)
+        xcorr = xcorr[:, :2 * window + 1]
+        best = numpy.argmax(xcorr, axis=1)
+        rows = numpy.arange(len(best))
+        # Interpolate the maxima which are not on the edges of the windows.
+        inner = (best > 0) & (best < 2 * window)
+        left = xcorr[rows, numpy.maximum(best - 1, 0)]
+        middle = xcorr[rows, best]
+        right = xcorr[rows, numpy.minimum(best + 1, 2 * window)]
+        L_, R_ = middle - left, middle - right
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            subsample = numpy.where(inner & (L_ + R_ > 0),
+                                    0.5 * (R_ - L_) / (L_ + R_), 0)
+
+        # Normalize by the energies of the matched parts.
+        energy = numpy.concatenate(
+            (numpy.zeros((len(rows), 1)), numpy.cumsum(segments ** 2, axis=1)),
+            axis=1)
+        segment_energy = energy[rows, best + block_size] - energy[rows, best]
+        block_energy = numpy.sum(blocks ** 2, axis=1)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            strength = middle / numpy.sqrt(segment_energy * block_energy)
+
+        batch = slice(first, first + len(batch_starts))
+        positions[batch] = segment_starts + best + subsample + block_size / 2
+        strengths[batch] = numpy.nan_to_num(strength)
+    return starts + block_size / 2, positions, strengths
+
+
+def affinealign(reference, targets, max_drift=0.02, block_size=None,
+                max_offset=None):
+    """
     Perform an affine registration between a reference and a number of
     targets.  Designed for aligning the amplitude envelopes of recordings of
-    the same event by different devices.
+    the same event by different devices, whose clocks drift.
+
+    Each target is first aligned as a whole with L{rigidalign}.  Then each
+    block of the target is located in the reference around that position,
+    and a line is fitted through the positions of the blocks, weighted by
+    how well they matched.  The blocks are processed in batches, so the
+    memory used does not depend on the length of the recordings.
 
-    NOTE: This method is currently NOT USED by Pitivi, as it has proven both
-    unnecessary and unusable.  So far every test case has been registered
-    successfully by rigidalign, and until Pitivi supports time-stretching of
-    audio, the drift calculation cannot actually be used.
+    Until Pitivi supports time-stretching of audio, the drift cannot
+    actually be corrected, only reported.
 
     @param reference: the reference signal to which others will be registered
     @type reference: array(number)
@@ -186,117 +424,52 @@ def affinealign(reference, targets, max_drift=0.02):
     @param max_drift: the maximum absolute clock drift rate
                   (i.e. stretch factor) that will be considered during search
     @type max_drift: positive L{float}
+    @param block_size: the number of samples of the blocks, by default
+        20 / max_drift
+    @type block_size: L{int}
+    @param max_offset: the maximum absolute offset of the targets, passed
+        to L{rigidalign}
+    @type max_offset: L{int}
     @return: (offsets, drifts).  offsets[i] is the point in reference at which
            targets[i] starts.  drifts[i] is the speed of targets[i] relative to
            the reference (positive is faster, meaning the target should be
-           slowed down to be in sync with the reference)
+           slowed down to be in sync with the reference): sample n of
+           targets[i] is at offsets[i] + (1 + drifts[i]) * n in reference.
     """
-    L = len(reference) + max(len(t) for t in targets) - 1
-    L2 = nextpow2(L)
-    bsize = int(20. / max_drift)  # NEEDS TUNING
-    num_blocks = nextpow2(1.0 * len(reference) // bsize)  # NEEDS TUNING
-    bspace = (len(reference) - bsize) // num_blocks
-    reference -= numpy.mean(reference)
-
-    # Construct FFT'd reference blocks
-    freference_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-    for i in range(num_blocks):
-        s = i * bspace
-        tmp = numpy.zeros((L2,))
-        tmp[s:s + bsize] = reference[s:s + bsize]
-        freference_blocks[:, i] = numpy.fft.rfft(tmp, L2).conj()
-    freference_blocks[:10, :] = 0  # High-pass to ignore slow volume variations
-
+    if block_size is None:
+        block_size = int(20. / max_drift)  # NEEDS TUNING
+    reference = reference - numpy.mean(reference)
     offsets = []
     drifts = []
     for t in targets:
-        t -= numpy.mean(t)
-        ft = numpy.fft.rfft(t, L2)
-        # fxcorr is the FFT'd cross-correlation with the reference blocks
-        fxcorr_blocks = numpy.zeros((L2 / 2 + 1, num_blocks),
-                                    dtype=numpy.complex)
-        for i in range(num_blocks):
-            fxcorr_blocks[:, i] = ft * freference_blocks[:, i]
-            fxcorr_blocks[:, i] /= numpy.sqrt(
-                numpy.sum(fxcorr_blocks[:, i] ** 2))
-        del ft
-        # At this point xcorr_blocks would show a distinct bright line, nearly
-        # orthogonal to time, indicating where each of these blocks found their
-        # peak.  Each point on this line represents the time in t where block i
-        # found its match.  The time-intercept gives the time in b at which the
-        # reference starts, and the slope gives the amount by which the
-        # reference is faster relative to b.
-
-        # The challenge now is to find this line.  Our strategy is to reduce the
-        # search to one dimension by first finding the slope.
-        # The Fourier Transform of a smooth real line in 2D is an orthogonal
-        # line through the origin, with phase that gives its position.
-        # Unfortunately this line is not clearly visible in fxcorr_blocks, so
-        # we discard the phase (by taking the absolute value) and then inverse
-        # transform.  This places the line at the origin, so we can find its
-        # slope.
-
-        # Construct the half-autocorrelation matrix
-        # (A true autocorrelation matrix would be ifft(abs(fft(x))**2), but this
-        # is just ifft(abs(fft(x))).)
-        # Construction is stepwise partly in an attempt to save memory
-        # The width is 2*num_blocks in order to avoid overlapping positive and
-        # negative correlations
-        halfautocorr = numpy.fft.fft(fxcorr_blocks, 2 * num_blocks, 1)
-        halfautocorr = numpy.abs(halfautocorr)
-        halfautocorr = numpy.fft.ifft(halfautocorr, None, 1)
-        halfautocorr = numpy.fft.irfft(halfautocorr, None, 0)
-        # Now it's actually the half-autocorrelation.
-        # Chop out the bit we don't care about
-        halfautocorr = halfautocorr[:bspace * num_blocks * max_drift, :]
-        # Remove the local-correlation peak.
-        halfautocorr[-1:2, -1:2] = 0  # NEEDS TUNING
-        # Normalize each column (appears to be necessary)
-        for i in range(2 * num_blocks):
-            halfautocorr[:, i] /= numpy.sqrt(
-                numpy.sum(halfautocorr[:, i] ** 2))
-        # from matplotlib.pyplot import imshow,show
-        # imshow(halfautocorr,interpolation='nearest',aspect='auto');show()
-        drift = _findslope(halfautocorr) / bspace
-        del halfautocorr
-
-        # inverse transform and shift everything into alignment
-        xcorr_blocks = numpy.fft.irfft(fxcorr_blocks, None, 0)
-        del fxcorr_blocks
-        # TODO: see if phase ramps are worthwhile here
-        for i in range(num_blocks):
-            blockcenter = i * bspace + bsize / 2
-            shift = int(blockcenter * drift)
-            if shift > 0:
-                temp = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = temp
-            elif shift < 0:
-                temp = xcorr_blocks[shift:, i].copy()
-                xcorr_blocks[-shift:, i] = xcorr_blocks[:shift, i].copy()
-                xcorr_blocks[:-shift, i] = temp
-
-        # from matplotlib.pyplot import imshow,show
-        # imshow(xcorr_blocks,interpolation='nearest',aspect='auto');show()
-
-        # xcorr is the drift-compensated cross-correlation
-        xcorr = numpy.sum(xcorr_blocks, axis=1)
-        del xcorr_blocks
-
-        offset = numpy.argmax(xcorr)
-        # from matplotlib.pyplot import plot,show
-        # plot(xcorr);show()
-        del xcorr
-        if offset >= len(t):
-            offset -= L2
-
-        # now offset is the point in target at which reference starts and
-        # drift is the speed with which the reference drifts relative to the
-        # target.  We reverse these relationships for the caller.
-        slope = 1 + drift
-        offsets.append(-offset / slope)
-        drifts.append(1 / slope - 1)
+        offset = rigidalign(reference, [t], max_offset)[0]
+        if len(t) < 2 * block_size:
+            # Not enough blocks to estimate a drift.
+            offsets.append(offset)
+            drifts.append(0.)
+            continue
+
+        # The blocks can slip by up to this much over the whole target.
+        window = int(max_drift * len(t)) + 2
+        centers, positions, weights = _blockpositions(
+            reference, t, int(round(offset)), block_size, window)
+        keep = weights > 0
+        for unused_iteration in range(2):
+            if numpy.count_nonzero(keep) < 2:
+                break
+            slope, intercept = numpy.polyfit(
+                centers[keep], positions[keep], 1, w=weights[keep])
+            # Ignore the blocks which matched elsewhere, for example
+            # because they are silent.
+            residuals = numpy.abs(positions - (intercept + slope * centers))
+            deviation = numpy.median(residuals[keep])
+            keep &= residuals <= max(3 * deviation, 1)
+        else:
+            offsets.append(intercept)
+            drifts.append(slope - 1)
+            continue
+        offsets.append(offset)
+        drifts.append(0.)
     return offsets, drifts
 
 
@@ -403,9 +576,13 @@ class EnvelopeExtractee(Extractee, Loggable):
     over each block.  This class computes the envelope incrementally,
     so that the entire signal does not ever need to be stored.
 
+    The received buffers are read in place.  Only the samples of the last,
+    incomplete block of a buffer are copied, to be completed by the next
+    buffer.
+
     """
 
-    def __init__(self, blocksize, callback, *cbargs):
+    def __init__(self, blocksize, callback, *cbargs, nb_samples=None):
         """
         @param blocksize: the number of samples in a block
         @type blocksize: L{int}
@@ -413,27 +590,68 @@ class EnvelopeExtractee(Extractee, Loggable):
             The function's first argument will be a numpy array
             representing the envelope, and any later argument to this
             function will be passed as subsequent arguments to callback.
+        @param nb_samples: the expected number of samples, if known, used
+            to allocate the envelope once
+        @type nb_samples: L{int}
 
         """
         Loggable.__init__(self)
         self._blocksize = blocksize
         self._cb = callback
         self._cbargs = cbargs
-        self._blocks = numpy.zeros((0,), dtype=numpy.float32)
-        self._empty = array.array('f', [])
-        # self._samples buffers up to self._threshold samples, before
-        # their envelope is computed and store in self._blocks, in order
-        # to amortize some of the function call overheads.
-        self._samples = array.array('f', [])
+        nb_blocks = 0
+        if nb_samples:
+            nb_blocks = nb_samples // blocksize + 1
+        self._blocks = numpy.empty((nb_blocks,), dtype=numpy.float32)
+        self._nb_blocks = 0
+        # The samples of the block being received, self._partial_len of
+        # them, which were at the end of the previous buffer.
+        self._partial = numpy.empty((blocksize,), dtype=numpy.float32)
+        self._partial_len = 0
+        self._nb_samples = 0
+        # The progress watchers are called every self._threshold samples,
+        # in order to amortize the function call overheads.
         self._threshold = 2000 * blocksize
+        self._notified = 0
         self._progress_watchers = []
 
     def receive(self, a):
-        self._samples.extend(a)
-        if len(self._samples) < self._threshold:
-            return
+        """
+        @param a: the samples, as a numpy array, or as F32LE samples in any
+            object supporting the buffer protocol, such as the memoryview
+            of a mapped L{Gst.Buffer}
+        """
+        if isinstance(a, numpy.ndarray):
+            samples = a.astype(numpy.float32, copy=False)
         else:
-            self._process_samples()
+            samples = numpy.frombuffer(a, dtype="<f4")
+        self._nb_samples += len(samples)
+
+        if self._partial_len:
+            missing = self._blocksize - self._partial_len
+            head = samples[:missing]
+            end = self._partial_len + len(head)
+            self._partial[self._partial_len:end] = head
+            self._partial_len = end
+            samples = samples[len(head):]
+            if self._partial_len < self._blocksize:
+                return
+            self._addBlocks(self._partial.reshape((1, self._blocksize)))
+            self._partial_len = 0
+
+        nb_blocks = len(samples) // self._blocksize
+        if nb_blocks:
+            end = nb_blocks * self._blocksize
+            self._addBlocks(
+                samples[:end].reshape((nb_blocks, self._blocksize)))
+            samples = samples[end:]
+        self._partial[:len(samples)] = samples
+        self._partial_len = len(samples)
+
+        if self._nb_samples - self._notified >= self._threshold:
+            self._notified = self._nb_samples
+            for w in self._progress_watchers:
+                w(self._nb_samples)
 
     def addWatcher(self, w):
         """
@@ -445,30 +663,123 @@ class EnvelopeExtractee(Extractee, Loggable):
         """
         self._progress_watchers.append(w)
 
-    def _process_samples(self):
-        excess = len(self._samples) % self._blocksize
-        if excess != 0:
-            samples_to_process = self._samples[:-excess]
-            self._samples = self._samples[-excess:]
-        else:
-            samples_to_process = self._samples
-            self._samples = array.array('f', [])
-        self.debug("Adding %s samples to %s blocks",
-                   len(samples_to_process), len(self._blocks))
-        newblocks = len(samples_to_process) // self._blocksize
-        samples_abs = numpy.abs(
-            samples_to_process).reshape((newblocks, self._blocksize))
-        self._blocks.resize((len(self._blocks) + newblocks,))
-        # This numpy.sum() call relies on samples_abs being a
-        # floating-point type. If samples_abs.dtype is int16
-        # then the sum may overflow.
-        self._blocks[-newblocks:] = numpy.sum(samples_abs, 1)
-        for w in self._progress_watchers:
-            w(self._blocksize * len(self._blocks) + excess)
+    def _addBlocks(self, blocks):
+        end = self._nb_blocks + len(blocks)
+        if end > len(self._blocks):
+            # More samples than expected, grow geometrically.
+            self._blocks.resize((max(end, 2 * len(self._blocks)),),
+                                refcheck=False)
+        # This numpy.sum() call relies on blocks being a floating-point
+        # type.  If blocks.dtype is int16 then the sum may overflow.
+        numpy.sum(numpy.abs(blocks), axis=1,
+                  out=self._blocks[self._nb_blocks:end])
+        self._nb_blocks = end
 
     def finalize(self):
-        self._process_samples()  # absorb any remaining buffered samples
-        self._cb(self._blocks, *self._cbargs)
+        # The samples of the incomplete last block are dropped.
+        self.debug("Computed %s blocks from %s samples",
+                   self._nb_blocks, self._nb_samples)
+        self._cb(self._blocks[:self._nb_blocks], *self._cbargs)
+
+
+# The queue through which the extraction workers report their progress.
+_progress_queue = None
+
+
+def _init_extraction_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+    Gst.init(None)
+
+
+def extract_envelope(index, uri, duration, blockrate, cache_path):
+    """
+    Compute the envelope of the audio of a file and save it in the cache.
+
+    Runs in a worker process of the L{AutoAligner}, with its own decoding
+    pipeline, and reports its progress as (index, nanoseconds decoded)
+    tuples.
+
+    @param index: The index of the extraction, used in progress reports.
+    @param uri: The URI of the file.
+    @param duration: The duration of the file, in nanoseconds.
+    @param blockrate: The number of envelope blocks per second.
+    @param cache_path: The file in which the envelope is saved.
+    @returns: The envelope.
+    @rtype: C{numpy.ndarray}
+    """
+    pipeline = Gst.parse_launch(
+        "uridecodebin name=decode ! audioconvert ! "
+        "audio/x-raw,format=F32LE,channels=1,layout=interleaved ! "
+        "appsink name=sink sync=false")
+    pipeline.get_by_name("decode").props.uri = uri
+    sink = pipeline.get_by_name("sink")
+    bus = pipeline.get_bus()
+    envelopes = []
+    try:
+        pipeline.set_state(Gst.State.PAUSED)
+        if pipeline.get_state(Gst.CLOCK_TIME_NONE)[0] == Gst.StateChangeReturn.FAILURE:
+            raise RuntimeError("Cannot decode %s" % uri)
+        pipeline.set_state(Gst.State.PLAYING)
+
+        extractee = None
+        while True:
+            sample = sink.emit("try-pull-sample", Gst.SECOND)
+            if sample is None:
+                if sink.is_eos():
+                    break
+                message = bus.pop_filtered(Gst.MessageType.ERROR)
+                if message:
+                    error, unused_debug = message.parse_error()
+                    raise RuntimeError(error.message)
+                continue
+            if extractee is None:
+                rate = sample.get_caps().get_structure(0).get_value("rate")
+                extractee = EnvelopeExtractee(
+                    rate // blockrate, envelopes.append,
+                    nb_samples=duration * rate // Gst.SECOND)
+                extractee.addWatcher(
+                    lambda samples: _progress_queue.put(
+                        (index, samples * Gst.SECOND // rate)))
+            buf = sample.get_buffer()
+            success, info = buf.map(Gst.MapFlags.READ)
+            if not success:
+                raise RuntimeError("Cannot map a buffer of %s" % uri)
+            try:
+                extractee.receive(info.data)
+            finally:
+                buf.unmap(info)
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+    if extractee is None:
+        raise RuntimeError("No audio decoded from %s" % uri)
+    extractee.finalize()
+    save_envelope(cache_path, envelopes[0])
+    _progress_queue.put((index, duration))
+    return envelopes[0]
+
+
+def load_envelope(path):
+    """
+    Load an envelope saved by L{save_envelope}.
+
+    @returns: The envelope or None if it cannot be loaded.
+    @rtype: C{numpy.ndarray}
+    """
+    try:
+        return numpy.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+def save_envelope(path, envelope):
+    # Written under a temporary name and renamed, so concurrent readers
+    # never see an incomplete file.
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        numpy.save(f, envelope)
+    os.replace(tmp_path, path)
 
 
 class AutoAligner(Loggable):
@@ -499,7 +810,8 @@ class AutoAligner(Loggable):
 
     """
 
-    def __init__(self, clips, callback):
+    def __init__(self, clips, callback, max_offset=None, coarse_to_fine=False,
+                 estimate_drift=False):
         """
         @param clips: an iterable of L{Clip}s.
             In this implementation, only L{Clip}s with at least one
@@ -508,18 +820,39 @@ class AutoAligner(Loggable):
         @param callback: A function to call when alignment is complete.  No
             arguments will be provided.
         @type callback: function
+        @param max_offset: The maximum expected offset between the clips, in
+            nanoseconds, or None if unknown.  Makes the alignment faster.
+        @type max_offset: L{int}
+        @param coarse_to_fine: Whether to search the offsets on decimated
+            envelopes first, see L{coarsetofinealign}.
+        @type coarse_to_fine: L{bool}
+        @param estimate_drift: Whether to also estimate the clock drift of the
+            clips relative to the reference, see L{affinealign}.  Takes
+            precedence over coarse_to_fine.
+        @type estimate_drift: L{bool}
 
         """
         Loggable.__init__(self)
+        self._max_offset = max_offset
+        self._coarse_to_fine = coarse_to_fine
+        # Maps the aligned objects to the confidence of their alignment,
+        # between -1 and 1, when aligning coarse to fine.
+        self.confidences = {}
+        self._estimate_drift = estimate_drift
+        # Maps the aligned objects to their clock drift relative to the
+        # reference, when estimating the drift.
+        self.drifts = {}
         # self._clips maps each object to its envelope.  The values
         # are initially None prior to envelope extraction.
         self._clips = dict.fromkeys(clips)
         self._callback = callback
-        # stack of (Track, Extractee) pairs waiting to be processed
-        # When start() is called, the stack will be populated, and then
-        # processed sequentially.  Only one item from the stack will be
-        # actively in process at a time.
-        self._extraction_stack = []
+        # The envelopes are extracted in parallel by the worker processes of
+        # self._pool, one decoding pipeline per worker.
+        self._pool = None
+        self._progress_queue = None
+        # The progress callbacks of the extractions, by index.
+        self._progress_cbs = []
+        self._pending = 0
 
     @staticmethod
     def canAlign(clips):
@@ -540,22 +873,67 @@ class AutoAligner(Loggable):
         # use the AutoAligner, which will crash immediately.
         return all(getAudioTrack(t) is not None for t in clips)
 
-    def _extractNextEnvelope(self):
-        audiotrack, extractee = self._extraction_stack.pop()
-        r = RandomAccessAudioExtractor(audiotrack.factory,
-                                       audiotrack.stream)
-        r.extract(extractee, audiotrack.in_point,
-                  audiotrack.out_point - audiotrack.in_point)
+    def _extractedCb(self, pairs, envelope):
+        # Called in a thread of the pool.
+        GLib.idle_add(self._envelopeCb, envelope, pairs)
+
+    def _extractionFailedCb(self, pairs, error):
+        # Called in a thread of the pool.
+        GLib.idle_add(self._extractionErrorCb, error, pairs)
+
+    def _envelopeCb(self, array, pairs):
+        for clip, audiotrack in pairs:
+            self.debug("Receiving envelope for %s", clip)
+            self._clips[clip] = self._cropEnvelope(array, audiotrack)
+        self._pending -= 1
+        self._maybeFinish()
         return False
 
-    def _envelopeCb(self, array, clip):
-        self.debug("Receiving envelope for %s", clip)
-        self._clips[clip] = array
-        if self._extraction_stack:
-            self._extractNextEnvelope()
-        else:  # This was the last envelope
+    def _extractionErrorCb(self, error, pairs):
+        for clip, unused_audiotrack in pairs:
+            self.error("Cannot extract the envelope of %s: %s", clip, error)
+            # Align the others.
+            self._clips.pop(clip)
+        self._pending -= 1
+        self._maybeFinish()
+        return False
+
+    def _cropEnvelope(self, envelope, audiotrack):
+        """
+        Get the part of the envelope of a file used by the track.
+        """
+        first = audiotrack.in_point * self.BLOCKRATE // Gst.SECOND
+        last = audiotrack.out_point * self.BLOCKRATE // Gst.SECOND
+        return envelope[first:last]
+
+    def _getEnvelopeCachePath(self, uri):
+        filehash = hash_file(Gst.uri_get_location(uri))
+        return os.path.join(cache_manager.getStoreDir("envelopes"),
+                            "%s-%d.npy" % (filehash, self.BLOCKRATE))
+
+    def _maybeFinish(self):
+        if self._pending:
+            return False
+        # This was the last envelope.
+        if self._pool:
+            self._pollProgress()
+            # The pool has been closed so the workers exit now that all
+            # the results arrived. Reap them without blocking the UI.
+            threading.Thread(target=self._pool.join, daemon=True).start()
+            self._pool = None
+        if len(self._clips) >= 2:
             self._performShifts()
-            self._callback()
+        self._callback()
+        return False
+
+    def _pollProgress(self):
+        while True:
+            try:
+                index, thusfar = self._progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._progress_cbs[index](thusfar)
+        return bool(self._pending)
 
     def start(self):
         """
@@ -575,29 +953,54 @@ class AutoAligner(Loggable):
             else:  # forget any Clip without an audio track
                 self._clips.pop(clip)
         if len(pairs) >= 2:
+            # The envelopes of whole files are cached, so aligning again
+            # or aligning a new clip only decodes the files never aligned.
+            # The clips of the same file share a single extraction, keyed
+            # by the cache path, which depends on the hash of the file and
+            # on the blockrate.
+            extractions = collections.OrderedDict()
             for clip, audiotrack in pairs:
-                # blocksize is the number of samples per block
-                blocksize = audiotrack.stream.rate // self.BLOCKRATE
-                extractee = EnvelopeExtractee(
-                    blocksize, self._envelopeCb, clip)
-                # numsamples is the total number of samples in the track,
-                # which is used by progress_aggregator to determine
-                # the percent completion.
-                numsamples = ((audiotrack.duration / Gst.SECOND) *
-                              audiotrack.stream.rate)
-                extractee.addWatcher(
-                    progress_aggregator.getPortionCB(numsamples))
-                self._extraction_stack.append((audiotrack, extractee))
-            # After we return, start the extraction cycle.
-            # This GLib.idle_add call should not be necessary;
-            # we should be able to invoke _extractNextEnvelope directly
-            # here.  However, there is some as-yet-unexplained
-            # race condition between the Python GIL, GTK UI updates,
-            # GLib mainloop, and pygst multithreading, resulting in
-            # occasional deadlocks during autoalignment.
-            # This call to idle_add() reportedly eliminates the deadlock.
-            # No one knows why.
-            GLib.idle_add(self._extractNextEnvelope)
+                uri = audiotrack.factory.uri
+                duration = audiotrack.factory.duration
+                cache_path = self._getEnvelopeCachePath(uri)
+                if cache_path in extractions:
+                    extractions[cache_path][0].append((clip, audiotrack))
+                    continue
+                # The progress is the duration of the decoded audio.
+                progress_cb = progress_aggregator.getPortionCB(duration)
+                envelope = load_envelope(cache_path)
+                if envelope is not None:
+                    cache_manager.touch(cache_path)
+                    cache_manager.recordLookups("envelopes", hits=1)
+                    self._clips[clip] = self._cropEnvelope(envelope, audiotrack)
+                    progress_cb(duration)
+                    continue
+                cache_manager.recordLookups("envelopes", misses=1)
+                self._progress_cbs.append(progress_cb)
+                extractions[cache_path] = ([(clip, audiotrack)], uri, duration)
+
+            if extractions:
+                # Spawn the workers rather than forking them, as a fork of
+                # the process would inherit the state of its GStreamer
+                # threads.
+                context = multiprocessing.get_context("spawn")
+                self._progress_queue = context.Queue()
+                self._pool = context.Pool(
+                    min(len(extractions), multiprocessing.cpu_count()),
+                    initializer=_init_extraction_worker,
+                    initargs=(self._progress_queue,))
+            for index, (cache_path, (clips, uri, duration)) in enumerate(extractions.items()):
+                self._pool.apply_async(
+                    extract_envelope,
+                    (index, uri, duration, self.BLOCKRATE, cache_path),
+                    callback=partial(self._extractedCb, clips),
+                    error_callback=partial(self._extractionFailedCb, clips))
+                self._pending += 1
+            if self._pool:
+                self._pool.close()
+                GLib.timeout_add(100, self._pollProgress)
+            else:
+                GLib.idle_add(self._maybeFinish)
         else:  # We can't do anything without at least two audio tracks
             # After we return, call the callback function (once)
             GLib.idle_add(call_false, self._callback)
@@ -631,7 +1034,25 @@ class AutoAligner(Loggable):
         # (In python 3, dict.items() returns an unordered dictview)
         pairs = list(self._clips.items())
         envelopes = [p[1] for p in pairs]
-        offsets = rigidalign(reference_envelope, envelopes)
+        max_offset = None
+        if self._max_offset is not None:
+            max_offset = self._max_offset * self.BLOCKRATE // Gst.SECOND + 1
+        if self._estimate_drift:
+            offsets, drifts = affinealign(reference_envelope, envelopes,
+                                          max_offset=max_offset)
+            for (movable, envelope), drift in zip(pairs, drifts):
+                self.info("%s drifts by %.0f ppm relative to %s",
+                          movable, drift * 1e6, reference)
+                self.drifts[movable] = drift
+        elif self._coarse_to_fine:
+            offsets, confidences = coarsetofinealign(
+                reference_envelope, envelopes, max_offset=max_offset)
+            for (movable, envelope), confidence in zip(pairs, confidences):
+                self.debug("Aligned %s with a confidence of %.2f",
+                           movable, confidence)
+                self.confidences[movable] = confidence
+        else:
+            offsets = rigidalign(reference_envelope, envelopes, max_offset)
         for (movable, envelope), offset in zip(pairs, offsets):
             # tshift is the offset rescaled to units of nanoseconds
             tshift = int((offset * Gst.SECOND) / self.BLOCKRATE)
@@ -305,7 +305,6 @@ if not ges_1_5.satisfied:
 SOFT_DEPENDENCIES = \
     (
         ClassicDependency("pycanberra", None, _("enables sound notifications when rendering is complete")),
-        GIDependency("GnomeDesktop", None, _("file thumbnails provided by GNOME's thumbnailers")),
         GIDependency("Notify", None, _("enables visual notifications when rendering is complete")),
         GstPluginDependency("libav", None, _("additional multimedia codecs through the GStreamer Libav library")),
         GstPluginDependency("debugutilsbad", None, _("enables a watchdog in the GStreamer pipeline."
@@ -1,20 +1,163 @@
 #include <Python.h>
 #include <stdio.h>
+#include <string.h>
 #include <cairo.h>
 #include <py3cairo.h>
 
 static Pycairo_CAPI_t *Pycairo_CAPI;
 
+/*
+ * A range of samples, read from an object supporting the buffer protocol,
+ * such as a numpy array of float32 or float64, a memoryview or an mmap,
+ * without copying it, or from a sequence of floats.
+ */
+typedef struct
+{
+  Py_buffer view;
+  PyObject *seq;
+  char format;
+  Py_ssize_t stride;
+  Py_ssize_t length;
+} Samples;
+
+static int
+samples_init(Samples * samples, PyObject * obj)
+{
+  const char *format;
+
+  memset(samples, 0, sizeof (Samples));
+
+  if (!PyObject_CheckBuffer(obj)) {
+    samples->seq = PySequence_Fast(obj,
+        "samples must support the buffer protocol or be a sequence");
+    if (samples->seq == NULL)
+      return -1;
+    samples->length = PySequence_Fast_GET_SIZE(samples->seq);
+    return 0;
+  }
+
+  if (PyObject_GetBuffer(obj, &samples->view,
+          PyBUF_STRIDES | PyBUF_FORMAT) < 0)
+    return -1;
+
+  if (samples->view.ndim != 1) {
+    PyErr_SetString(PyExc_ValueError, "samples must be one dimensional");
+    goto error;
+  }
+
+  format = samples->view.format ? samples->view.format : "B";
+  if (*format == '@' || *format == '=')
+    format++;
+#if PY_LITTLE_ENDIAN
+  else if (*format == '<')
+    format++;
+#else
+  else if (*format == '>' || *format == '!')
+    format++;
+#endif
+  if ((*format != 'f' && *format != 'd') || format[1] != '\0') {
+    PyErr_Format(PyExc_TypeError,
+        "samples must be native float32 or float64, not '%s'",
+        samples->view.format);
+    goto error;
+  }
+
+  samples->format = *format;
+  samples->length = samples->view.shape[0];
+  samples->stride = samples->view.strides[0];
+  return 0;
+
+error:
+  PyBuffer_Release(&samples->view);
+  return -1;
+}
+
+static int
+samples_get(Samples * samples, Py_ssize_t i, double *value)
+{
+  char *item;
+
+  if (samples->seq) {
+    *value = PyFloat_AsDouble(PySequence_Fast_GET_ITEM(samples->seq, i));
+    /* If the object was not a float or convertible to float */
+    if (*value == -1.0 && PyErr_Occurred())
+      return -1;
+    return 0;
+  }
+
+  item = (char *) samples->view.buf + i * samples->stride;
+  if (samples->format == 'f')
+    *value = *(float *) item;
+  else
+    *value = *(double *) item;
+  return 0;
+}
+
+static void
+samples_release(Samples * samples)
+{
+  if (samples->seq)
+    Py_DECREF(samples->seq);
+  else
+    PyBuffer_Release(&samples->view);
+}
+
+/*
+ * Reduce the samples covered by each of the width pixels to their minimum,
+ * maximum or average, depending on the reduction.
+ */
+typedef enum
+{
+  REDUCE_MIN,
+  REDUCE_MAX,
+  REDUCE_AVERAGE
+} Reduction;
+
+static int
+reduce_samples(Samples * samples, Py_ssize_t length, int width,
+    Reduction reduction, double *pixels)
+{
+  Py_ssize_t first, last, i;
+  double value, result;
+  int x;
+
+  for (x = 0; x < width; x++) {
+    first = x * length / width;
+    last = (x + 1) * length / width;
+    if (last <= first)
+      last = first + 1;
+
+    if (samples_get(samples, first, &result) < 0)
+      return -1;
+    for (i = first + 1; i < last; i++) {
+      if (samples_get(samples, i, &value) < 0)
+        return -1;
+      if (reduction == REDUCE_MIN)
+        result = value < result ? value : result;
+      else if (reduction == REDUCE_MAX)
+        result = value > result ? value : result;
+      else
+        result += value;
+    }
+    if (reduction == REDUCE_AVERAGE)
+      result /= last - first;
+    pixels[x] = result;
+  }
+
+  return 0;
+}
+
 /*
  * This function must be called with a range of samples, and a desired
  * width and height.
  * It will average samples if needed.
  */
-static PyObject* py_fill_surface(PyObject* self, PyObject* args)
+static PyObject *
+py_fill_surface(PyObject * self, PyObject * args)
 {
-  PyObject *samples;
-  PyObject *sampleObj;
-  int length, i;
+  PyObject *samplesObj;
+  Samples samples;
+  Py_ssize_t i;
   double sample;
   cairo_surface_t *surface;
   cairo_t *ctx;
@@ -23,14 +166,13 @@ static PyObject* py_fill_surface(PyObject* self, PyObject* args)
   float currentPixel;
   int samplesInAccum;
   float x = 0.;
-  float lastX = 0.;
   double accum;
-  double lastAccum = 0.;
 
-  if (!PyArg_ParseTuple(args, "O!ii", &PyList_Type, &samples, &width, &height))
+  if (!PyArg_ParseTuple(args, "Oii", &samplesObj, &width, &height))
     return NULL;
 
-  length = PyList_Size(samples);
+  if (samples_init(&samples, samplesObj) < 0)
+    return NULL;
 
   surface = cairo_image_surface_create(CAIRO_FORMAT_ARGB32, width, height);
 
@@ -40,51 +182,153 @@ static PyObject* py_fill_surface(PyObject* self, PyObject* args)
   cairo_set_line_width(ctx, 0.5);
   cairo_move_to(ctx, 0, height);
 
-  pixelsPerSample = width / (float) length;
+  pixelsPerSample = width / (float) samples.length;
   currentPixel = 0.;
   samplesInAccum = 0;
   accum = 0.;
 
-  for (i = 0; i < length; i++)
-    {
-      /* Guaranteed to return something */
-      sampleObj = PyList_GetItem(samples, i);
-      sample = PyFloat_AsDouble(sampleObj);
-
-      /* If the object was not a float or convertible to float */
-      if (PyErr_Occurred())
-	{
-	  cairo_surface_finish(surface);
-	  Py_DECREF(samples);
-	  return NULL;
-	}
-
-      currentPixel += pixelsPerSample;
-      samplesInAccum += 1;
-      accum += sample;
-      if (currentPixel > 1.0)
-	{
-	  accum /= samplesInAccum;
-	  cairo_line_to(ctx, x, height - accum);
-	  lastAccum = accum;
-	  accum = 0;
-	  currentPixel -= 1.0;
-	  samplesInAccum = 0;
-	  lastX = x;
-	}
-      x += pixelsPerSample;
+  for (i = 0; i < samples.length; i++) {
+    if (samples_get(&samples, i, &sample) < 0) {
+      cairo_destroy(ctx);
+      cairo_surface_destroy(surface);
+      samples_release(&samples);
+      return NULL;
     }
 
-  Py_DECREF(samples);
+    currentPixel += pixelsPerSample;
+    samplesInAccum += 1;
+    accum += sample;
+    if (currentPixel > 1.0) {
+      accum /= samplesInAccum;
+      cairo_line_to(ctx, x, height - accum);
+      accum = 0;
+      currentPixel -= 1.0;
+      samplesInAccum = 0;
+    }
+    x += pixelsPerSample;
+  }
+
+  samples_release(&samples);
   cairo_line_to(ctx, width, height);
   cairo_close_path(ctx);
   cairo_fill_preserve(ctx);
+  cairo_destroy(ctx);
 
   return PycairoSurface_FromSurface(surface, NULL);
 }
 
+/*
+ * Draw the envelope of a range of peaks over the whole width of an image
+ * surface, which is cleared first: the area between the minimums and the
+ * maximums, and the area below the RMS.
+ * The minimums, maximums and RMS are reduced to one value per pixel, so
+ * the peaks are best provided at one or two per pixel.
+ */
+static PyObject *
+py_draw_envelope(PyObject * self, PyObject * args)
+{
+  PyObject *surfaceObj, *minsObj, *maxsObj, *rmsObj;
+  Samples mins, maxs, rms;
+  Py_ssize_t length;
+  cairo_surface_t *surface;
+  cairo_t *ctx;
+  int width, height, x;
+  double *lows = NULL, *highs = NULL, *averages = NULL;
+  PyObject *result = NULL;
+
+  if (!PyArg_ParseTuple(args, "O!OOO", &PycairoImageSurface_Type,
+          &surfaceObj, &minsObj, &maxsObj, &rmsObj))
+    return NULL;
+
+  if (samples_init(&mins, minsObj) < 0)
+    return NULL;
+  if (samples_init(&maxs, maxsObj) < 0) {
+    samples_release(&mins);
+    return NULL;
+  }
+  if (samples_init(&rms, rmsObj) < 0) {
+    samples_release(&maxs);
+    samples_release(&mins);
+    return NULL;
+  }
+
+  surface = ((PycairoSurface *) surfaceObj)->surface;
+  width = cairo_image_surface_get_width(surface);
+  height = cairo_image_surface_get_height(surface);
+  length = mins.length;
+  if (maxs.length != length || rms.length != length) {
+    PyErr_SetString(PyExc_ValueError,
+        "mins, maxs and rms must have the same length");
+    goto done;
+  }
+
+  ctx = cairo_create(surface);
+  cairo_set_operator(ctx, CAIRO_OPERATOR_CLEAR);
+  cairo_paint(ctx);
+  cairo_set_operator(ctx, CAIRO_OPERATOR_OVER);
+
+  if (length == 0 || width <= 0) {
+    cairo_destroy(ctx);
+    result = Py_None;
+    Py_INCREF(result);
+    goto done;
+  }
+
+  lows = PyMem_New(double, width);
+  highs = PyMem_New(double, width);
+  averages = PyMem_New(double, width);
+  if (lows == NULL || highs == NULL || averages == NULL) {
+    PyErr_NoMemory();
+    cairo_destroy(ctx);
+    goto done;
+  }
+
+  if (reduce_samples(&mins, length, width, REDUCE_MIN, lows) < 0 ||
+      reduce_samples(&maxs, length, width, REDUCE_MAX, highs) < 0 ||
+      reduce_samples(&rms, length, width, REDUCE_AVERAGE, averages) < 0) {
+    cairo_destroy(ctx);
+    goto done;
+  }
+
+  /* The peaks, lighter. */
+  cairo_set_source_rgba(ctx, 0.2, 0.6, 0.0, 0.5);
+  cairo_move_to(ctx, 0, height - highs[0]);
+  for (x = 0; x < width; x++)
+    cairo_line_to(ctx, x + 1, height - highs[x]);
+  for (x = width - 1; x >= 0; x--)
+    cairo_line_to(ctx, x + 1, height - lows[x]);
+  cairo_line_to(ctx, 0, height - lows[0]);
+  cairo_close_path(ctx);
+  cairo_fill(ctx);
+
+  /* The RMS. */
+  cairo_set_source_rgb(ctx, 0.2, 0.6, 0.0);
+  cairo_move_to(ctx, 0, height);
+  cairo_line_to(ctx, 0, height - averages[0]);
+  for (x = 0; x < width; x++)
+    cairo_line_to(ctx, x + 1, height - averages[x]);
+  cairo_line_to(ctx, width, height);
+  cairo_close_path(ctx);
+  cairo_fill(ctx);
+
+  cairo_destroy(ctx);
+  cairo_surface_flush(surface);
+  result = Py_None;
+  Py_INCREF(result);
+
+done:
+  PyMem_Free(lows);
+  PyMem_Free(highs);
+  PyMem_Free(averages);
+  samples_release(&rms);
+  samples_release(&maxs);
+  samples_release(&mins);
+  return result;
+}
+
 static PyMethodDef renderer_methods[] = {
   {"fill_surface", py_fill_surface, METH_VARARGS},
+  {"draw_envelope", py_draw_envelope, METH_VARARGS},
   {NULL, NULL}
 };
 
@@ -51,6 +51,7 @@ from pitivi.configure import get_ui_dir, get_pixmap_dir
 from pitivi.settings import GlobalSettings
 
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.search import SearchIndex, SEARCH_DELAY
 from pitivi.utils.ui import EFFECT_TARGET_ENTRY, SPACING
 
 from pitivi.utils.widgets import GstElementSettingsWidget, FractionWidget
@@ -339,6 +340,9 @@ class EffectListWidget(Gtk.VBox, Loggable):
         self.audio_togglebutton = builder.get_object("audio_togglebutton")
         self.categoriesWidget = builder.get_object("categories")
         self.searchEntry = builder.get_object("search_entry")
+        # The searchable texts of the effects, keyed by element name.
+        self._search_index = SearchIndex()
+        self._search_timeout_id = 0
 
         # Store
         self.storemodel = Gtk.ListStore(
@@ -420,6 +424,8 @@ class EffectListWidget(Gtk.VBox, Loggable):
             name = element.get_name()
             if name not in HIDDEN_EFFECTS:
                 effect_factory = self.app.effects.getFactoryFromName(name)
+                self._search_index.add(name, effect_factory.human_name,
+                                       effect_factory.description)
                 self.storemodel.append([effect_factory.human_name,
                                         effect_factory.description,
                                         effectType,
@@ -516,7 +522,17 @@ class EffectListWidget(Gtk.VBox, Loggable):
         self.modelFilter.refilter()
 
     def _searchEntryChangedCb(self, unused_entry):
+        if self._search_timeout_id:
+            GLib.source_remove(self._search_timeout_id)
+        # Wait for the user to stop typing.
+        self._search_timeout_id = GLib.timeout_add(
+            SEARCH_DELAY, self._searchTimeoutCb)
+
+    def _searchTimeoutCb(self):
+        self._search_timeout_id = 0
+        self._search_index.search(self.searchEntry.get_text())
         self.modelFilter.refilter()
+        return False
 
     def _searchEntryIconClickedCb(self, entry, unused, unused1):
         entry.set_text("")
@@ -526,9 +542,8 @@ class EffectListWidget(Gtk.VBox, Loggable):
             if model.get_value(iter, COL_EFFECT_CATEGORIES) is None:
                 return False
             if self.categoriesWidget.get_active_text() in model.get_value(iter, COL_EFFECT_CATEGORIES):
-                text = self.searchEntry.get_text().lower()
-                return text in model.get_value(iter, COL_DESC_TEXT).lower() or\
-                    text in model.get_value(iter, COL_NAME_TEXT).lower()
+                return self._search_index.matches(
+                    model.get_value(iter, COL_ELEMENT_NAME))
             else:
                 return False
         else:
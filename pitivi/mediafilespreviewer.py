@@ -32,6 +32,7 @@ from gi.repository import Pango
 from gi.repository import GstPbutils
 
 from pitivi.settings import GlobalSettings
+from pitivi.utils.discovery import discovery_cache
 from pitivi.utils.loggable import Loggable
 from pitivi.utils.misc import uri_is_valid
 from pitivi.utils.pipeline import AssetPipeline
@@ -192,6 +193,11 @@ class PreviewWidget(Gtk.Grid, Loggable):
             self.log(uri + " already in error cache")
             self.show_error(uri)
         else:
+            info = discovery_cache.get(uri)
+            if info is not None:
+                self.log(uri + " already in the discovery cache")
+                self.show_preview(uri, info)
+                return
             self.log("Call discoverer for " + uri)
             self.fixme("Use a GESAsset here, and discover async with it")
             try:
@@ -201,6 +207,7 @@ class PreviewWidget(Gtk.Grid, Loggable):
                 if self.current_selected_uri == uri:
                     self.show_error(uri)
                 return
+            discovery_cache.set(info)
 
             if self.current_selected_uri == uri:
                 self.show_preview(uri, info)
@@ -24,7 +24,6 @@
 
 from gi.repository import Gst
 from gi.repository import GES
-from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
@@ -32,9 +31,10 @@ from gi.repository import Gdk
 from gi.repository import Pango
 from gi.repository import GdkPixbuf
 
+import multiprocessing
 import os
-import time
 import threading
+import time
 
 from urllib.parse import unquote
 from gettext import ngettext, gettext as _
@@ -42,7 +42,6 @@ from urllib.parse import urlparse
 from hashlib import md5
 from gi.repository.GstPbutils import DiscovererVideoInfo
 
-from pitivi.check import missing_soft_deps
 from pitivi.configure import get_ui_dir, get_pixmap_dir
 from pitivi.settings import GlobalSettings
 from pitivi.mediafilespreviewer import PreviewWidget
@@ -51,6 +50,8 @@ from pitivi.dialogs.clipmediaprops import ClipMediaPropsDialog
 from pitivi.utils.ui import beautify_length
 from pitivi.utils.misc import PathWalker, quote_uri, path_from_uri
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.search import SearchIndex, SEARCH_DELAY
+from pitivi.utils.thumbnailer import get_thumbnails_dir, ThumbnailerPool
 import pitivi.utils.ui as dnd
 from pitivi.utils.ui import beautify_info, info_name, FILESOURCE_TARGET_ENTRY, SPACING
 
@@ -73,6 +74,11 @@ GlobalSettings.addConfigOption('lastClipView',
                                key='last-clip-view',
                                type_=int,
                                default=SHOW_ICONVIEW)
+GlobalSettings.addConfigOption('thumbnailerMaxWorkers',
+                               section='clip-library',
+                               key='thumbnailer-max-workers',
+                               environment='PITIVI_THUMBNAILER_MAX_WORKERS',
+                               default=min(4, multiprocessing.cpu_count()))
 
 STORE_MODEL_STRUCTURE = (
     GdkPixbuf.Pixbuf, GdkPixbuf.Pixbuf,
@@ -107,6 +113,10 @@ SUPPORTED_FILE_FORMATS = {
     "image": ("jp2", "jpeg", "png", "svg+xml")}
 # Stuff that we're not too confident about but might improve eventually:
 OTHER_KNOWN_FORMATS = ("video/mp2t",)
+# The types of the files imported when importing a folder.
+KNOWN_MIME_TYPES = [category + "/" + mime
+                    for category, mime_types in SUPPORTED_FILE_FORMATS.items()
+                    for mime in mime_types] + list(OTHER_KNOWN_FORMATS)
 
 
 class MediaLibraryWidget(Gtk.VBox, Loggable):
@@ -122,6 +132,21 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         Loggable.__init__(self)
 
         self.pending_rows = []
+        # Maps the URIs to their rows in self.pending_rows, so the rows can
+        # be looked up and updated without flushing them.
+        self._pending_rows_by_uri = {}
+        # Maps the URIs to the iters of their rows in self.storemodel. The
+        # iters of a Gtk.ListStore stay valid until their row is removed.
+        self._iters_by_uri = {}
+        # The thumbnails generated by self.thumbnailer, waiting to be shown
+        # by a single idle callback.
+        self._pending_thumbnails = []
+        self._pending_thumbnails_lock = threading.Lock()
+        # The searchable texts of the assets, keyed by URI.
+        self._search_index = SearchIndex()
+        self._search_timeout_id = 0
+        # The threads looking for files in the imported folders.
+        self._path_walkers = []
 
         self.app = app
         self._errors = []
@@ -131,6 +156,8 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         self.dragged = False
         self.clip_view = self.app.settings.lastClipView
         self.import_start_time = time.time()
+        # The number of files imported or rejected since the import started.
+        self._nb_processed_imports = 0
 
         builder = Gtk.Builder()
         builder.add_from_file(os.path.join(get_ui_dir(), "medialibrary.ui"))
@@ -177,8 +204,7 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         # Filtering model for the search box.
         # Use this instead of using self.storemodel directly
         self.modelFilter = self.storemodel.filter_new()
-        self.modelFilter.set_visible_func(
-            self._setRowVisible, data=searchEntry)
+        self.modelFilter.set_visible_func(self._setRowVisible)
 
         # TreeView
         # Displays icon, name, type, length
@@ -310,16 +336,8 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         self.pack_start(self.treeview_scrollwin, True, True, 0)
         self.pack_start(self._progressbar, False, True, 0)
 
-        self.thumbnailer = MediaLibraryWidget._getThumbnailer()
-
-    @staticmethod
-    def _getThumbnailer():
-        if "GnomeDesktop" in missing_soft_deps:
-            return None
-        from gi.repository import GnomeDesktop
-        # We need to instanciate the thumbnail factory on the main thread...
-        size_normal = GnomeDesktop.DesktopThumbnailSize.NORMAL
-        return GnomeDesktop.DesktopThumbnailFactory.new(size_normal)
+        self.thumbnailer = ThumbnailerPool(
+            self._thumbnailGeneratedCb, self.app.settings.thumbnailerMaxWorkers)
 
     @staticmethod
     def compare_basename(model, iter1, iter2, unused_user_data):
@@ -338,16 +356,33 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         return 1
 
     def getAssetForUri(self, uri):
-        for path in self.modelFilter:
-            asset = path[COL_ASSET]
-            info = asset.get_info()
-            asset_uri = info.get_uri()
-            if asset_uri == uri:
-                self.debug("Found asset: %s for uri: %s" % (asset, uri))
-                return asset
+        row_iter = self._getIterForUri(uri)
+        if row_iter is not None:
+            asset = self.storemodel.get_value(row_iter, COL_ASSET)
+            self.debug("Found asset: %s for uri: %s" % (asset, uri))
+            return asset
+        row = self._pending_rows_by_uri.get(uri)
+        if row is not None:
+            asset = row[COL_ASSET]
+            self.debug("Found pending asset: %s for uri: %s" % (asset, uri))
+            return asset
 
         self.warning("Did not find any asser for uri: %s" % (uri))
 
+    def _getIterForUri(self, uri):
+        """
+        Get the iter of the row of the specified URI in the model.
+
+        @returns: The iter, or None if the row is not in the model, which
+        includes the rows still in self.pending_rows.
+        """
+        return self._iters_by_uri.get(uri)
+
+    def _clearStoreModel(self):
+        self.storemodel.clear()
+        self._iters_by_uri.clear()
+        self._search_index.clear()
+
     def _setup_view_for_drag_and_drop(self, view, target_entries):
         view.drag_source_set(0, [], Gdk.DragAction.COPY)
         view.enable_model_drag_source(
@@ -373,8 +408,19 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         # ellipsizing, doing needless searches is very expensive.
         # Realistically, nobody expects to search for only one character,
         # and skipping that makes a huge difference in responsiveness.
+        if self._search_timeout_id:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = 0
         if len(entry.get_text()) != 1:
-            self.modelFilter.refilter()
+            # Wait for the user to stop typing.
+            self._search_timeout_id = GLib.timeout_add(
+                SEARCH_DELAY, self._searchTimeoutCb, entry)
+
+    def _searchTimeoutCb(self, entry):
+        self._search_timeout_id = 0
+        self._search_index.search(entry.get_text())
+        self.modelFilter.refilter()
+        return False
 
     def _searchEntryIconClickedCb(self, entry, icon_pos, unused_event):
         if icon_pos == Gtk.EntryIconPosition.SECONDARY:
@@ -382,17 +428,29 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         elif icon_pos == Gtk.EntryIconPosition.PRIMARY:
             self._selectUnusedSources()
 
-    def _setRowVisible(self, model, iter, data):
+    def _setRowVisible(self, model, iter, unused_data):
         """
         Toggle the visibility of a liststore row.
         Used for the search box.
         """
-        text = data.get_text().lower()
-        if not text:
-            return True  # Avoid silly warnings
-        # We must convert to markup form to be able to search for &, ', etc.
-        text = GLib.markup_escape_text(text)
-        return text in model.get_value(iter, COL_INFOTEXT).lower()
+        return self._search_index.matches(model.get_value(iter, COL_URI))
+
+    def _indexAsset(self, info, infotext):
+        """
+        Make an asset searchable by its path, its properties and its tags.
+        """
+        # The infotext is markup, which should not be searched.
+        texts = [Pango.parse_markup(infotext, -1, "\0")[2]]
+        tags = info.get_tags()
+        if tags:
+            for i in range(tags.n_tags()):
+                tag = tags.nth_tag_name(i)
+                if Gst.tag_get_type(tag) != GObject.TYPE_STRING:
+                    continue
+                res, value = tags.get_string(tag)
+                if res:
+                    texts.append(value)
+        self._search_index.add(info.get_uri(), *texts)
 
     def _getIcon(self, iconname, alternate=None, size=48):
         icontheme = Gtk.IconTheme.get_default()
@@ -531,8 +589,8 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         The cache dirs might have resolutions of 256 and/or 128,
         while we need 128 (for iconview) and 64 (for listview).
         """
-        path_256 = dir + "large/" + hash + ".png"
-        path_128 = dir + "normal/" + hash + ".png"
+        path_256 = os.path.join(dir, "large", hash + ".png")
+        path_128 = os.path.join(dir, "normal", hash + ".png")
         interpolation = GdkPixbuf.InterpType.BILINEAR
 
         # First, try the 128 version since that's the native resolution we
@@ -553,30 +611,6 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
             except GLib.GError:
                 return None, None
 
-    def _generateThumbnails(self, uri):
-        if not self.thumbnailer:
-            # TODO: Use thumbnails generated with GStreamer.
-            return None
-        # This way of getting the mimetype feels awfully convoluted but
-        # seems to be the proper/reliable way in a GNOME context
-        asset_file = Gio.file_new_for_uri(uri)
-        info = asset_file.query_info(attributes="standard::*",
-                                     flags=Gio.FileQueryInfoFlags.NONE,
-                                     cancellable=None)
-        mime = Gio.content_type_get_mime_type(info.get_content_type())
-        mtime = os.path.getmtime(path_from_uri(uri))
-        if not self.thumbnailer.can_thumbnail(uri, mime, mtime):
-            self.debug("Thumbnailer says it can't thumbnail %s", uri)
-            return None
-        pixbuf_128 = self.thumbnailer.generate_thumbnail(uri, mime)
-        if not pixbuf_128:
-            self.debug("Thumbnailer failed thumbnailing %s", uri)
-            return None
-        self.thumbnailer.save_thumbnail(pixbuf_128, uri, mtime)
-        pixbuf_64 = pixbuf_128.scale_simple(
-            64, 64, GdkPixbuf.InterpType.BILINEAR)
-        return pixbuf_128, pixbuf_64
-
     def _addAsset(self, asset):
         # 128 is the normal size for thumbnails, but for *icons* it looks
         # insane
@@ -596,16 +630,8 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
             # Older version of the spec also mentioned $HOME/.thumbnails
             quoted_uri = quote_uri(info.get_uri())
             thumbnail_hash = md5(quoted_uri.encode()).hexdigest()
-            try:
-                thumb_dir = os.environ['XDG_CACHE_HOME']
-                thumb_64, thumb_128 = self._getThumbnailInDir(
-                    thumb_dir, thumbnail_hash)
-            except KeyError:
-                thumb_64, thumb_128 = (None, None)
-            if thumb_64 is None:
-                thumb_dir = os.path.expanduser("~/.cache/thumbnails/")
-                thumb_64, thumb_128 = self._getThumbnailInDir(
-                    thumb_dir, thumbnail_hash)
+            thumb_64, thumb_128 = self._getThumbnailInDir(
+                get_thumbnails_dir(), thumbnail_hash)
             if thumb_64 is None:
                 thumb_dir = os.path.expanduser("~/.thumbnails/")
                 thumb_64, thumb_128 = self._getThumbnailInDir(
@@ -619,7 +645,6 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
                     thumb_64 = self._getIcon("video-x-generic")
                     thumb_128 = self._getIcon(
                         "video-x-generic", None, LARGE_SIZE)
-                # TODO ideally gst discoverer should create missing thumbnails.
                 self.log(
                     "Missing a thumbnail for %s, queuing", path_from_uri(quoted_uri))
                 self._missing_thumbs.append(quoted_uri)
@@ -633,22 +658,28 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
             duration = beautify_length(info.get_duration())
 
         name = info_name(info)
-
-        self.pending_rows.append((thumb_64,
-                                  thumb_128,
-                                  beautify_info(info),
-                                  asset,
-                                  info.get_uri(),
-                                  duration,
-                                  name))
+        infotext = beautify_info(info)
+        self._indexAsset(info, infotext)
+
+        # A list, so the thumbnails can be replaced until it is flushed.
+        row = [thumb_64,
+               thumb_128,
+               infotext,
+               asset,
+               info.get_uri(),
+               duration,
+               name]
+        self.pending_rows.append(row)
+        self._pending_rows_by_uri[row[COL_URI]] = row
         if len(self.pending_rows) > 50:
             self.flush_pending_rows()
 
     def flush_pending_rows(self):
         self.debug("Flushing %d pending model rows", len(self.pending_rows))
         for row in self.pending_rows:
-            self.storemodel.append(row)
+            self._iters_by_uri[row[COL_URI]] = self.storemodel.append(row)
         del self.pending_rows[:]
+        self._pending_rows_by_uri.clear()
 
     # medialibrary callbacks
 
@@ -656,18 +687,24 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
                       unused_current_clip_iter=None, unused_total_clips=None):
         """ a file was added to the medialibrary """
         if isinstance(asset, GES.UriClipAsset):
+            self._nb_processed_imports += 1
             self._updateProgressbar()
             self._addAsset(asset)
+            self._releaseWalkedUri(asset.get_id())
 
     def _assetRemovedCb(self, unused_project, asset):
         """ the given uri was removed from the medialibrary """
         # find the good line in the storemodel and remove it
         model = self.storemodel
         uri = asset.get_id()
-        for row in model:
-            if uri == row[COL_URI]:
-                model.remove(row.iter)
-                break
+        row_iter = self._getIterForUri(uri)
+        if row_iter is not None:
+            del self._iters_by_uri[uri]
+            model.remove(row_iter)
+        row = self._pending_rows_by_uri.pop(uri, None)
+        if row is not None:
+            self.pending_rows.remove(row)
+        self._search_index.remove(uri)
         if not len(model):
             self._welcome_infobar.show_all()
         self.debug("Removing: %s", uri)
@@ -677,18 +714,29 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         if GObject.type_is_a(type, GES.UriClip):
             error = (id, str(error.domain), error)
             self._errors.append(error)
+            self._nb_processed_imports += 1
             self._updateProgressbar()
+            self._releaseWalkedUri(id)
 
     def _sourcesStartedImportingCb(self, unused_project):
         self.import_start_time = time.time()
+        self._nb_processed_imports = 0
         self._welcome_infobar.hide()
         self._progressbar.show()
 
     def _sourcesStoppedImportingCb(self, unused_project):
-        self.debug("Importing took %.3f seconds",
-                   time.time() - self.import_start_time)
+        duration = time.time() - self.import_start_time
+        self.info("Importing %d files took %.3f seconds, %.1f files per second",
+                  self._nb_processed_imports, duration,
+                  self._nb_processed_imports / max(duration, 0.001))
         self.flush_pending_rows()
         self._progressbar.hide()
+        # Nothing is being imported anymore, including the walked files
+        # which were already in the project.
+        for walker in self._path_walkers:
+            walker.releaseAll()
+        self._path_walkers = [walker for walker in self._path_walkers
+                              if walker.is_alive()]
         if self._errors:
             errors_amount = len(self._errors)
             btn_text = ngettext("View error", "View errors", errors_amount)
@@ -708,31 +756,38 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         self._missing_thumbs = []
         if missing_thumbs:
             self.info("Generating missing thumbnails: %d", len(missing_thumbs))
-            self._thumbs_process = threading.Thread(
-                target=MediaLibraryWidget._generateThumbnailsThread, args=(self, missing_thumbs))
-            self._thumbs_process.start()
-
-    def _generateThumbnailsThread(self, missing_thumbs):
-        for uri in missing_thumbs:
-            thumbnails = self._generateThumbnails(uri)
-            if not thumbnails:
+            self.thumbnailer.add(missing_thumbs)
+
+    def _thumbnailGeneratedCb(self, uri, pixbuf_128, pixbuf_64):
+        # Called in the threads of the thumbnailer.
+        with self._pending_thumbnails_lock:
+            if not self._pending_thumbnails:
+                GLib.idle_add(self._setPendingThumbnails)
+            self._pending_thumbnails.append((uri, pixbuf_128, pixbuf_64))
+
+    def _setPendingThumbnails(self):
+        with self._pending_thumbnails_lock:
+            thumbnails = self._pending_thumbnails
+            self._pending_thumbnails = []
+        self.debug("Showing %d thumbnails", len(thumbnails))
+        for uri, pixbuf_128, pixbuf_64 in thumbnails:
+            row = self._pending_rows_by_uri.get(uri)
+            if row is not None:
+                # Shown when the row is flushed.
+                row[COL_ICON_64] = pixbuf_64
+                row[COL_ICON_128] = pixbuf_128
                 continue
-            pixbuf_128, pixbuf_64 = thumbnails
-            # Search through the model for the row corresponding to the asset.
-            found = False
-            for row in self.storemodel:
-                if uri == row[COL_URI]:
-                    found = True
-                    # Finally, show the new pixbuf in the UI
-                    if pixbuf_128:
-                        row[COL_ICON_128] = pixbuf_128
-                    if pixbuf_64:
-                        row[COL_ICON_64] = pixbuf_64
-                    break
-            if not found:
+            row_iter = self._getIterForUri(uri)
+            if row_iter is None:
                 # Can happen if the user removed the asset in the meanwhile.
                 self.log(
                     "%s needed a thumbnail, but vanished from storemodel", uri)
+                continue
+            # Finally, show the new pixbuf in the UI
+            self.storemodel.set(row_iter,
+                                [COL_ICON_64, COL_ICON_128],
+                                [pixbuf_64, pixbuf_128])
+        return False
 
     # Error Dialog Box callbacks
 
@@ -1022,30 +1077,48 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
     def _newProjectCreatedCb(self, unused_app, project):
         if self._project is not project:
             self._project = project
+            self.thumbnailer.cancel()
+            self._abortPathWalkers()
             self._resetErrorList()
-            self.storemodel.clear()
+            self._clearStoreModel()
             self._welcome_infobar.show_all()
             self._connectToProject(project)
 
     def _newProjectLoadedCb(self, unused_app, project, unused_fully_ready):
         if self._project is not project:
             self._project = project
-            self.storemodel.clear()
+            self.thumbnailer.cancel()
+            self._abortPathWalkers()
+            self._clearStoreModel()
             self._connectToProject(project)
 
         # Make sure that the sources added to the project are added added
         self.flush_pending_rows()
 
     def _newProjectFailedCb(self, unused_pitivi, unused_reason, unused_uri):
-        self.storemodel.clear()
+        self._clearStoreModel()
         self._project = None
 
+    def _releaseWalkedUri(self, uri):
+        for walker in self._path_walkers:
+            if walker.release(uri):
+                break
+
+    def _abortPathWalkers(self):
+        for walker in self._path_walkers:
+            walker.abort()
+        del self._path_walkers[:]
+
     def _addUris(self, uris):
         if self.app.project_manager.current_project:
-            self.app.project_manager.current_project.addUris(uris)
+            uris = self.app.project_manager.current_project.addUris(uris)
         else:
             self.warning(
                 "Adding uris to project, but the project has changed in the meantime")
+        # Neither "asset-added" nor "error-loading-asset" is emitted for the
+        # URIs which are not imported, so the walkers do not wait for them.
+        for uri in uris:
+            self._releaseWalkedUri(uri)
         return False
 
     # Drag and Drop
@@ -1079,7 +1152,9 @@ class MediaLibraryWidget(Gtk.VBox, Loggable):
         if directories:
             # Recursively import from folders that were dragged into the
             # library
-            self.app.threads.addThread(PathWalker, directories, self._addUris)
+            walker = self.app.threads.addThread(
+                PathWalker, directories, self._addUris, KNOWN_MIME_TYPES)
+            self._path_walkers.append(walker)
         if filenames:
             self.app.project_manager.current_project.addUris(filenames)
 
@@ -40,6 +40,7 @@ from pwd import getpwuid
 from pitivi.undo.undo import UndoableAction
 from pitivi.configure import get_ui_dir
 
+from pitivi.utils.discovery import discovery_cache
 from pitivi.utils.validate import has_validate
 from pitivi.utils.misc import quote_uri, path_from_uri, isWritable, unicode_error_dialog
 from pitivi.utils.pipeline import PipelineError, Seeker
@@ -1007,6 +1008,8 @@ class Project(Loggable, GES.Project):
             # Ignore for example the assets producing GES.TitleClips.
             return
         self.nb_imported_files += 1
+        if asset:
+            discovery_cache.set(asset.get_info())
         assets = self.get_loading_assets()
         self.nb_remaining_file_to_import = len([asset for asset in assets if
                                                 GObject.type_is_a(asset.get_extractable_type(), GES.UriClip)])
@@ -1124,12 +1127,20 @@ class Project(Loggable, GES.Project):
         Add c{uris} to the source list.
 
         The uris will be analyzed before being added.
+
+        @returns: The quoted URIs which the project already has. No signal
+        is emitted for them.
+        @rtype: C{list} of C{str}
         """
-        # Do not try to reload URIS that we already have loaded
         self.app.action_log.begin("Adding assets")
+        rejected = []
         for uri in uris:
-            self.create_asset(quote_uri(uri), GES.UriClip)
+            uri = quote_uri(uri)
+            if not self.create_asset(uri, GES.UriClip):
+                # Do not try to reload URIS that we already have loaded
+                rejected.append(uri)
         self._calculateNbLoadingAssets()
+        return rejected
 
     def listSources(self):
         return self.list_assets(GES.UriClip)
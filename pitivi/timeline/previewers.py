@@ -20,13 +20,16 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from random import randrange
 import cairo
+import multiprocessing
 import numpy
 import os
-import pickle
 import sqlite3
+import struct
+import weakref
 
 from gi.repository import Clutter
 from gi.repository import Cogl
@@ -43,7 +46,8 @@ except ImportError:
     # Running uninstalled?
     import renderer
 
-from pitivi.settings import get_dir, xdg_cache_home
+from pitivi.settings import GlobalSettings
+from pitivi.utils.cache import cache_manager
 from pitivi.utils.loggable import Loggable
 from pitivi.utils.misc import binary_search, filename_from_uri, quantize, quote_uri, hash_file, format_ns
 from pitivi.utils.system import CPUUsageTracker
@@ -57,17 +61,68 @@ WAVEFORMS_CPU_USAGE = 30
 # A little lower as it's more fluctuating
 THUMBNAILS_CPU_USAGE = 20
 
+# How often the CPU usage shared by all the previewers is sampled.
+CPU_USAGE_SAMPLING_INTERVAL = timedelta(microseconds=400000)
+
+# The keyframe thumbnails are refined only while the CPU usage is below this.
+THUMBNAILS_REFINE_CPU_USAGE = THUMBNAILS_CPU_USAGE / 2
+# How often to check whether the CPU is idle enough to refine the keyframe
+# thumbnails, in milliseconds.
+THUMBNAILS_REFINE_RETRY_INTERVAL = 1000
+
 THUMB_MARGIN_PX = 3
+# The keyframe interval assumed when deciding whether to do a linear pass,
+# until it is measured from the keyframes found when fast seeking.
+LINEAR_PASS_DEFAULT_KEYFRAME_INTERVAL = 4 * Gst.SECOND
+# The number of thumbnails compressed and stored at once by a linear pass.
+LINEAR_PASS_BATCH_SIZE = 50
+# How much memory the decoded thumbnails of all the clips can use.
+DECODED_THUMBS_MAX_BYTES = 64 * 1024 * 1024
 WAVEFORM_UPDATE_INTERVAL = timedelta(microseconds=500000)
+# The duration of the audio summarized by a waveform peak.
+WAVEFORM_SAMPLE_INTERVAL = 10 * Gst.MSECOND
+# Each level of the waveform pyramids summarizes this many peaks of the
+# previous level, down to a level with at most WAVEFORM_PYRAMID_MIN_PEAKS.
+WAVEFORM_PYRAMID_FACTOR = 4
+WAVEFORM_PYRAMID_MIN_PEAKS = 256
+# The waveforms are drawn in tiles of this width, kept in memory up to
+# WAVEFORM_TILES_MAX_BYTES, so scrolling only composites the tiles.
+WAVEFORM_TILE_WIDTH = 256
+WAVEFORM_TILES_MAX_BYTES = 32 * 1024 * 1024
 # For the waveforms, ensures we always have a little extra surface when
 # scrolling while playing.
 MARGIN = 500
 
+cache_manager.addStore("thumbs")
+cache_manager.addStore("waves")
+
 PREVIEW_GENERATOR_SIGNALS = {
     "done": (GObject.SIGNAL_RUN_LAST, None, ()),
     "error": (GObject.SIGNAL_RUN_LAST, None, ()),
 }
 
+GlobalSettings.addConfigSection("previewers")
+GlobalSettings.addConfigOption("previewersMaxWorkers",
+                               section="previewers",
+                               key="max-workers",
+                               environment="PITIVI_PREVIEWERS_MAX_WORKERS",
+                               default=max(1, multiprocessing.cpu_count() // 4),
+                               notify=True)
+GlobalSettings.addConfigOption("previewersFastSeek",
+                               section="previewers",
+                               key="fast-seek",
+                               environment="PITIVI_PREVIEWERS_FAST_SEEK",
+                               default=False)
+GlobalSettings.addConfigOption("previewersRefineThumbnails",
+                               section="previewers",
+                               key="refine-thumbnails",
+                               default=True)
+GlobalSettings.addConfigOption("previewersUnsyncedWaveforms",
+                               section="previewers",
+                               key="unsynced-waveforms",
+                               environment="PITIVI_PREVIEWERS_UNSYNCED_WAVEFORMS",
+                               default=True)
+
 
 """
 Convention throughout this file:
@@ -76,48 +131,226 @@ is prefixed with a little b, example : bTimeline
 """
 
 
+def get_visible_timeline_range(timeline):
+    """
+    Get the part of the timeline which is on screen.
+
+    @returns: The times of the left and right edges, in nanoseconds.
+    """
+    if not timeline.get_stage():
+        return (0, 0)
+
+    # determine the visible left edge of the timeline
+    # TODO: isn't there some easier way to get the scroll point of the ScrollActor?
+    # timeline_left = -(timeline.get_transform().xw - timeline.props.x)
+    timeline_left = timeline.get_scroll_point().x
+
+    # determine the width of the pipeline
+    # by intersecting the timeline's and the stage's allocation
+    timeline_allocation = timeline.props.allocation
+    stage_allocation = timeline.get_stage().props.allocation
+
+    timeline_rect = Clutter.Rect()
+    timeline_rect.init(timeline_allocation.x1,
+                       timeline_allocation.y1,
+                       timeline_allocation.x2 - timeline_allocation.x1,
+                       timeline_allocation.y2 - timeline_allocation.y1)
+
+    stage_rect = Clutter.Rect()
+    stage_rect.init(stage_allocation.x1,
+                    stage_allocation.y1,
+                    stage_allocation.x2 - stage_allocation.x1,
+                    stage_allocation.y2 - stage_allocation.y1)
+
+    has_intersection, intersection = timeline_rect.intersection(stage_rect)
+
+    if not has_intersection:
+        return (0, 0)
+
+    timeline_width = intersection.size.width
+
+    # determine the visible right edge of the timeline
+    timeline_right = timeline_left + timeline_width
+
+    # convert to nanoseconds
+    time_left = Zoomable.pixelToNs(timeline_left)
+    time_right = Zoomable.pixelToNs(timeline_right)
+
+    return (time_left, time_right)
+
+
+def is_element_visible(timeline, element):
+    """
+    Check whether a part of a timeline element is on screen.
+
+    @type element: L{GES.TimelineElement}
+    """
+    timeline_left, timeline_right = get_visible_timeline_range(timeline)
+    start = element.props.start
+    return start < timeline_right and \
+        start + element.props.duration > timeline_left
+
+
+def estimate_keyframe_interval(keyframe_times):
+    """
+    Estimate the interval between the keyframes of a stream.
+
+    @param keyframe_times: Times of keyframes, in any order, possibly
+    repeated.
+    @returns: The median interval between the consecutive keyframes, in
+    nanoseconds, or None if there are less than two keyframes.
+    """
+    times = sorted(set(keyframe_times))
+    if len(times) < 2:
+        return None
+    return int(numpy.median(numpy.diff(times)))
+
+
 class PreviewGeneratorManager():
 
     """
     Manage the execution of PreviewGenerators
+
+    Up to max_workers PreviewGenerators run at the same time for each
+    GES.TrackType. The generators of the clips visible on screen are
+    started before the others.
+
+    The refinements of the previews are queued separately. They are
+    started only when no other generator is waiting and the CPU is idle,
+    and are stopped when another generator needs their slot.
     """
 
     def __init__(self):
-        # The current PreviewGenerator per GES.TrackType.
-        self._cpipeline = {}
+        # The running PreviewGenerators per GES.TrackType.
+        self._cpipelines = {
+            GES.TrackType.AUDIO: [],
+            GES.TrackType.VIDEO: []
+        }
         # The queue of PreviewGenerators.
         self._pipelines = {
             GES.TrackType.AUDIO: [],
             GES.TrackType.VIDEO: []
         }
+        # The queue of PreviewGenerators waiting to refine their previews.
+        self._refinements = {
+            GES.TrackType.AUDIO: [],
+            GES.TrackType.VIDEO: []
+        }
+        # The running PreviewGenerators which are refining their previews.
+        self._running_refinements = set()
+        self._refine_retry_id = 0
+        self.max_workers = 1
+        # A single tracker for all the generators, so the CPU budget is
+        # applied to the whole process instead of to each generator.
+        self._cpu_usage_tracker = CPUUsageTracker()
+        self._cpu_usage = 0
+        self._cpu_usage_time = None
 
     def addPipeline(self, pipeline):
         track_type = pipeline.track_type
 
-        current_pipeline = self._cpipeline.get(track_type)
+        running_pipelines = self._cpipelines[track_type]
         if pipeline in self._pipelines[track_type] or \
-                pipeline is current_pipeline:
+                pipeline in running_pipelines:
             # Already in the queue or already processing.
             return
+        if pipeline in self._refinements[track_type]:
+            self._refinements[track_type].remove(pipeline)
 
-        if not self._pipelines[track_type] and current_pipeline is None:
+        if not self._pipelines[track_type] and \
+                len(running_pipelines) < self.max_workers:
             self._setPipeline(pipeline)
         else:
             self._pipelines[track_type].insert(0, pipeline)
+            self._preemptRefinement(track_type)
+
+    def addRefinement(self, pipeline):
+        """
+        Queue a generator which has to refine its previews when the CPU is
+        idle, after all the generators queued with addPipeline.
+        """
+        track_type = pipeline.track_type
+        if pipeline in self._pipelines[track_type] or \
+                pipeline in self._cpipelines[track_type] or \
+                pipeline in self._refinements[track_type]:
+            return
+        self._refinements[track_type].insert(0, pipeline)
+        self._startQueuedPipelines(track_type)
+
+    def _preemptRefinement(self, track_type):
+        for pipeline in self._cpipelines[track_type]:
+            if pipeline in self._running_refinements:
+                # Emits "done", which starts the next queued generator.
+                pipeline.stopGeneration()
+                self.addRefinement(pipeline)
+                return
+
+    def setMaxWorkers(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        for track_type in self._pipelines:
+            self._startQueuedPipelines(track_type)
+
+    def cpuUsage(self):
+        """
+        Get the CPU usage of the process, sampled at most once per
+        CPU_USAGE_SAMPLING_INTERVAL whatever the number of generators asking.
+        """
+        now = datetime.now()
+        if self._cpu_usage_time is None or \
+                now - self._cpu_usage_time > CPU_USAGE_SAMPLING_INTERVAL:
+            self._cpu_usage = self._cpu_usage_tracker.usage()
+            self._cpu_usage_tracker.reset()
+            self._cpu_usage_time = now
+        return self._cpu_usage
+
+    def _startQueuedPipelines(self, track_type):
+        while self._pipelines[track_type] and \
+                len(self._cpipelines[track_type]) < self.max_workers:
+            self._setPipeline(self._popPipeline(self._pipelines[track_type]))
+
+        refinements = self._refinements[track_type]
+        if not refinements or self._pipelines[track_type] or \
+                len(self._cpipelines[track_type]) >= self.max_workers:
+            return
+        if self.cpuUsage() >= THUMBNAILS_REFINE_CPU_USAGE:
+            if not self._refine_retry_id:
+                self._refine_retry_id = GLib.timeout_add(
+                    THUMBNAILS_REFINE_RETRY_INTERVAL, self._refineRetryCb)
+            return
+        while refinements and \
+                len(self._cpipelines[track_type]) < self.max_workers:
+            pipeline = self._popPipeline(refinements)
+            self._running_refinements.add(pipeline)
+            self._setPipeline(pipeline)
+
+    def _refineRetryCb(self):
+        self._refine_retry_id = 0
+        for track_type in self._refinements:
+            self._startQueuedPipelines(track_type)
+        return False
+
+    def _popPipeline(self, queue):
+        # The generators are queued at the front, so this favors the
+        # earliest queued visible generator, if any.
+        for index in range(len(queue) - 1, -1, -1):
+            if queue[index].isVisible():
+                return queue.pop(index)
+        return queue.pop()
 
     def _setPipeline(self, pipeline):
-        self._cpipeline[pipeline.track_type] = pipeline
+        self._cpipelines[pipeline.track_type].append(pipeline)
         pipeline.connect("done", self._nextPipeline)
         pipeline.startGeneration()
 
     def _nextPipeline(self, controlled):
         track_type = controlled.track_type
-        pipeline = self._cpipeline.pop(track_type, None)
-        if pipeline:
-            pipeline.disconnect_by_func(self._nextPipeline)
+        running_pipelines = self._cpipelines[track_type]
+        if controlled in running_pipelines:
+            running_pipelines.remove(controlled)
+            controlled.disconnect_by_func(self._nextPipeline)
+        self._running_refinements.discard(controlled)
 
-        if self._pipelines[track_type]:
-            self._setPipeline(self._pipelines[track_type].pop())
+        self._startQueuedPipelines(track_type)
 
 
 class PreviewGenerator(object):
@@ -144,12 +377,37 @@ class PreviewGenerator(object):
     def stopGeneration(self):
         raise NotImplemented
 
+    def isVisible(self):
+        """
+        Whether the previewed clip is currently on screen, in which case
+        its generation is started before the generation of the others.
+        """
+        return True
+
     def becomeControlled(self):
         """
         Let the PreviewGeneratorManager control our execution
         """
         PreviewGenerator.__manager.addPipeline(self)
 
+    def requestRefinement(self):
+        """
+        Let the PreviewGeneratorManager start our execution again when the
+        CPU is idle and no other generator is waiting.
+        """
+        PreviewGenerator.__manager.addRefinement(self)
+
+    @staticmethod
+    def cpuUsage():
+        return PreviewGenerator.__manager.cpuUsage()
+
+    @staticmethod
+    def setMaxWorkers(max_workers):
+        """
+        Set how many generators of the same track type can run in parallel.
+        """
+        PreviewGenerator.__manager.setMaxWorkers(max_workers)
+
 
 class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
 
@@ -185,12 +443,29 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         self.thumb_period = int(0.5 * Gst.SECOND)
         self.thumb_height = EXPANDED_SIZE - 2 * THUMB_MARGIN_PX
         self.thumb_width = None  # will be set by self._setupPipeline()
+        # Whether to seek to the keyframe nearest to the wanted time instead
+        # of decoding up to the exact frame. The thumbnails shown in place
+        # of the exact ones can be refined later when the CPU is idle.
+        self.fast_seek = self.timeline._settings.previewersFastSeek
+        self.refine_thumbnails = self.timeline._settings.previewersRefineThumbnails
+        # Maps the times of the thumbnails to the times of the keyframes
+        # found when fast seeking.
+        self._snapped_times = {}
+        # The times of the visible thumbnails showing a keyframe.
+        self._refine_wishlist = []
+        self._refining = False
+        self._seek_time = None
+        self._seek_flags = Gst.SeekFlags.ACCURATE
+        # Whether the clip is being decoded in PLAYING state to get all
+        # the thumbnails of a range instead of seeking for each of them.
+        self._linear_pass = False
+        self._linear_pass_thumbs = []
+        self._linear_pass_times = set()
 
         # Maps (quantized) times to Thumbnail objects
         self.thumbs = {}
         self.thumb_cache = get_cache_for_uri(self.uri)
 
-        self.cpu_usage_tracker = CPUUsageTracker()
         self.interval = 500  # Every 0.5 second, reevaluate the situation
 
         # Connect signals and fire things up
@@ -208,6 +483,8 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
             self._addVisibleThumbnails()
             if self.wishlist:
                 self.becomeControlled()
+            elif self.refine_thumbnails and self._refine_wishlist:
+                self.requestRefinement()
 
     def _setupPipeline(self):
         """
@@ -263,7 +540,7 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         which the next thumbnail will be generated. Even then, it will only
         happen when the gobject loop is idle to avoid blocking the UI.
         """
-        usage_percent = self.cpu_usage_tracker.usage()
+        usage_percent = self.cpuUsage()
         if usage_percent < THUMBNAILS_CPU_USAGE:
             self.interval *= 0.9
             self.log(
@@ -274,7 +551,8 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
             self.log(
                 'Thumbnailing slowed down (-10%%) to a %.1f ms interval for "%s"' %
                 (self.interval, filename_from_uri(self.uri)))
-        self.cpu_usage_tracker.reset()
+        if self._thumb_cb_id:
+            GLib.source_remove(self._thumb_cb_id)
         self._thumb_cb_id = GLib.timeout_add(
             self.interval, self._create_next_thumb)
 
@@ -317,15 +595,28 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         return False
 
     def _create_next_thumb(self):
+        self._thumb_cb_id = None
         if not self.wishlist or not self.queue:
+            if self._refineNextThumb():
+                # Remove the GSource
+                return False
             # nothing left to do
             self.debug("Thumbnails generation complete")
             self.stopGeneration()
             self.thumb_cache.commit()
-            return
+            if self.refine_thumbnails and self._refine_wishlist:
+                # The CPU is busy, free the slot of the manager and refine
+                # when nothing else is waiting.
+                self.requestRefinement()
+            return False
         else:
             self.debug("Missing %d thumbs", len(self.wishlist))
 
+        if self._useLinearPass():
+            self._startLinearPass()
+            # Remove the GSource
+            return False
+
         wish = self._get_wish()
         if wish:
             time = wish
@@ -336,14 +627,132 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         # append the time to the end of the queue so that if this seek fails
         # another try will be started later
         self.queue.append(time)
-        self.pipeline.seek(1.0,
-                           Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
-                           Gst.SeekType.SET, time,
-                           Gst.SeekType.NONE, -1)
+        self._refining = False
+        if self.fast_seek:
+            self._seek(time, Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_NEAREST)
+        else:
+            self._seek(time, Gst.SeekFlags.ACCURATE)
 
         # Remove the GSource
         return False
 
+    def _useLinearPass(self):
+        """
+        Decide whether decoding the range of the wanted thumbnails is
+        cheaper than seeking for each of them.
+
+        An accurate seek decodes from the previous keyframe, half a keyframe
+        interval on average, while the linear pass decodes the range once.
+        So the linear pass is used when the wanted thumbnails are on average
+        at most half a keyframe interval apart. The keyframe interval is
+        measured from the keyframes found when fast seeking, or assumed to
+        be LINEAR_PASS_DEFAULT_KEYFRAME_INTERVAL.
+        """
+        if len(self.wishlist) < 2:
+            return False
+        keyframe_interval = estimate_keyframe_interval(
+            self._snapped_times.values())
+        if keyframe_interval is None:
+            keyframe_interval = LINEAR_PASS_DEFAULT_KEYFRAME_INTERVAL
+        first_wish = min(self.wishlist)
+        last_wish = max(self.wishlist)
+        spacing = (last_wish - first_wish) / (len(self.wishlist) - 1)
+        return spacing <= keyframe_interval / 2
+
+    def _startLinearPass(self):
+        start = min(self.wishlist)
+        stop = max(self.wishlist) + self.thumb_period
+        self.debug("Decoding %s to %s to get %d thumbs in one pass",
+                   format_ns(start), format_ns(stop), len(self.wishlist))
+        self.wishlist = []
+        self._linear_pass = True
+        self._refining = False
+        # The videorate element already outputs one frame per thumb_period,
+        # the sink only has to go as fast as the decoder allows.
+        self.gdkpixbufsink.props.sync = False
+        self.pipeline.seek(1.0,
+                           Gst.Format.TIME,
+                           Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                           Gst.SeekType.SET, start,
+                           Gst.SeekType.SET, stop)
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self._thumb_cb_id = GLib.timeout_add(
+            self.interval, self._throttleLinearPass)
+
+    def _throttleLinearPass(self):
+        """
+        Pause the linear pass while the CPU usage is above the budget.
+        """
+        if not self._linear_pass:
+            self._thumb_cb_id = None
+            return False
+        if self.cpuUsage() < THUMBNAILS_CPU_USAGE:
+            self.pipeline.set_state(Gst.State.PLAYING)
+        else:
+            self.log("Pausing the linear pass for %s",
+                     filename_from_uri(self.uri))
+            self.pipeline.set_state(Gst.State.PAUSED)
+        return True
+
+    def _addLinearPassThumbnail(self, time, pixbuf):
+        # Round to the nearest thumb_period multiple, in case the stream
+        # time is not nanosecond precise.
+        time = quantize(time + self.thumb_period // 2, self.thumb_period)
+        self._linear_pass_thumbs.append((time, pixbuf))
+        thumb = self.thumbs.get(time)
+        if thumb and thumb.has_pixel_data:
+            # Replace a keyframe shown in the meantime.
+            thumb.set_from_gdkpixbuf(pixbuf)
+        elif thumb:
+            thumb.set_from_gdkpixbuf_animated(pixbuf)
+        if len(self._linear_pass_thumbs) >= LINEAR_PASS_BATCH_SIZE:
+            self._flushLinearPassThumbnails()
+
+    def _flushLinearPassThumbnails(self):
+        self.thumb_cache.setItems(self._linear_pass_thumbs)
+        self._linear_pass_times.update(
+            time for time, unused_pixbuf in self._linear_pass_thumbs)
+        self._linear_pass_thumbs = []
+
+    def _finishLinearPass(self):
+        self._flushLinearPassThumbnails()
+        # All the thumbnails of the pass are saved in a single transaction.
+        self.thumb_cache.commit()
+        self.queue = [time for time in self.queue
+                      if time not in self._linear_pass_times]
+        self._linear_pass_times = set()
+        self._linear_pass = False
+        self.gdkpixbufsink.props.sync = True
+        self.pipeline.set_state(Gst.State.PAUSED)
+        self._checkCPU()
+
+    def _refineNextThumb(self):
+        """
+        Replace one of the visible keyframe thumbnails with the exact one.
+
+        @returns: Whether a refining seek has been started.
+        """
+        if not self.refine_thumbnails or not self._refine_wishlist:
+            return False
+        if self.cpuUsage() >= THUMBNAILS_REFINE_CPU_USAGE:
+            # Not idle, the refinement is requested again.
+            self.debug("Postponing the refinement of %d thumbs",
+                       len(self._refine_wishlist))
+            return False
+        time = self._refine_wishlist.pop(0)
+        self.log('Refining thumb for "%s"' % filename_from_uri(self.uri))
+        self._refining = True
+        self._seek(time, Gst.SeekFlags.ACCURATE)
+        return True
+
+    def _seek(self, time, flags):
+        self._seek_time = time
+        self._seek_flags = flags
+        self.pipeline.seek(1.0,
+                           Gst.Format.TIME, Gst.SeekFlags.FLUSH | flags,
+                           Gst.SeekType.SET, time,
+                           Gst.SeekType.NONE, -1)
+
     def _autosave(self):
         if self.wishlist:
             self.log("Periodic thumbnail autosave")
@@ -372,10 +781,17 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         old_thumbs = self.thumbs
         self.thumbs = {}
         self.wishlist = []
+        self._refine_wishlist = []
 
         thumb_duration = self._get_thumb_duration()
         element_left, element_right = self._get_visible_range()
         element_left = quantize(element_left, thumb_duration)
+        # Get all the cached thumbnails with a single query.
+        cached_thumbs = self.thumb_cache.getRange(
+            element_left, element_right, thumb_duration)
+        nb_slots = len(range(element_left, element_right, thumb_duration))
+        cache_manager.recordLookups("thumbs", hits=len(cached_thumbs),
+                                    misses=nb_slots - len(cached_thumbs))
 
         for current_time in range(element_left, element_right, thumb_duration):
             thumb = Thumbnail(self.thumb_width, self.thumb_height)
@@ -383,8 +799,13 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
                 Zoomable.nsToPixel(current_time), THUMB_MARGIN_PX)
             self.add_child(thumb)
             self.thumbs[current_time] = thumb
-            if current_time in self.thumb_cache:
-                gdkpixbuf = self.thumb_cache[current_time]
+            gdkpixbuf = cached_thumbs.get(current_time)
+            if gdkpixbuf is None and self.fast_seek:
+                gdkpixbuf = self._getKeyframeThumbnail(
+                    current_time, thumb_duration // 2)
+                if gdkpixbuf:
+                    self._refine_wishlist.append(current_time)
+            if gdkpixbuf:
                 if self._allAnimated or current_time not in old_thumbs:
                     self.thumbs[
                         current_time].set_from_gdkpixbuf_animated(gdkpixbuf)
@@ -394,6 +815,22 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
                 self.wishlist.append(current_time)
         self._allAnimated = False
 
+    def _getKeyframeThumbnail(self, time, tolerance):
+        """
+        Get the thumbnail of a keyframe which can be shown in place of the
+        thumbnail at the specified time, if any.
+        """
+        if time in self._snapped_times:
+            snapped_time = self._snapped_times[time]
+            if snapped_time in self.thumb_cache:
+                return self.thumb_cache[snapped_time]
+        nearest = self.thumb_cache.getNearest(time, tolerance)
+        if not nearest:
+            return None
+        snapped_time, gdkpixbuf = nearest
+        self._snapped_times[time] = snapped_time
+        return gdkpixbuf
+
     def _get_wish(self):
         """
         Returns a wish that is also in the queue, or None if no such wish exists
@@ -436,6 +873,35 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
             self.queue.remove(time)
         self.thumb_cache[time] = pixbuf
 
+    def _setKeyframeThumbnail(self, time, keyframe_time, pixbuf):
+        """
+        Show the keyframe found when fast seeking for the thumbnail at time.
+
+        The keyframe is cached at its own time, so it can stand in for the
+        other thumbnails around it.
+        """
+        self._snapped_times[time] = keyframe_time
+        self.thumb_cache[keyframe_time] = pixbuf
+        if time in self.queue:
+            self.queue.remove(time)
+        if keyframe_time != time and time not in self._refine_wishlist:
+            self._refine_wishlist.append(time)
+        thumb = self.thumbs.get(time)
+        if thumb:
+            thumb.set_from_gdkpixbuf_animated(pixbuf)
+
+    def _setRefinedThumbnail(self, time, pixbuf):
+        self._snapped_times.pop(time, None)
+        self.thumb_cache[time] = pixbuf
+        thumb = self.thumbs.get(time)
+        if thumb:
+            thumb.set_from_gdkpixbuf(pixbuf)
+
+    # Interface (PreviewGenerator)
+
+    def isVisible(self):
+        return is_element_visible(self.timeline, self.bElement)
+
     # Interface (Zoomable)
 
     def zoomChanged(self):
@@ -448,7 +914,8 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
         start = self.bElement.props.start
         in_point = self.bElement.props.in_point
         duration = self.bElement.props.duration
-        timeline_left, timeline_right = self._get_visible_timeline_range()
+        timeline_left, timeline_right = get_visible_timeline_range(
+            self.timeline)
 
         element_left = timeline_left - start + in_point
         element_left = max(element_left, in_point)
@@ -457,46 +924,6 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
 
         return (element_left, element_right)
 
-    # TODO: move to Timeline or to utils
-    def _get_visible_timeline_range(self):
-        # determine the visible left edge of the timeline
-        # TODO: isn't there some easier way to get the scroll point of the ScrollActor?
-        # timeline_left = -(self.timeline.get_transform().xw - self.timeline.props.x)
-        timeline_left = self.timeline.get_scroll_point().x
-
-        # determine the width of the pipeline
-        # by intersecting the timeline's and the stage's allocation
-        timeline_allocation = self.timeline.props.allocation
-        stage_allocation = self.timeline.get_stage().props.allocation
-
-        timeline_rect = Clutter.Rect()
-        timeline_rect.init(timeline_allocation.x1,
-                           timeline_allocation.y1,
-                           timeline_allocation.x2 - timeline_allocation.x1,
-                           timeline_allocation.y2 - timeline_allocation.y1)
-
-        stage_rect = Clutter.Rect()
-        stage_rect.init(stage_allocation.x1,
-                        stage_allocation.y1,
-                        stage_allocation.x2 - stage_allocation.x1,
-                        stage_allocation.y2 - stage_allocation.y1)
-
-        has_intersection, intersection = timeline_rect.intersection(stage_rect)
-
-        if not has_intersection:
-            return (0, 0)
-
-        timeline_width = intersection.size.width
-
-        # determine the visible right edge of the timeline
-        timeline_right = timeline_left + timeline_width
-
-        # convert to nanoseconds
-        time_left = Zoomable.pixelToNs(timeline_left)
-        time_right = Zoomable.pixelToNs(timeline_right)
-
-        return (time_left, time_right)
-
     # Callbacks
 
     def bus_message_handler(self, unused_bus, message):
@@ -504,12 +931,24 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
                 message.src == self.gdkpixbufsink:
             struct = message.get_structure()
             struct_name = struct.get_name()
-            if struct_name == "preroll-pixbuf":
+            if struct_name == "pixbuf" and self._linear_pass:
+                stream_time = struct.get_value("stream-time")
+                pixbuf = struct.get_value("pixbuf")
+                self._addLinearPassThumbnail(stream_time, pixbuf)
+            elif struct_name == "preroll-pixbuf" and not self._linear_pass:
                 stream_time = struct.get_value("stream-time")
                 pixbuf = struct.get_value("pixbuf")
-                self._setThumbnail(stream_time, pixbuf)
+                if self._refining:
+                    self._setRefinedThumbnail(self._seek_time, pixbuf)
+                elif self._seek_flags & Gst.SeekFlags.KEY_UNIT:
+                    self._setKeyframeThumbnail(
+                        self._seek_time, stream_time, pixbuf)
+                else:
+                    self._setThumbnail(stream_time, pixbuf)
+        elif message.type == Gst.MessageType.EOS and self._linear_pass:
+            self._finishLinearPass()
         elif message.type == Gst.MessageType.ASYNC_DONE and \
-                message.src == self.pipeline:
+                message.src == self.pipeline and not self._linear_pass:
             self._checkCPU()
         return Gst.BusSyncReply.PASS
 
@@ -546,6 +985,12 @@ class VideoPreviewer(Clutter.ScrollActor, PreviewGenerator, Zoomable, Loggable):
             GLib.source_remove(self._thumb_cb_id)
             self._thumb_cb_id = None
 
+        if self._linear_pass:
+            self._linear_pass = False
+            self._flushLinearPassThumbnails()
+            self._linear_pass_times = set()
+            self.thumb_cache.commit()
+
         if self.pipeline:
             self.pipeline.set_state(Gst.State.NULL)
             self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
@@ -589,6 +1034,60 @@ class Thumbnail(Clutter.Actor):
         self.restore_easing_state()
 
 
+class PixbufLRUCache(object):
+
+    """
+    Keeps the most recently used pixbufs in memory, up to a total size.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._pixbufs = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._pixbufs
+
+    def get(self, key):
+        pixbuf = self._pixbufs.get(key)
+        if pixbuf is not None:
+            self._pixbufs.move_to_end(key)
+        return pixbuf
+
+    def add(self, key, pixbuf):
+        self.remove(key)
+        self._pixbufs[key] = pixbuf
+        self.bytes += self._size(pixbuf)
+        while self.bytes > self.max_bytes and len(self._pixbufs) > 1:
+            unused_key, oldest = self._pixbufs.popitem(last=False)
+            self.bytes -= self._size(oldest)
+
+    def remove(self, key):
+        pixbuf = self._pixbufs.pop(key, None)
+        if pixbuf is not None:
+            self.bytes -= self._size(pixbuf)
+
+    @staticmethod
+    def _size(pixbuf):
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class SurfaceLRUCache(PixbufLRUCache):
+
+    """
+    Keeps the most recently used cairo image surfaces in memory, up to a
+    total size.
+    """
+
+    @staticmethod
+    def _size(surface):
+        return surface.get_stride() * surface.get_height()
+
+
+# The decoded thumbnails shared by all the ThumbnailCaches, so scrolling and
+# zooming back to recently seen thumbnails does not decode them again.
+decoded_thumbs = PixbufLRUCache(DECODED_THUMBS_MAX_BYTES)
+
 caches = {}
 
 
@@ -603,24 +1102,33 @@ def get_cache_for_uri(uri):
 
 class ThumbnailCache(Loggable):
 
-    """Caches thumbnails by key using LRU policy, implemented with heapq.
+    """Caches thumbnails by key using LRU policy.
 
-    Uses a two stage caching mechanism. A limited number of elements are
-    held in memory, the rest is being cached on disk using an sqlite db."""
+    Uses a two stage caching mechanism. A limited number of decoded elements
+    are held in memory, the rest is being cached on disk using an sqlite db."""
 
     def __init__(self, uri):
         Loggable.__init__(self)
         self._filehash = hash_file(Gst.uri_get_location(uri))
         self._filename = filename_from_uri(uri)
-        thumbs_cache_dir = get_dir(os.path.join(xdg_cache_home(), "thumbs"))
+        thumbs_cache_dir = cache_manager.getStoreDir("thumbs")
         dbfile = os.path.join(thumbs_cache_dir, self._filehash)
-        self._db = sqlite3.connect(dbfile)
+        cache_manager.touch(dbfile)
+        # Transactions are handled explicitly, see _begin() and commit().
+        self._db = sqlite3.connect(dbfile, isolation_level=None)
         self._cur = self._db.cursor()  # Use this for normal db operations
+        # Readers do not block the writer and the other way around, and the
+        # thumbnails can be generated again if the last commits are lost.
+        self._cur.execute("PRAGMA journal_mode = WAL")
+        self._cur.execute("PRAGMA synchronous = NORMAL")
+        self._cur.execute("PRAGMA temp_store = MEMORY")
         self._cur.execute("CREATE TABLE IF NOT EXISTS Thumbs\
                           (Time INTEGER NOT NULL PRIMARY KEY,\
                           Jpeg BLOB NOT NULL)")
 
     def __contains__(self, key):
+        if (self._filehash, key) in decoded_thumbs:
+            return True
         # check if item is present in on disk cache
         self._cur.execute("SELECT Time FROM Thumbs WHERE Time = ?", (key,))
         if self._cur.fetchone():
@@ -628,11 +1136,75 @@ class ThumbnailCache(Loggable):
         return False
 
     def __getitem__(self, key):
+        return self.getPixbuf(key)
+
+    def getRange(self, start, end, step):
+        """
+        Get the thumbnails in [start, end) at multiples of step from start,
+        with a single query.
+
+        @returns: A dict mapping the times to the full size pixbufs.
+        """
+        pixbufs = {}
+        self._cur.execute("SELECT Time FROM Thumbs"
+                          " WHERE Time >= ? AND Time < ? AND (Time - ?) % ? = 0",
+                          (start, end, start, step))
+        missing = []
+        for (key,) in self._cur.fetchall():
+            pixbuf = decoded_thumbs.get((self._filehash, key))
+            if pixbuf is None:
+                missing.append(key)
+            else:
+                pixbufs[key] = pixbuf
+        if missing:
+            # Only the JPEGs which are not decoded already are fetched.
+            self._cur.execute("SELECT Time, Jpeg FROM Thumbs"
+                              " WHERE Time >= ? AND Time <= ? AND (Time - ?) % ? = 0",
+                              (min(missing), max(missing), start, step))
+            wanted = set(missing)
+            for key, jpeg in self._cur.fetchall():
+                if key not in wanted:
+                    continue
+                pixbuf = self._loadJpeg(jpeg)
+                decoded_thumbs.add((self._filehash, key), pixbuf)
+                pixbufs[key] = pixbuf
+        return pixbufs
+
+    def getPixbuf(self, key):
+        """
+        Get a thumbnail, decoding it only if it is not in decoded_thumbs.
+
+        @raises KeyError: If there is no thumbnail for key.
+        """
+        decoded_key = (self._filehash, key)
+        pixbuf = decoded_thumbs.get(decoded_key)
+        if pixbuf is not None:
+            return pixbuf
+
         self._cur.execute("SELECT * FROM Thumbs WHERE Time = ?", (key,))
         row = self._cur.fetchone()
         if not row:
             raise KeyError(key)
-        jpeg = row[1]
+        pixbuf = self._loadJpeg(row[1])
+        decoded_thumbs.add(decoded_key, pixbuf)
+        return pixbuf
+
+    def getNearest(self, key, tolerance):
+        """
+        Get the thumbnail closest to key, at most tolerance away from it.
+
+        @returns: The (time, pixbuf) pair or None if there is no such
+        thumbnail.
+        """
+        self._cur.execute("SELECT Time FROM Thumbs WHERE Time BETWEEN ? AND ?"
+                          " ORDER BY ABS(Time - ?) LIMIT 1",
+                          (key - tolerance, key + tolerance, key))
+        row = self._cur.fetchone()
+        if not row:
+            return None
+        return row[0], self.getPixbuf(row[0])
+
+    def _loadJpeg(self, jpeg):
         loader = GdkPixbuf.PixbufLoader.new()
         # TODO: what do to if any of the following calls fails?
         loader.write(jpeg)
@@ -641,20 +1213,48 @@ class ThumbnailCache(Loggable):
         return pixbuf
 
     def __setitem__(self, key, value):
-        success, jpeg = value.save_to_bufferv(
+        self.setItems([(key, value)])
+
+    def setItems(self, items):
+        """
+        Store many thumbnails at once.
+
+        @param items: The (time, pixbuf) pairs to store.
+        """
+        rows = []
+        for key, value in items:
+            blob = self._compress(value)
+            if blob is not None:
+                rows.append((key, blob))
+        self._begin()
+        # Replace if a row with the same time already exists.
+        self._cur.executemany("INSERT OR REPLACE INTO Thumbs VALUES (?,?)",
+                              rows)
+        for key, value in items:
+            decoded_thumbs.add((self._filehash, key), value)
+
+    def _compress(self, pixbuf):
+        success, jpeg = pixbuf.save_to_bufferv(
             "jpeg", ["quality", None], ["90"])
         if not success:
             self.warning("JPEG compression failed")
-            return
-        blob = sqlite3.Binary(jpeg)
-        # Replace if a row with the same time already exists.
-        self._cur.execute("DELETE FROM Thumbs WHERE  time=?", (key,))
-        self._cur.execute("INSERT INTO Thumbs VALUES (?,?)", (key, blob,))
+            return None
+        return sqlite3.Binary(jpeg)
+
+    def _begin(self):
+        """
+        Make sure the next writes are part of the current transaction.
+
+        All the writes until the next commit() are batched in it.
+        """
+        if not self._db.in_transaction:
+            self._cur.execute("BEGIN")
 
     def commit(self):
         self.debug(
             'Saving thumbnail cache file to disk for: %s', self._filename)
-        self._db.commit()
+        if self._db.in_transaction:
+            self._cur.execute("COMMIT")
         self.log("Saved thumbnail cache file: %s" % self._filehash)
 
 
@@ -672,7 +1272,6 @@ class PipelineCpuAdapter(Loggable):
         self.pipeline = pipeline
         self.bus = self.pipeline.get_bus()
 
-        self.cpu_usage_tracker = CPUUsageTracker()
         self.rate = 1.0
         self.done = False
         self.ready = False
@@ -698,8 +1297,7 @@ class PipelineCpuAdapter(Loggable):
         if self.done:
             return False
 
-        usage_percent = self.cpu_usage_tracker.usage()
-        self.cpu_usage_tracker.reset()
+        usage_percent = PreviewGenerator.cpuUsage()
         if usage_percent >= WAVEFORMS_CPU_USAGE:
             if self.rate < 0.1:
                 if not self.ready:
@@ -756,6 +1354,302 @@ class PipelineCpuAdapter(Loggable):
                     self.ready = False
 
 
+def levels_to_peaks(levels):
+    """
+    Convert the RMS levels posted by the level element to peaks.
+
+    The levels which are not negative are not valid, and the previous peak
+    is used instead.
+
+    @param levels: The levels in dB, with a row for each channel.
+    @type levels: C{numpy.ndarray}
+    @returns: The peaks, in the [0, 100] range.
+    @rtype: C{numpy.ndarray}
+    """
+    valid = levels < 0
+    peaks = numpy.zeros(levels.shape, dtype=numpy.float32)
+    peaks[valid] = numpy.power(10, levels[valid] / 20) * 100
+    # The index of the last valid level at or before each position.
+    indices = numpy.where(valid, numpy.arange(levels.shape[1]), 0)
+    numpy.maximum.accumulate(indices, axis=1, out=indices)
+    return numpy.take_along_axis(peaks, indices, axis=1)
+
+
+class WaveformPeaksAccumulator(object):
+
+    """
+    Computes the peaks of raw audio, as the RMS of consecutive windows of
+    samples, in the [0, 100] range.
+
+    @ivar peaks: The peaks computed so far, with a row for each channel.
+    @type peaks: C{numpy.ndarray}
+    """
+
+    def __init__(self, nb_peaks, nb_channels, window):
+        """
+        @param nb_peaks: The number of peaks to compute per channel.
+        @param nb_channels: The number of channels of the audio.
+        @param window: The number of frames summarized by a peak.
+        """
+        self.peaks = numpy.zeros((nb_channels, nb_peaks), dtype=numpy.float32)
+        self.window = max(1, window)
+        self.position = 0
+        self._pending = numpy.empty((0, nb_channels), dtype=numpy.float32)
+
+    def addSamples(self, samples):
+        """
+        Add the next interleaved samples.
+
+        @type samples: C{numpy.ndarray} of float32
+        """
+        frames = samples.reshape(-1, self.peaks.shape[0])
+        if len(self._pending):
+            frames = numpy.concatenate((self._pending, frames))
+        nb_windows = len(frames) // self.window
+        self._addWindows(frames[:nb_windows * self.window], nb_windows)
+        # Keep a copy, the samples can be in a reused buffer.
+        self._pending = frames[nb_windows * self.window:].copy()
+
+    def finish(self):
+        """
+        Compute the peak of the remaining samples.
+
+        @returns: The peaks.
+        @rtype: C{numpy.ndarray}
+        """
+        if len(self._pending):
+            self._addWindows(self._pending, 1)
+            self._pending = self._pending[:0]
+        return self.peaks
+
+    def _addWindows(self, frames, nb_windows):
+        nb_windows = min(nb_windows, self.peaks.shape[1] - self.position)
+        if nb_windows <= 0:
+            return
+        # Only the last window passed by finish() can be partial.
+        frames = frames[:nb_windows * self.window]
+        windows = frames.reshape(nb_windows, -1, self.peaks.shape[0])
+        rms = numpy.sqrt(numpy.mean(numpy.square(windows), axis=1)) * 100
+        self.peaks[:, self.position:self.position + nb_windows] = rms.T
+        self.position += nb_windows
+
+
+class WaveformPeaks(object):
+
+    """
+    The peaks of the channels of an audio file, stored in a .wave file.
+
+    The file starts with a HEADER, followed by the peaks of each channel,
+    one channel after the other, by the average of the channels if there
+    are several, and by the levels of a pyramid of this average. Each
+    level of the pyramid summarizes
+    WAVEFORM_PYRAMID_FACTOR peaks of the previous level with their minimum,
+    maximum and RMS, stored one after the other.
+
+    The peaks are in the [0, 100] range, stored as float32 or, scaled to
+    the int16 range, as int16. The peaks are memory mapped, so they are
+    only read when they are drawn and the pages are shared by all the
+    previewers of the file.
+
+    @ivar channels: The peaks, with a row for each channel.
+    @type channels: C{numpy.ndarray}
+    @ivar mono: The average of the channels, as stored.
+    @type mono: C{numpy.ndarray}
+    @ivar nb_peaks: The number of peaks of each channel.
+    @ivar levels: The levels of the pyramid, each with a row for the
+    minimums, the maximums and the RMS.
+    @type levels: C{list} of C{numpy.ndarray}
+    @ivar interval: The duration summarized by a peak, in nanoseconds.
+    """
+
+    MAGIC = b"PTVWAVE\0"
+    VERSION = 3
+    # Magic, version, sample format, number of channels, number of levels
+    # of the pyramid, interval and number of peaks per channel.
+    HEADER = struct.Struct("<8sHHHHQQ")
+    SAMPLE_FORMATS = {0: numpy.dtype(numpy.float32),
+                      1: numpy.dtype(numpy.int16)}
+    INT16_SCALE = 32767 / 100
+
+    def __init__(self, channels, mono, levels, interval):
+        self.channels = channels
+        self.mono = mono
+        self.levels = levels
+        self.interval = interval
+        self.nb_peaks = channels.shape[1]
+
+    def getEnvelope(self, start, end, max_peaks):
+        """
+        Get the envelope of the average of the channels between two peaks,
+        from the most detailed level of the pyramid which has at most
+        max_peaks peaks in this range.
+
+        @param start: The index of the first peak of the range.
+        @param end: The index of the peak after the range.
+        @param max_peaks: The maximum number of peaks to return.
+        @returns: The minimums, maximums and RMS, as float32 peaks in the
+        [0, 100] range.
+        @rtype: C{tuple} of three C{numpy.ndarray}
+        """
+        start = max(0, start)
+        end = min(self.nb_peaks, end)
+        max_peaks = max(1, max_peaks)
+        level = 0
+        while level < len(self.levels) and end - start > max_peaks:
+            level += 1
+            # Round outwards so the whole range is covered.
+            start //= WAVEFORM_PYRAMID_FACTOR
+            end = -(-end // WAVEFORM_PYRAMID_FACTOR)
+        if level == 0:
+            peaks = self._toFloat(self.mono[start:end])
+            return peaks, peaks, peaks
+        mins, maxs, rms = self.levels[level - 1][:, start:end]
+        return self._toFloat(mins), self._toFloat(maxs), self._toFloat(rms)
+
+    def _toFloat(self, peaks):
+        if self.channels.dtype == numpy.int16:
+            return peaks.astype(numpy.float32) / self.INT16_SCALE
+        return peaks
+
+    @staticmethod
+    def _levelSizes(nb_peaks, nb_levels):
+        sizes = []
+        for unused_level in range(nb_levels):
+            nb_peaks = -(-nb_peaks // WAVEFORM_PYRAMID_FACTOR)
+            sizes.append(nb_peaks)
+        return sizes
+
+    @staticmethod
+    def _buildPyramid(mono):
+        """
+        Compute the levels of the pyramid of the specified peaks.
+        """
+        levels = []
+        mins = maxs = rms = mono
+        while len(mins) > WAVEFORM_PYRAMID_MIN_PEAKS:
+            indices = numpy.arange(0, len(mins), WAVEFORM_PYRAMID_FACTOR)
+            counts = numpy.diff(numpy.append(indices, len(mins)))
+            mins = numpy.minimum.reduceat(mins, indices)
+            maxs = numpy.maximum.reduceat(maxs, indices)
+            rms = numpy.sqrt(
+                numpy.add.reduceat(numpy.square(rms), indices) / counts)
+            levels.append(numpy.array((mins, maxs, rms), dtype=numpy.float32))
+        return levels
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map the peaks stored in a .wave file.
+
+        @returns: The peaks or None if the file is not a valid .wave file,
+        for example if it has been created by a previous version.
+        @rtype: L{WaveformPeaks}
+        """
+        try:
+            with open(path, "rb") as f:
+                header = f.read(cls.HEADER.size)
+                size = os.fstat(f.fileno()).st_size
+        except OSError:
+            return None
+        if len(header) < cls.HEADER.size:
+            return None
+        magic, version, sample_format, nb_channels, nb_levels, interval, \
+            nb_peaks = cls.HEADER.unpack(header)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            return None
+        dtype = cls.SAMPLE_FORMATS.get(sample_format)
+        if dtype is None or not nb_channels or not nb_peaks:
+            return None
+        level_sizes = cls._levelSizes(nb_peaks, nb_levels)
+        nb_rows = nb_channels + 1 if nb_channels > 1 else 1
+        expected_size = cls.HEADER.size + dtype.itemsize * (
+            nb_rows * nb_peaks + 3 * sum(level_sizes))
+        if size != expected_size:
+            return None
+
+        offset = cls.HEADER.size
+        channels = numpy.memmap(path, dtype=dtype, mode="r", offset=offset,
+                                shape=(nb_channels, nb_peaks))
+        offset += channels.nbytes
+        if nb_channels > 1:
+            mono = numpy.memmap(path, dtype=dtype, mode="r", offset=offset,
+                                shape=(nb_peaks,))
+            offset += mono.nbytes
+        else:
+            mono = channels[0]
+        levels = []
+        for level_size in level_sizes:
+            level = numpy.memmap(path, dtype=dtype, mode="r", offset=offset,
+                                 shape=(3, level_size))
+            offset += level.nbytes
+            levels.append(level)
+        return cls(channels, mono, levels, interval)
+
+    @classmethod
+    def save(cls, path, channels, interval, dtype=numpy.float32):
+        """
+        Store peaks and their pyramid in a .wave file.
+
+        The file is written under a temporary name and renamed, so it is
+        never seen incomplete.
+
+        @param channels: The peaks in the [0, 100] range, with a row for
+        each channel.
+        @type channels: C{numpy.ndarray}
+        @param interval: The duration summarized by a peak, in nanoseconds.
+        @param dtype: The type of the stored peaks, float32 or int16.
+        """
+        dtype = numpy.dtype(dtype)
+        for sample_format, format_dtype in cls.SAMPLE_FORMATS.items():
+            if format_dtype == dtype:
+                break
+        else:
+            raise ValueError("Unsupported sample format: %s" % dtype)
+        channels = numpy.asarray(channels, dtype=numpy.float32)
+        mono = channels.mean(axis=0, dtype=numpy.float32)
+        levels = cls._buildPyramid(mono)
+
+        nb_channels, nb_peaks = channels.shape
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, sample_format,
+                                    nb_channels, len(levels), interval,
+                                    nb_peaks))
+            rows = [channels]
+            if len(channels) > 1:
+                # Stored so drawing does not have to read all the channels.
+                rows.append(mono)
+            for peaks in rows + levels:
+                if dtype == numpy.int16:
+                    peaks = numpy.clip(peaks * cls.INT16_SCALE, 0, 32767)
+                f.write(numpy.ascontiguousarray(
+                    peaks, dtype=dtype.newbyteorder("<")).tobytes())
+        os.replace(tmp_path, path)
+
+
+# The peaks of the audio files, shared by all their previewers.
+waveform_peaks = weakref.WeakValueDictionary()
+
+
+def get_waveform_peaks(path):
+    """
+    Get the peaks stored in a .wave file, loading them only once.
+
+    @rtype: L{WaveformPeaks}
+    """
+    peaks = waveform_peaks.get(path)
+    if peaks is None:
+        peaks = WaveformPeaks.load(path)
+        if peaks is not None:
+            waveform_peaks[path] = peaks
+    return peaks
+
+
+# The tiles of the waveforms, by .wave file, zoom ratio and tile index, shared
+# by all the AudioPreviewers.
+waveform_tiles = SurfaceLRUCache(WAVEFORM_TILES_MAX_BYTES)
+
+
 class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
 
     """
@@ -772,6 +1666,7 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
 
         self.pipeline = None
         self.discovered = False
+        self.waveform = None
         self.bElement = bElement
         # Guard against malformed URIs
         self._uri = quote_uri(bElement.props.uri)
@@ -783,13 +1678,19 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         self.canvas = Clutter.Canvas()
         self.set_content(self.canvas)
         self.width = 0
+        # The position of the drawn part of the clip, in the clip.
+        self.left = 0
         self._num_failures = 0
         self.lastUpdate = None
 
         self.current_geometry = (-1, -1)
 
         self.adapter = None
-        self.surface = None
+        self._unsynced = timeline._settings.previewersUnsyncedWaveforms
+        self._accumulator = None
+        self._levels = None
+        self._throttle_id = None
+        self.wavefile = None
         self.timeline.connect("scrolled", self._scrolledCb)
         self.canvas.connect("draw", self._drawContentCb)
         self.canvas.invalidate()
@@ -804,32 +1705,46 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
     def _startLevelsDiscovery(self):
         self.log('Preparing waveforms for "%s"' % filename_from_uri(self._uri))
         filename = hash_file(Gst.uri_get_location(self._uri)) + ".wave"
-        cache_dir = get_dir(os.path.join(xdg_cache_home(), "waves"))
+        cache_dir = cache_manager.getStoreDir("waves")
         filename = os.path.join(cache_dir, filename)
+        self.wavefile = filename
 
-        if os.path.exists(filename):
-            self.samples = pickle.load(open(filename, "rb"))
+        self.waveform = get_waveform_peaks(filename)
+        if self.waveform:
+            cache_manager.touch(filename)
+            cache_manager.recordLookups("waves", hits=1)
             self._startRendering()
         else:
-            self.wavefile = filename
+            cache_manager.recordLookups("waves", misses=1)
             self._launchPipeline()
 
     def _launchPipeline(self):
         self.debug(
             'Now generating waveforms for: %s', filename_from_uri(self._uri))
         self.peaks = None
-        self.pipeline = Gst.parse_launch("uridecodebin name=decode uri=" + self._uri +
-                                         " ! audioconvert ! level name=wavelevel interval=10000000 post-messages=true ! fakesink qos=false name=faked")
-        faked = self.pipeline.get_by_name("faked")
-        faked.props.sync = True
-        self._wavelevel = self.pipeline.get_by_name("wavelevel")
+        self._accumulator = None
+        self._levels = None
+        if self._unsynced:
+            # Decode as fast as the CPU budget allows and compute the peaks
+            # from the raw samples.
+            self.pipeline = Gst.parse_launch("uridecodebin name=decode uri=" + self._uri +
+                                             " ! audioconvert ! audio/x-raw,format=F32LE,layout=interleaved ! appsink name=sink sync=false emit-signals=true")
+            sink = self.pipeline.get_by_name("sink")
+            sink.connect("new-sample", self._newSampleCb)
+            self._wavelevel = None
+        else:
+            self.pipeline = Gst.parse_launch("uridecodebin name=decode uri=" + self._uri +
+                                             " ! audioconvert ! level name=wavelevel interval=%d post-messages=true ! fakesink qos=false name=faked" % WAVEFORM_SAMPLE_INTERVAL)
+            faked = self.pipeline.get_by_name("faked")
+            faked.props.sync = True
+            self._wavelevel = self.pipeline.get_by_name("wavelevel")
         decode = self.pipeline.get_by_name("decode")
         decode.connect("autoplug-select", self._autoplugSelectCb)
         bus = self.pipeline.get_bus()
         bus.add_signal_watch()
 
         self.nSamples = self.bElement.get_parent(
-        ).get_asset().get_duration() / 10000000
+        ).get_asset().get_duration() / WAVEFORM_SAMPLE_INTERVAL
         bus.connect("message", self._busMessageCb)
         self.becomeControlled()
 
@@ -837,6 +1752,9 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         if self.discovered:
             self._maybeUpdate()
 
+    def isVisible(self):
+        return is_element_visible(self.timeline, self.bElement)
+
     def zoomChanged(self):
         self._maybeUpdate()
 
@@ -875,21 +1793,7 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         if self.width < 0:
             return
 
-        # We need to take duration and inpoint into account.
-        asset_duration = self.bElement.get_parent().get_asset().get_duration()
-        if self.bElement.props.duration:
-            nbSamples = self.nbSamples / \
-                (float(asset_duration) / float(self.bElement.props.duration))
-        else:
-            nbSamples = self.nbSamples
-        if self.bElement.props.in_point:
-            startOffsetSamples = self.nbSamples / \
-                (float(asset_duration) / float(self.bElement.props.in_point))
-        else:
-            startOffsetSamples = 0
-
-        self.start = int(start / width_px * nbSamples + startOffsetSamples)
-        self.end = int(end / width_px * nbSamples + startOffsetSamples)
+        self.left = start
 
         self.canvas.set_size(self.width, EXPANDED_SIZE)
         Clutter.Actor.set_size(self, self.width, EXPANDED_SIZE)
@@ -897,22 +1801,12 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         self.canvas.invalidate()
 
     def _prepareSamples(self):
-        # Let's go mono.
-        if len(self.peaks) > 1:
-            samples = (
-                numpy.array(self.peaks[0]) + numpy.array(self.peaks[1])) / 2
-        else:
-            samples = numpy.array(self.peaks[0])
-
-        self.samples = samples.tolist()
-        f = open(self.wavefile, 'wb')
-        pickle.dump(self.samples, f)
+        WaveformPeaks.save(self.wavefile, self.peaks, WAVEFORM_SAMPLE_INTERVAL)
+        cache_manager.touch(self.wavefile)
+        self.waveform = get_waveform_peaks(self.wavefile)
 
     def _startRendering(self):
-        self.nbSamples = len(self.samples)
         self.discovered = True
-        self.start = 0
-        self.end = self.nbSamples
         self._compute_geometry()
         if self.adapter:
             self.adapter.stop()
@@ -927,24 +1821,24 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
             if p:
                 st = s.get_value("stream-time")
 
-                if self.peaks is None:
-                    self.peaks = []
-                    for channel in p:
-                        self.peaks.append([0] * int(self.nSamples))
+                if self._levels is None:
+                    # Missing levels mean silence.
+                    self._levels = numpy.full((len(p), int(self.nSamples)),
+                                              -numpy.inf, dtype=numpy.float32)
 
-                pos = int(st / 10000000)
-                if pos >= len(self.peaks[0]):
+                pos = int(st / WAVEFORM_SAMPLE_INTERVAL)
+                if pos >= self._levels.shape[1]:
                     return
 
-                for i, val in enumerate(p):
-                    if val < 0:
-                        val = 10 ** (val / 20) * 100
-                        self.peaks[i][pos] = val
-                    else:
-                        self.peaks[i][pos] = self.peaks[i][pos - 1]
+                # Converted all at once when done.
+                self._levels[:, pos] = p
             return
 
         if message.type == Gst.MessageType.EOS:
+            if self._accumulator:
+                self.peaks = self._accumulator.finish()
+            elif self._levels is not None:
+                self.peaks = levels_to_peaks(self._levels)
             self._prepareSamples()
             self._startRendering()
             self.stopGeneration()
@@ -981,11 +1875,43 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
                                        -1)
 
                 # In case we failed previously, we won't modulate next time
-                elif not self.adapter and prev == Gst.State.PAUSED and \
+                elif not self.adapter and not self._unsynced and \
+                        prev == Gst.State.PAUSED and \
                         new == Gst.State.PLAYING and self._num_failures == 0:
                     self.adapter = PipelineCpuAdapter(self.pipeline)
                     self.adapter.start()
 
+    def _newSampleCb(self, sink):
+        """
+        Compute the peaks of the decoded samples. Called in a streaming thread.
+        """
+        sample = sink.emit("pull-sample")
+        if self._accumulator is None:
+            structure = sample.get_caps().get_structure(0)
+            window = structure.get_value("rate") * WAVEFORM_SAMPLE_INTERVAL // Gst.SECOND
+            self._accumulator = WaveformPeaksAccumulator(
+                int(self.nSamples), structure.get_value("channels"), window)
+        buf = sample.get_buffer()
+        samples = numpy.frombuffer(buf.extract_dup(0, buf.get_size()),
+                                   dtype="<f4")
+        self._accumulator.addSamples(samples)
+        return Gst.FlowReturn.OK
+
+    def _throttle(self):
+        """
+        Pause the unsynced pipeline while the CPU usage is above the budget.
+        """
+        if not self.pipeline:
+            self._throttle_id = None
+            return False
+        if self.cpuUsage() < WAVEFORMS_CPU_USAGE:
+            self.pipeline.set_state(Gst.State.PLAYING)
+        else:
+            self.log("Pausing the waveforms generation for %s",
+                     filename_from_uri(self._uri))
+            self.pipeline.set_state(Gst.State.PAUSED)
+        return True
+
     def _autoplugSelectCb(self, unused_decode, unused_pad, unused_caps, factory):
         # Don't plug video decoders / parsers.
         if "Video" in factory.get_klass():
@@ -998,15 +1924,48 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         if not self.discovered:
             return
 
-        if self.surface:
-            self.surface.finish()
-
-        self.surface = renderer.fill_surface(
-            self.samples[self.start:self.end], int(self.width), int(EXPANDED_SIZE))
-
+        # The position of the drawn part of the clip, in the asset.
+        left = self.nsToPixel(self.bElement.props.in_point) + int(self.left)
+        right = left + int(self.width)
+        first_tile = left // WAVEFORM_TILE_WIDTH
+        last_tile = (right - 1) // WAVEFORM_TILE_WIDTH
         context.set_operator(cairo.OPERATOR_OVER)
-        context.set_source_surface(self.surface, 0, 0)
-        context.paint()
+        for tile_index in range(first_tile, last_tile + 1):
+            tile = self._getTile(tile_index)
+            if tile is None:
+                break
+            context.set_source_surface(
+                tile, tile_index * WAVEFORM_TILE_WIDTH - left, 0)
+            context.paint()
+
+    def _getTile(self, tile_index):
+        """
+        Get the tile of the waveform at the current zoom ratio, drawing it
+        if it's not in the cache.
+
+        @returns: The tile or None if it's past the end of the waveform.
+        @rtype: C{cairo.ImageSurface}
+        """
+        key = (self.wavefile, Zoomable.zoomratio, tile_index)
+        tile = waveform_tiles.get(key)
+        if tile is not None:
+            return tile
+
+        waveform_width = self.nsToPixel(
+            self.waveform.nb_peaks * self.waveform.interval)
+        tile_left = tile_index * WAVEFORM_TILE_WIDTH
+        tile_width = min(WAVEFORM_TILE_WIDTH, waveform_width - tile_left)
+        if tile_width <= 0:
+            return None
+        start = self.pixelToNs(tile_left) // self.waveform.interval
+        end = self.pixelToNs(tile_left + tile_width) // self.waveform.interval
+        # Read at most two peaks per pixel, whatever the zoom level.
+        mins, maxs, rms = self.waveform.getEnvelope(start, end, 2 * tile_width)
+        tile = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, tile_width, int(EXPANDED_SIZE))
+        renderer.draw_envelope(tile, mins, maxs, rms)
+        waveform_tiles.add(key, tile)
+        return tile
 
     def _scrolledCb(self, unused):
         self._maybeUpdate()
@@ -1015,12 +1974,18 @@ class AudioPreviewer(Clutter.Actor, PreviewGenerator, Zoomable, Loggable):
         self.pipeline.set_state(Gst.State.PLAYING)
         if self.adapter is not None:
             self.adapter.start()
+        if self._unsynced and self._throttle_id is None:
+            self._throttle_id = GLib.timeout_add(200, self._throttle)
 
     def stopGeneration(self):
         if self.adapter is not None:
             self.adapter.stop()
             self.adapter = None
 
+        if self._throttle_id is not None:
+            GLib.source_remove(self._throttle_id)
+            self._throttle_id = None
+
         if self.pipeline:
             self.pipeline.set_state(Gst.State.NULL)
             self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
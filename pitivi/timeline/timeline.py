@@ -33,14 +33,16 @@ from gi.repository import Gst
 from gi.repository import Gtk
 from gi.repository import GtkClutter
 
-from pitivi.autoaligner import AlignmentProgressDialog, AutoAligner
+from pitivi.autoaligner import ALIGNMENT_MIN_CONFIDENCE, AlignmentProgressDialog, AutoAligner
 from pitivi.configure import get_ui_dir
 from pitivi.dialogs.prefs import PreferencesDialog
 from pitivi.settings import GlobalSettings
 from pitivi.timeline.controls import ControlContainer
 from pitivi.timeline.elements import URISourceElement, TransitionElement, Ghostclip
+from pitivi.timeline.previewers import PreviewGenerator
 from pitivi.timeline.ruler import ScaleRuler
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import filename_from_uri
 from pitivi.utils.pipeline import PipelineError
 from pitivi.utils.timeline import Zoomable, Selection, SELECT, TimelineError
 from pitivi.utils.ui import alter_style_class, EFFECT_TARGET_ENTRY, EXPANDED_SIZE, SPACING, PLAYHEAD_COLOR, PLAYHEAD_WIDTH, CONTROL_WIDTH
@@ -73,6 +75,38 @@ PreferencesDialog.addNumericPreference('imageClipLength',
                                            "Default clip length (in miliseconds) of images when inserting on the timeline."),
                                        lower=1)
 
+GlobalSettings.addConfigOption('alignMaxOffset',
+                               section="user-interface",
+                               key="align-max-offset",
+                               default=0,
+                               notify=True)
+
+PreferencesDialog.addNumericPreference('alignMaxOffset',
+                                       section=_("Behavior"),
+                                       label=_("Maximum alignment offset"),
+                                       description=_("Maximum offset (in seconds) expected between the clips aligned "
+                                                     "based on their soundtracks, or 0 if unknown. Makes the "
+                                                     "alignment faster."),
+                                       lower=0)
+
+GlobalSettings.addConfigOption('alignMethod',
+                               section="user-interface",
+                               key="align-method",
+                               default="rigid",
+                               notify=True)
+
+PreferencesDialog.addChoicePreference('alignMethod',
+                                      section=_("Behavior"),
+                                      label=_("Alignment method"),
+                                      description=_("How the clips are aligned based on their soundtracks. "
+                                                    "Coarse to fine is faster on long clips and reports "
+                                                    "the clips which are probably misaligned. Drift "
+                                                    "estimation reports how fast the clock of each "
+                                                    "device runs relative to the reference clip."),
+                                      choices=((_("Exhaustive"), "rigid"),
+                                               (_("Coarse to fine"), "coarse-to-fine"),
+                                               (_("Estimate the clock drift"), "drift")))
+
 # Colors
 TIMELINE_BACKGROUND_COLOR = Clutter.Color.new(31, 30, 33, 255)
 SELECTION_MARQUEE_COLOR = Clutter.Color.new(100, 100, 100, 200)
@@ -695,6 +729,10 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
         self._settings.connect("edgeSnapDeadbandChanged",
                                self._snapDistanceChangedCb)
 
+        PreviewGenerator.setMaxWorkers(self._settings.previewersMaxWorkers)
+        self._settings.connect("previewersMaxWorkersChanged",
+                               self._previewersMaxWorkersChangedCb)
+
         self.show_all()
 
     # Public API
@@ -1236,8 +1274,16 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
             self.app.action_log.commit()
             self._project.pipeline.commit_timeline()
             progress_dialog.window.destroy()
-
-        auto_aligner = AutoAligner(self.timeline.selection, alignedCb)
+            self._reportAlignment(auto_aligner)
+
+        max_offset = None
+        if self._settings.alignMaxOffset:
+            max_offset = self._settings.alignMaxOffset * Gst.SECOND
+        method = self._settings.alignMethod
+        auto_aligner = AutoAligner(self.timeline.selection, alignedCb,
+                                   max_offset=max_offset,
+                                   coarse_to_fine=method == "coarse-to-fine",
+                                   estimate_drift=method == "drift")
         try:
             progress_meter = auto_aligner.start()
             progress_meter.addWatcher(progress_dialog.updatePosition)
@@ -1245,6 +1291,46 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
             self.error("Could not start the autoaligner: %s" % e)
             progress_dialog.window.destroy()
 
+    def _reportAlignment(self, auto_aligner):
+        """
+        Warn the user about the clips which are probably misaligned, or
+        show the clock drift of the clips if it has been estimated.
+
+        @param auto_aligner: The aligner which completed.
+        @type auto_aligner: L{AutoAligner}
+        """
+        lines = []
+        for clip, confidence in auto_aligner.confidences.items():
+            if confidence >= ALIGNMENT_MIN_CONFIDENCE:
+                continue
+            filename = filename_from_uri(clip.get_asset().get_id())
+            self.warning("%s aligned with a low confidence of %.2f",
+                         filename, confidence)
+            lines.append(_("%s (confidence: %.2f)") % (filename, confidence))
+        if lines:
+            self._showAlignmentReport(Gtk.MessageType.WARNING,
+                                      _("Some clips are probably misaligned"),
+                                      lines)
+
+        lines = []
+        for clip, drift in auto_aligner.drifts.items():
+            filename = filename_from_uri(clip.get_asset().get_id())
+            lines.append(_("%s: %+.0f ppm") % (filename, drift * 1e6))
+        if lines:
+            self._showAlignmentReport(Gtk.MessageType.INFO,
+                                      _("Clock drift relative to the reference clip"),
+                                      lines)
+
+    def _showAlignmentReport(self, message_type, text, lines):
+        dialog = Gtk.MessageDialog(transient_for=self.app.gui,
+                                   modal=True,
+                                   message_type=message_type,
+                                   buttons=Gtk.ButtonsType.OK,
+                                   text=text)
+        dialog.set_property("secondary-text", "\n".join(lines))
+        dialog.run()
+        dialog.destroy()
+
     def _splitCb(self, unused_action):
         """
         If clips are selected, split them at the current playhead position.
@@ -1392,6 +1478,9 @@ class TimelineContainer(Gtk.Grid, Zoomable, Loggable):
             self.bTimeline.set_snapping_distance(
                 Zoomable.pixelToNs(self._settings.edgeSnapDeadband))
 
+    def _previewersMaxWorkersChangedCb(self, unused_settings):
+        PreviewGenerator.setMaxWorkers(self._settings.previewersMaxWorkers)
+
     def _projectChangedCb(self, unused_app, project, unused_fully_loaded):
         """
         When a project is loaded, we connect to its pipeline
@@ -33,6 +33,7 @@ from gettext import gettext as _
 
 from pitivi.configure import get_pixmap_dir
 from pitivi.utils.loggable import Loggable
+from pitivi.utils.search import SearchIndex, SEARCH_DELAY
 from pitivi.utils.ui import SPACING
 
 
@@ -56,6 +57,9 @@ class TransitionsListWidget(Gtk.VBox, Loggable):
 
         self.app = app
         self.element = None
+        # The searchable texts of the transitions, keyed by asset id.
+        self._search_index = SearchIndex()
+        self._search_timeout_id = 0
         self._pixdir = os.path.join(get_pixmap_dir(), "transitions")
         icon_theme = Gtk.IconTheme.get_default()
         self._question_icon = icon_theme.load_icon("dialog-question", 48, 0)
@@ -215,7 +219,17 @@ class TransitionsListWidget(Gtk.VBox, Loggable):
                 25000, Gtk.PositionType.BOTTOM, _("Smooth"))
 
     def _searchEntryChangedCb(self, unused_entry):
+        if self._search_timeout_id:
+            GLib.source_remove(self._search_timeout_id)
+        # Wait for the user to stop typing.
+        self._search_timeout_id = GLib.timeout_add(
+            SEARCH_DELAY, self._searchTimeoutCb)
+
+    def _searchTimeoutCb(self):
+        self._search_timeout_id = 0
+        self._search_index.search(self.searchEntry.get_text())
         self.modelFilter.refilter()
+        return False
 
     def _searchEntryIconClickedCb(self, entry, unused, unused_1):
         entry.set_text("")
@@ -266,10 +280,12 @@ class TransitionsListWidget(Gtk.VBox, Loggable):
         """
         for trans_asset in GES.list_assets(GES.BaseTransitionClip):
             trans_asset.icon = self._getIcon(trans_asset.get_id())
+            name = str(trans_asset.get_id())
+            description = str(trans_asset.get_meta(GES.META_DESCRIPTION))
+            self._search_index.add(name, name, description)
             self.storemodel.append([trans_asset,
-                                    str(trans_asset.get_id()),
-                                    str(trans_asset.get_meta(
-                                        GES.META_DESCRIPTION)),
+                                    name,
+                                    description,
                                     trans_asset.icon])
 
         # Now that the UI is fully ready, enable searching
@@ -378,6 +394,4 @@ class TransitionsListWidget(Gtk.VBox, Loggable):
         """
         Filters the icon view depending on the search results
         """
-        text = self.searchEntry.get_text().lower()
-        return text in model.get_value(iter, COL_DESC_TEXT).lower() or\
-            text in model.get_value(iter, COL_NAME_TEXT).lower()
+        return self._search_index.matches(model.get_value(iter, COL_NAME_TEXT))
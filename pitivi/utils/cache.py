@@ -0,0 +1,346 @@
+# Pitivi video editor
+#
+#       pitivi/utils/cache.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Size accounting and eviction for the stores in the Pitivi cache directory.
+
+Each store is a subdirectory of xdg_cache_home(), for example "thumbs" or
+"waves". Each file of a store is an entry, except for the journal files of
+sqlite databases, which are part of the entry of their database. The last
+access time of an entry is the mtime of its files, which is updated by
+CacheManager.touch() when an entry is used.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from gi.repository import GLib
+
+from pitivi.settings import GlobalSettings, get_dir, xdg_cache_home
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.threads import Thread
+
+
+GlobalSettings.addConfigSection("cache")
+GlobalSettings.addConfigOption("cacheMaxBytes",
+                               section="cache",
+                               key="max-bytes",
+                               environment="PITIVI_CACHE_MAX_BYTES",
+                               default=2 * 1024 ** 3,
+                               notify=True)
+# Statistics about the cache, not saved in the configuration file.
+GlobalSettings.addConfigOption("cacheBytes", default=0, notify=True)
+GlobalSettings.addConfigOption("cacheEntries", default=0, notify=True)
+GlobalSettings.addConfigOption("cacheHitRate", default=0.0, notify=True)
+
+# The suffixes of the files which belong to the entry of another file.
+AUXILIARY_SUFFIXES = ("-wal", "-shm", "-journal")
+# How often the budget is enforced while the stores are being written to,
+# in seconds.
+CACHE_EVICTION_INTERVAL = 5 * 60
+# How often the stats are published to the settings, at most, in
+# milliseconds.
+CACHE_STATS_PUBLISH_INTERVAL = 1000
+# The number of recently used entries protected from the eviction.
+CACHE_USED_MAX_ENTRIES = 4096
+
+
+class CacheStats(object):
+
+    """
+    Statistics about a cache store.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.entries = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return self.hits / lookups
+
+
+class CacheEntry(object):
+
+    """
+    The files making up an entry of a cache store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = []
+        self.size = 0
+        self.last_access = 0
+
+    def addFile(self, path, stat):
+        self.files.append(path)
+        self.size += stat.st_size
+        self.last_access = max(self.last_access, stat.st_mtime)
+
+
+class CacheManager(Loggable):
+
+    """
+    Tracks the size of the cache stores and evicts the least recently used
+    entries when they use more than the settings.cacheMaxBytes budget.
+
+    @ivar settings: The settings the budget is read from and the stats are
+    published to. Set by the application at startup.
+    @type settings: L{GlobalSettings}
+    @ivar threads: The master of the eviction threads.
+    @type threads: L{pitivi.utils.threads.ThreadMaster}
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self.settings = None
+        self.threads = None
+        self._stores = {}
+        # The entries recently used by this process, which must not be
+        # evicted, least recently used first.
+        self._used = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._evicting = False
+        self._publish_stats_id = 0
+
+    def start(self, settings, threads):
+        """
+        Start enforcing the budget set in the specified settings.
+        """
+        self.settings = settings
+        self.threads = threads
+        settings.connect("cacheMaxBytesChanged", self._maxBytesChangedCb)
+        self._startEviction()
+        GLib.timeout_add_seconds(CACHE_EVICTION_INTERVAL,
+                                 self._evictionTimeoutCb)
+
+    def addStore(self, store):
+        """
+        Register a store, so its entries are accounted for and evicted
+        even before it is used in this session.
+
+        @param store: The name of the store, for example "thumbs".
+        @type store: C{str}
+        """
+        with self._lock:
+            if store not in self._stores:
+                self._stores[store] = CacheStats()
+
+    def getStoreDir(self, store):
+        """
+        Get the directory of a store, creating it if needed.
+
+        @param store: The name of the store, for example "thumbs".
+        @type store: C{str}
+        """
+        self.addStore(store)
+        return get_dir(os.path.join(xdg_cache_home(), store))
+
+    def touch(self, path):
+        """
+        Mark the entry at path as just used, so it is evicted last.
+        """
+        with self._lock:
+            self._used[path] = True
+            self._used.move_to_end(path)
+            if len(self._used) > CACHE_USED_MAX_ENTRIES:
+                self._used.popitem(last=False)
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            self.debug("Cannot update the access time of %s: %s", path, e)
+
+    def recordLookups(self, store, hits=0, misses=0):
+        """
+        Account for lookups in a store, for computing its hit rate.
+        """
+        with self._lock:
+            stats = self._stores[store]
+            stats.hits += hits
+            stats.misses += misses
+        self._publishStats()
+
+    def stats(self, store=None):
+        """
+        Get the stats of a store or, if no store is specified, the total.
+
+        @rtype: L{CacheStats}
+        """
+        with self._lock:
+            if store is not None:
+                return self._stores[store]
+            total = CacheStats()
+            for stats in self._stores.values():
+                total.hits += stats.hits
+                total.misses += stats.misses
+                total.bytes += stats.bytes
+                total.entries += stats.entries
+            return total
+
+    def scan(self):
+        """
+        List the entries of all the stores and update their stats.
+
+        Can be called from any thread.
+
+        @returns: The entries, least recently used first.
+        @rtype: C{list} of L{CacheEntry}
+        """
+        all_entries = []
+        with self._lock:
+            stores = list(self._stores.keys())
+        for store in stores:
+            entries = self._scanStore(store)
+            with self._lock:
+                stats = self._stores[store]
+                stats.entries = len(entries)
+                stats.bytes = sum(entry.size for entry in entries)
+            all_entries.extend(entries)
+        all_entries.sort(key=lambda entry: entry.last_access)
+        return all_entries
+
+    def _scanStore(self, store):
+        store_dir = os.path.join(xdg_cache_home(), store)
+        entries = {}
+        try:
+            names = os.listdir(store_dir)
+        except OSError:
+            return []
+        for name in names:
+            path = os.path.join(store_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed in the meantime.
+                continue
+            entry_path = path
+            for suffix in AUXILIARY_SUFFIXES:
+                if path.endswith(suffix):
+                    entry_path = path[:-len(suffix)]
+                    break
+            entry = entries.get(entry_path)
+            if entry is None:
+                entry = CacheEntry(entry_path)
+                entries[entry_path] = entry
+            entry.addFile(path, stat)
+        return list(entries.values())
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used entries until the stores fit in
+        max_bytes. Can be called from any thread.
+
+        @returns: The number of bytes freed.
+        """
+        if max_bytes is None:
+            max_bytes = self.settings.cacheMaxBytes
+        entries = self.scan()
+        total = sum(entry.size for entry in entries)
+        freed = 0
+        with self._lock:
+            used = set(self._used)
+        for entry in entries:
+            if total - freed <= max_bytes:
+                break
+            if entry.path in used:
+                continue
+            self.debug("Evicting %s, last used %s", entry.path,
+                       time.ctime(entry.last_access))
+            for path in entry.files:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    self.warning("Cannot evict %s: %s", path, e)
+            freed += entry.size
+        if freed:
+            self.info("Evicted %d bytes from the cache", freed)
+            self.scan()
+        self._publishStats()
+        return freed
+
+    def _publishStats(self):
+        # Lookups happen each time a thumbnail or a waveform is drawn, so
+        # they are accumulated and published at most once per interval.
+        with self._lock:
+            if self._publish_stats_id:
+                return
+            self._publish_stats_id = GLib.timeout_add(
+                CACHE_STATS_PUBLISH_INTERVAL, self._updateSettings)
+
+    def _updateSettings(self):
+        with self._lock:
+            self._publish_stats_id = 0
+        if self.settings:
+            total = self.stats()
+            # Setting an option notifies its watchers, even if unchanged.
+            if self.settings.cacheBytes != total.bytes:
+                self.settings.cacheBytes = total.bytes
+            if self.settings.cacheEntries != total.entries:
+                self.settings.cacheEntries = total.entries
+            if self.settings.cacheHitRate != total.hit_rate:
+                self.settings.cacheHitRate = total.hit_rate
+        return False
+
+    def _startEviction(self):
+        with self._lock:
+            if self._evicting:
+                return
+            self._evicting = True
+        self.threads.addThread(CacheEvictor, self)
+
+    def _evictionDone(self):
+        with self._lock:
+            self._evicting = False
+
+    def _evictionTimeoutCb(self):
+        # The stores grow as the thumbnails, waveforms and envelopes of the
+        # edited clips are written.
+        self._startEviction()
+        return True
+
+    def _maxBytesChangedCb(self, unused_settings):
+        self._startEviction()
+
+
+class CacheEvictor(Thread):
+
+    """
+    Thread enforcing the cache budget without blocking the UI.
+    """
+
+    def __init__(self, cache_manager):
+        Thread.__init__(self)
+        self.cache_manager = cache_manager
+
+    def process(self):
+        try:
+            self.cache_manager.evict()
+        finally:
+            self.cache_manager._evictionDone()
+
+
+# The CacheManager of all the stores in the cache directory.
+cache_manager = CacheManager()
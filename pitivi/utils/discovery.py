@@ -0,0 +1,172 @@
+# Pitivi video editor
+#
+#       pitivi/utils/discovery.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Caching of the DiscovererInfo of media files.
+
+The DiscovererInfo of the files is kept in the "discovery" store of the cache
+directory, so unchanged files are not discovered again.
+"""
+
+import hashlib
+import os
+import queue
+import threading
+
+from gi.repository import GLib
+from gi.repository import GstPbutils
+
+from pitivi.utils.cache import cache_manager
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import path_from_uri
+
+# Serializing a DiscovererInfo requires GStreamer 1.6.
+DISCOVERY_CACHE_SUPPORTED = hasattr(GstPbutils.DiscovererInfo, "from_variant")
+
+cache_manager.addStore("discovery")
+
+
+class DiscoveryCache(Loggable):
+
+    """
+    On-disk cache of the DiscovererInfo of local files.
+
+    The entries are keyed by the URI, the size and the modification time of
+    the files, so the entry of a file which changed is simply not found
+    anymore, and is eventually evicted by the L{CacheManager}.
+
+    The entries are written by a worker thread, so caching the info of the
+    imported files does not block the main loop.
+    """
+
+    MAGIC = b"PTVDISC1"
+
+    def __init__(self):
+        Loggable.__init__(self)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _getEntryPath(self, uri):
+        if not DISCOVERY_CACHE_SUPPORTED or not uri.startswith("file://"):
+            return None
+        try:
+            stat = os.stat(path_from_uri(uri))
+        except OSError:
+            return None
+        key = "%s:%d:%d" % (uri, stat.st_size, stat.st_mtime_ns)
+        return os.path.join(cache_manager.getStoreDir("discovery"),
+                            hashlib.sha1(key.encode("UTF-8")).hexdigest())
+
+    def get(self, uri):
+        """
+        Get the cached info of a file.
+
+        @returns: The info, or None if the file is not in the cache or
+        changed since it has been cached.
+        @rtype: L{GstPbutils.DiscovererInfo}
+        """
+        path = self._getEntryPath(uri)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, type_string, serialized = data.split(b"\n", 2)
+            if magic != self.MAGIC:
+                raise ValueError("not a discovery cache entry")
+            variant = GLib.Variant.new_from_bytes(
+                GLib.VariantType.new(type_string.decode("ascii")),
+                GLib.Bytes.new(serialized), False)
+            info = GstPbutils.DiscovererInfo.from_variant(variant)
+        except FileNotFoundError:
+            cache_manager.recordLookups("discovery", misses=1)
+            return None
+        except (OSError, ValueError, TypeError, GLib.Error) as e:
+            self.warning("Cannot read the cached info of %s: %s", uri, e)
+            cache_manager.recordLookups("discovery", misses=1)
+            return None
+        cache_manager.touch(path)
+        cache_manager.recordLookups("discovery", hits=1)
+        return info
+
+    def set(self, info):
+        """
+        Cache the info of a file in the background, if it was discovered
+        successfully.
+
+        @type info: L{GstPbutils.DiscovererInfo}
+        """
+        if not DISCOVERY_CACHE_SUPPORTED:
+            return
+        if info is None or info.get_result() != GstPbutils.DiscovererResult.OK:
+            return
+        with self._lock:
+            self._queue.put(info)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+
+    def join(self):
+        """
+        Wait until the infos passed to L{set} are written.
+        """
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                try:
+                    info = self._queue.get_nowait()
+                except queue.Empty:
+                    self._worker = None
+                    return
+            try:
+                self._write(info)
+            except Exception as e:
+                self.warning("Failed caching the info of %s: %s",
+                             info.get_uri(), e)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, info):
+        uri = info.get_uri()
+        path = self._getEntryPath(uri)
+        if path is None:
+            return
+        if os.path.exists(path):
+            cache_manager.touch(path)
+            return
+        variant = info.to_variant(GstPbutils.DiscovererSerializeFlags.ALL)
+        # Written under a temporary name and renamed, so concurrent readers
+        # never see an incomplete file.
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(self.MAGIC + b"\n")
+                f.write(variant.get_type_string().encode("ascii") + b"\n")
+                f.write(variant.get_data_as_bytes().get_data())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.warning("Cannot cache the info of %s: %s", uri, e)
+            return
+        cache_manager.touch(path)
+
+# The cache of the DiscovererInfo of the local files.
+discovery_cache = DiscoveryCache()
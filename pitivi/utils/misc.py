@@ -22,11 +22,13 @@
 
 import bisect
 import hashlib
+import mmap
 import os
 import threading
 import time
 from urllib.parse import urlparse, unquote, urlsplit
 
+from gi.repository import Gio
 from gi.repository import GLib
 from gi.repository import Gst
 from gi.repository import Gtk
@@ -146,48 +148,190 @@ def quote_uri(uri):
     return Gst.filename_to_uri(raw_path)
 
 
+# The number of URIs handed at once to the callback of a PathWalker.
+PATHWALKER_BATCH_SIZE = 100
+# The maximum number of URIs handed by a PathWalker and not yet released.
+PATHWALKER_MAX_OUTSTANDING = 500
+
+
 class PathWalker(Thread):
 
     """
     Thread for recursively searching in a list of directories
+
+    The URIs of the files found are handed in batches to the callback, in the
+    main loop. The callback is not given more URIs while max_outstanding of
+    them have not been released, so huge folders do not flood the main loop
+    and the consumer.
+
+    @ivar mime_types: The content types of the files to hand to the callback,
+    or None for all the files. Files whose type cannot be guessed from their
+    name are always handed.
+    @type mime_types: C{list} of C{str}
+    @ivar max_outstanding: The maximum number of URIs not yet released.
+    @type max_outstanding: C{int}
     """
 
-    def __init__(self, paths, callback):
+    def __init__(self, paths, callback, mime_types=None,
+                 max_outstanding=PATHWALKER_MAX_OUTSTANDING):
         Thread.__init__(self)
         self.log("New PathWalker for %s" % paths)
         self.paths = paths
         self.callback = callback
+        self.mime_types = mime_types
+        self.max_outstanding = max(PATHWALKER_BATCH_SIZE, max_outstanding)
         self.stopme = threading.Event()
+        # Whether the files with the extensions seen so far are accepted.
+        self._accepted_extensions = {}
+        # The URIs handed to the callback and not released yet.
+        self._outstanding = set()
+        self._condition = threading.Condition()
 
     def process(self):
+        uris = []
         for folder in self.paths:
             self.log("folder %s" % folder)
             if folder.startswith("file://"):
                 folder = unquote(folder[len("file://"):])
-            for path, dirs, files in os.walk(folder):
-                if self.stopme.isSet():
-                    return
-                uris = []
-                for afile in files:
-                    uris.append(quote_uri("file://%s" %
-                                          os.path.join(path, afile)))
-                if uris:
-                    GLib.idle_add(self.callback, uris)
+            for path in self._walk(folder):
+                uris.append(quote_uri("file://%s" % path))
+                if len(uris) >= PATHWALKER_BATCH_SIZE:
+                    if not self._handUris(uris):
+                        return
+                    uris = []
+        if uris:
+            self._handUris(uris)
+
+    def _walk(self, folder):
+        # Depth-first, without building the list of the files of a
+        # directory before looking at them.
+        folders = [folder]
+        while folders:
+            if self.stopme.is_set():
+                return
+            directory = folders.pop()
+            try:
+                entries = os.scandir(directory)
+            except OSError as e:
+                self.warning("Cannot list %s: %s", directory, e)
+                continue
+            subfolders = []
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subfolders.append(entry.path)
+                        elif entry.is_file() and self._accept(entry.name):
+                            yield entry.path
+                    except OSError:
+                        continue
+            # Visit the subfolders in the order they have been listed.
+            folders.extend(reversed(subfolders))
+
+    def _accept(self, filename):
+        if self.mime_types is None:
+            return True
+        extension = os.path.splitext(filename)[1].lower()
+        accepted = self._accepted_extensions.get(extension)
+        if accepted is None:
+            content_type, uncertain = Gio.content_type_guess(filename, None)
+            accepted = uncertain or any(
+                Gio.content_type_is_a(content_type, mime_type)
+                for mime_type in self.mime_types)
+            self._accepted_extensions[extension] = accepted
+        return accepted
+
+    def _handUris(self, uris):
+        """
+        Wait for room for the URIs, then hand them to the callback.
+
+        @returns: Whether the walker has not been aborted.
+        """
+        with self._condition:
+            while len(self._outstanding) + len(uris) > self.max_outstanding:
+                if self.stopme.is_set():
+                    return False
+                self._condition.wait()
+            if self.stopme.is_set():
+                return False
+            self._outstanding.update(uris)
+        GLib.idle_add(self.callback, uris)
+        return True
+
+    def release(self, uri):
+        """
+        Mark a URI handed to the callback as processed.
+
+        @returns: Whether the URI was handed by this walker.
+        """
+        with self._condition:
+            if uri not in self._outstanding:
+                return False
+            self._outstanding.remove(uri)
+            self._condition.notify()
+            return True
+
+    def releaseAll(self):
+        """
+        Mark all the URIs handed to the callback as processed.
+        """
+        with self._condition:
+            self._outstanding.clear()
+            self._condition.notify()
 
     def abort(self):
-        self.stopme.set()
+        with self._condition:
+            self.stopme.set()
+            self._condition.notify()
+
+
+# Files up to this size are hashed entirely.
+HASH_FILE_FULL_SIZE = 4 * 1024 * 1024
+# Larger files are hashed by sampling HASH_FILE_NB_BLOCKS blocks, spread
+# evenly from the start to the end of the file.
+HASH_FILE_BLOCK_SIZE = 256 * 1024
+HASH_FILE_NB_BLOCKS = 16
+
+# The hashes computed by hash_file, by device, inode, size and mtime.
+_file_hashes = {}
 
 
-def hash_file(uri):
-    """Hashes the first 256KB of the specified file"""
+def hash_file(path):
+    """
+    Get a hash of the contents of a file, to be used as cache key.
+
+    The hash covers the size of the file and blocks from its start, middle
+    and end, so files differing only after their headers have different
+    hashes. It is computed once per session for each version of the file.
+
+    @param path: The path of the file.
+    @type path: C{str}
+    @returns: The hexadecimal SHA-256 digest.
+    @rtype: C{str}
+    """
+    stat = os.stat(path)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    filehash = _file_hashes.get(key)
+    if filehash is not None:
+        return filehash
+
     sha256 = hashlib.sha256()
-    with open(uri, "rb") as file:
-        for _ in range(1024):
-            chunk = file.read(256)
-            if not chunk:
-                break
-            sha256.update(chunk)
-    return sha256.hexdigest()
+    size = stat.st_size
+    sha256.update(b"%d\n" % size)
+    if size:
+        with open(path, "rb") as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view:
+            if len(view) <= HASH_FILE_FULL_SIZE:
+                sha256.update(view)
+            else:
+                last = len(view) - HASH_FILE_BLOCK_SIZE
+                for i in range(HASH_FILE_NB_BLOCKS):
+                    offset = last * i // (HASH_FILE_NB_BLOCKS - 1)
+                    sha256.update(view[offset:offset + HASH_FILE_BLOCK_SIZE])
+    filehash = sha256.hexdigest()
+    _file_hashes[key] = filehash
+    return filehash
 
 
 def quantize(input, interval):
@@ -0,0 +1,157 @@
+# Pitivi video editor
+#
+#       pitivi/utils/search.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Substring search in the lists of the UI, such as the media library.
+"""
+
+import time
+
+from pitivi.utils.loggable import Loggable
+
+# The time in milliseconds to wait after a key press for the next one before
+# searching.
+SEARCH_DELAY = 150
+
+
+def trigrams(text):
+    """
+    Get the set of substrings of three characters of a text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex(Loggable):
+
+    """
+    Case insensitive substring search in a set of documents.
+
+    The documents are indexed by their trigrams, so a query only has to be
+    checked against the documents having all its trigrams. When a query
+    contains the previous one, for example when typing, only the documents
+    matching the previous query are checked.
+
+    @ivar last_search_time: The duration of the last search, in seconds.
+    @type last_search_time: C{float}
+    """
+
+    def __init__(self):
+        Loggable.__init__(self)
+        # Maps the keys of the documents to their lowercase text.
+        self._texts = {}
+        # Maps the trigrams to the keys of the documents containing them.
+        self._postings = {}
+        self._query = ""
+        # The keys of the documents matching self._query, or None if all
+        # the documents match.
+        self._matches = None
+        self.last_search_time = 0.0
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, key, *texts):
+        """
+        Add or replace a document.
+
+        @param key: The hashable identifier of the document.
+        @param texts: The searchable texts of the document.
+        """
+        if key in self._texts:
+            self.remove(key)
+        text = "\n".join(texts).lower()
+        self._texts[key] = text
+        for trigram in trigrams(text):
+            self._postings.setdefault(trigram, set()).add(key)
+        if self._matches is not None and self._query in text:
+            self._matches.add(key)
+
+    def remove(self, key):
+        """
+        Remove a document, if it has been added.
+        """
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        for trigram in trigrams(text):
+            keys = self._postings[trigram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[trigram]
+        if self._matches is not None:
+            self._matches.discard(key)
+
+    def clear(self):
+        """
+        Remove all the documents.
+        """
+        self._texts.clear()
+        self._postings.clear()
+        if self._matches is not None:
+            self._matches.clear()
+
+    def search(self, query):
+        """
+        Find the documents containing a text.
+
+        @param query: The text to search for, ignoring the case.
+        @returns: The keys of the matching documents, or None if the query
+        is empty, meaning all the documents match.
+        """
+        start = time.time()
+        query = query.lower()
+        if not query:
+            candidates = None
+            matches = None
+        else:
+            if self._matches is not None and self._query in query:
+                # Narrow down the previous matches.
+                candidates = self._matches
+            elif len(query) >= 3:
+                candidates = self._getCandidates(query)
+            else:
+                candidates = self._texts.keys()
+            matches = {key for key in candidates
+                       if query in self._texts[key]}
+        self._query = query
+        self._matches = matches
+
+        self.last_search_time = time.time() - start
+        self.debug("Searched %r in %d of %d documents in %.3f ms, %s matches",
+                   query,
+                   len(self._texts) if candidates is None else len(candidates),
+                   len(self._texts), self.last_search_time * 1000,
+                   "all" if matches is None else len(matches))
+        return matches
+
+    def _getCandidates(self, query):
+        postings = []
+        for trigram in trigrams(query):
+            keys = self._postings.get(trigram)
+            if not keys:
+                return set()
+            postings.append(keys)
+        postings.sort(key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def matches(self, key):
+        """
+        Check whether a document matches the last search.
+        """
+        return self._matches is None or key in self._matches
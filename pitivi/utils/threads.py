@@ -76,7 +76,11 @@ class ThreadMaster(Loggable):
         self.threads = []
 
     def addThread(self, threadclass, *args):
-        """ Instantiate the specified Thread class and start it. """
+        """
+        Instantiate the specified Thread class and start it.
+
+        @returns: The started thread.
+        """
         assert issubclass(threadclass, Thread)
         self.log("Adding thread of type %r", threadclass)
         thread = threadclass(*args)
@@ -85,6 +89,7 @@ class ThreadMaster(Loggable):
         self.log("starting it...")
         thread.start()
         self.log("started !")
+        return thread
 
     def _threadDoneCb(self, thread):
         self.log("thread %r is done", thread)
@@ -98,6 +103,7 @@ class ThreadMaster(Loggable):
             for thread in self.threads:
                 self.log("Trying to stop thread %r", thread)
                 try:
+                    thread.abort()
                     thread.join()
                     joinedthreads += 1
                 except:
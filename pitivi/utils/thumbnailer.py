@@ -0,0 +1,237 @@
+# Pitivi video editor
+#
+#       pitivi/utils/thumbnailer.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+Generation of the thumbnails of media files with GStreamer.
+
+The thumbnails are stored as specified by the freedesktop.org Thumbnail
+Managing Standard, so they are shared with the other applications, but no
+desktop thumbnailer is needed to generate them.
+"""
+
+import os
+import queue
+import threading
+
+from hashlib import md5
+
+from gi.repository import GdkPixbuf
+from gi.repository import GLib
+from gi.repository import Gst
+
+from pitivi.utils.loggable import Loggable
+from pitivi.utils.misc import path_from_uri
+
+# The size of the "normal" thumbnails of the standard.
+THUMBNAIL_SIZE = 128
+# The position of the frame used as thumbnail of a video, relative to its
+# duration, to skip the black frames of the beginning.
+THUMBNAIL_POSITION = 1 / 3
+# The time after which the pipeline of a file is considered stuck.
+THUMBNAIL_TIMEOUT = 10 * Gst.SECOND
+
+
+def get_thumbnails_dir():
+    """
+    Get the base directory of the thumbnails of the current user.
+    """
+    return os.path.join(GLib.get_user_cache_dir(), "thumbnails")
+
+
+def get_thumbnail_path(uri, flavor="normal"):
+    """
+    Get the path of the thumbnail of a file.
+
+    @param uri: The quoted URI of the file.
+    @param flavor: The subdirectory, "normal" or "large" for the thumbnails
+    of 128 or 256 pixels, or "fail/pitivi" for the files which cannot be
+    thumbnailed.
+    """
+    thumbnail_hash = md5(uri.encode()).hexdigest()
+    return os.path.join(get_thumbnails_dir(), flavor, thumbnail_hash + ".png")
+
+
+def save_thumbnail(pixbuf, uri, mtime, flavor="normal"):
+    """
+    Save a thumbnail with the metadata required by the standard.
+
+    @param mtime: The modification time of the file.
+    """
+    path = get_thumbnail_path(uri, flavor)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    # Written under a temporary name and renamed, so concurrent readers
+    # never see an incomplete file.
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    pixbuf.savev(tmp_path, "png",
+                 ["tEXt::Thumb::URI", "tEXt::Thumb::MTime",
+                  "tEXt::Software"],
+                 [uri, str(int(mtime)), "Pitivi"])
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)
+
+
+def has_failed(uri, mtime):
+    """
+    Check whether generating the thumbnail of an unchanged file failed.
+    """
+    try:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(
+            get_thumbnail_path(uri, "fail/pitivi"))
+    except GLib.Error:
+        return False
+    return pixbuf.get_option("tEXt::Thumb::MTime") == str(int(mtime))
+
+
+def generate_thumbnail(uri):
+    """
+    Decode a frame of a file and scale it to fit in THUMBNAIL_SIZE.
+
+    Blocks until done, so it is meant to be called in a worker thread.
+
+    @returns: The thumbnail or None if the file has no video.
+    @rtype: L{GdkPixbuf.Pixbuf}
+    """
+    pipeline = Gst.parse_launch(
+        "uridecodebin name=decode ! "
+        "videoconvert ! "
+        "videoscale ! "
+        "capsfilter caps=video/x-raw,format=(string)RGB,"
+        "height=(int){height},pixel-aspect-ratio=(fraction)1/1 ! "
+        "gdkpixbufsink name=sink".format(height=THUMBNAIL_SIZE))
+    decode = pipeline.get_by_name("decode")
+    decode.props.uri = uri
+    # Do not decode the other streams, for example the audio.
+    decode.props.caps = Gst.Caps.from_string("video/x-raw")
+    decode.props.expose_all_streams = False
+    try:
+        pipeline.set_state(Gst.State.PAUSED)
+        if pipeline.get_state(THUMBNAIL_TIMEOUT)[0] != \
+                Gst.StateChangeReturn.SUCCESS:
+            return None
+        res, duration = pipeline.query_duration(Gst.Format.TIME)
+        if res and duration > 0:
+            pipeline.seek_simple(Gst.Format.TIME,
+                                 Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                                 int(duration * THUMBNAIL_POSITION))
+            if pipeline.get_state(THUMBNAIL_TIMEOUT)[0] != \
+                    Gst.StateChangeReturn.SUCCESS:
+                return None
+        pixbuf = pipeline.get_by_name("sink").props.last_pixbuf
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+    if pixbuf is None:
+        return None
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    if width > THUMBNAIL_SIZE:
+        height = max(1, height * THUMBNAIL_SIZE // width)
+        pixbuf = pixbuf.scale_simple(THUMBNAIL_SIZE, height,
+                                     GdkPixbuf.InterpType.BILINEAR)
+    return pixbuf
+
+
+class ThumbnailerPool(Loggable):
+
+    """
+    Generates the thumbnails of files with up to max_workers threads.
+
+    The thumbnails are saved in the thumbnails directory of the user, and the
+    files which cannot be thumbnailed are remembered there, so they are not
+    tried again until they change.
+
+    @ivar max_workers: The maximum number of worker threads.
+    @type max_workers: C{int}
+    """
+
+    def __init__(self, callback, max_workers=1):
+        """
+        @param callback: The function called with the URI, the 128 pixels
+        and the 64 pixels thumbnails of each file successfully thumbnailed.
+        It is called in the worker threads.
+        """
+        Loggable.__init__(self)
+        self.max_workers = max(1, max_workers)
+        self._callback = callback
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._nb_workers = 0
+        # Increased when cancelling, to ignore the queued URIs.
+        self._generation = 0
+
+    def add(self, uris):
+        """
+        Queue files for thumbnailing.
+
+        @param uris: The quoted URIs of the files.
+        """
+        with self._lock:
+            for uri in uris:
+                self._queue.put((self._generation, uri))
+            while self._nb_workers < min(self.max_workers,
+                                         self._queue.qsize()):
+                self._nb_workers += 1
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+
+    def cancel(self):
+        """
+        Forget the queued files. The files being thumbnailed are finished.
+        """
+        with self._lock:
+            self._generation += 1
+
+    def _work(self):
+        while True:
+            with self._lock:
+                try:
+                    generation, uri = self._queue.get_nowait()
+                except queue.Empty:
+                    self._nb_workers -= 1
+                    return
+                if generation != self._generation:
+                    continue
+            try:
+                self._thumbnail(uri)
+            except Exception as e:
+                self.warning("Failed thumbnailing %s: %s", uri, e)
+
+    def _thumbnail(self, uri):
+        try:
+            mtime = os.path.getmtime(path_from_uri(uri))
+        except OSError as e:
+            self.debug("Cannot thumbnail %s: %s", uri, e)
+            return
+        if has_failed(uri, mtime):
+            self.debug("Thumbnailing %s failed before", uri)
+            return
+
+        pixbuf_128 = generate_thumbnail(uri)
+        if pixbuf_128 is None:
+            self.debug("Failed thumbnailing %s", uri)
+            # The standard says to store an empty PNG.
+            pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8,
+                                          1, 1)
+            save_thumbnail(pixbuf, uri, mtime, "fail/pitivi")
+            return
+        save_thumbnail(pixbuf_128, uri, mtime)
+        pixbuf_64 = pixbuf_128.scale_simple(
+            max(1, pixbuf_128.get_width() // 2),
+            max(1, pixbuf_128.get_height() // 2),
+            GdkPixbuf.InterpType.BILINEAR)
+        self._callback(uri, pixbuf_128, pixbuf_64)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import queue
+from unittest import TestCase, mock
+
+import numpy
+
+from pitivi import autoaligner
+from pitivi.autoaligner import affinealign, AutoAligner, coarsetofinealign, \
+    decimate, EnvelopeExtractee, rigidalign
+
+
+class AlignTestCase(TestCase):
+
+    def setUp(self):
+        signal = numpy.random.RandomState(0).rand(20000)
+        self.reference = signal[1000:15000]
+        self.shifts = [-700, 0, 333, 900]
+        self.targets = [signal[1000 + shift:12000 + shift]
+                        for shift in self.shifts]
+
+
+class TestRigidAlign(AlignTestCase):
+
+    def testShifts(self):
+        numpy.testing.assert_allclose(
+            rigidalign(self.reference, self.targets), self.shifts, atol=0.01)
+
+    def testMaxOffset(self):
+        numpy.testing.assert_allclose(
+            rigidalign(self.reference, self.targets, max_offset=1000),
+            self.shifts, atol=0.01)
+
+    def testBatches(self):
+        with mock.patch.object(autoaligner, "RIGIDALIGN_BATCH_BYTES", 1):
+            numpy.testing.assert_allclose(
+                rigidalign(self.reference, self.targets), self.shifts,
+                atol=0.01)
+
+
+class TestCoarseToFineAlign(AlignTestCase):
+
+    def testShifts(self):
+        shifts, confidences = coarsetofinealign(self.reference, self.targets)
+        numpy.testing.assert_allclose(shifts, self.shifts, atol=0.01)
+        for confidence in confidences:
+            self.assertGreater(confidence, 0.99)
+
+    def testMaxOffset(self):
+        shifts, unused_confidences = coarsetofinealign(
+            self.reference, self.targets, max_offset=1000)
+        numpy.testing.assert_allclose(shifts, self.shifts, atol=0.01)
+
+    def testShiftAtMaxOffset(self):
+        shifts, confidences = coarsetofinealign(
+            self.reference, self.targets, max_offset=900)
+        numpy.testing.assert_allclose(shifts, self.shifts, atol=0.01)
+        numpy.testing.assert_allclose(
+            shifts, rigidalign(self.reference, self.targets), atol=1e-6)
+        for confidence in confidences:
+            self.assertGreater(confidence, 0.99)
+
+    def testUnrelated(self):
+        unrelated = numpy.random.RandomState(1).rand(9000)
+        unused_shifts, confidences = coarsetofinealign(self.reference,
+                                                       [unrelated])
+        self.assertLess(confidences[0], 0.2)
+
+    def testDecimate(self):
+        self.assertEqual(decimate(numpy.arange(7), 3).tolist(), [1, 4])
+
+
+class TestAffineAlign(TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.signal = numpy.convolve(random.rand(30000), numpy.ones(5) / 5,
+                                     "same")
+        self.reference = self.signal[:25000]
+
+    def _drifting(self, offset, drift, length):
+        positions = offset + (1 + drift) * numpy.arange(length)
+        return numpy.interp(positions, numpy.arange(len(self.signal)),
+                            self.signal)
+
+    def testDrifts(self):
+        targets = [self._drifting(500, 0.002, 20000),
+                   self._drifting(3000, -0.001, 20000)]
+        offsets, drifts = affinealign(self.reference, targets)
+        numpy.testing.assert_allclose(offsets, [500, 3000], atol=0.5)
+        numpy.testing.assert_allclose(drifts, [0.002, -0.001], atol=1e-4)
+
+    def testBatches(self):
+        target = self._drifting(500, 0.002, 20000)
+        with mock.patch.object(autoaligner, "RIGIDALIGN_BATCH_BYTES", 1):
+            offsets, drifts = affinealign(self.reference, [target])
+        numpy.testing.assert_allclose(offsets, [500], atol=0.5)
+        numpy.testing.assert_allclose(drifts, [0.002], atol=1e-4)
+
+    def testShortTarget(self):
+        offsets, drifts = affinealign(self.reference, [self.signal[700:1500]])
+        numpy.testing.assert_allclose(offsets, [700], atol=0.01)
+        self.assertEqual(drifts, [0])
+
+
+class TestEnvelopeExtractee(TestCase):
+
+    def _extract(self, buffers, **kwargs):
+        envelopes = []
+        extractee = EnvelopeExtractee(4, envelopes.append, **kwargs)
+        for buf in buffers:
+            extractee.receive(buf)
+        extractee.finalize()
+        return envelopes[0]
+
+    def testBlocksSpanBuffers(self):
+        samples = numpy.arange(-10, 13, dtype=numpy.float32)
+        expected = numpy.abs(samples[:20]).reshape((5, 4)).sum(axis=1)
+        for nb_samples in (None, 8, len(samples)):
+            envelope = self._extract(
+                [samples[:3], samples[3:4], samples[4:13], samples[13:]],
+                nb_samples=nb_samples)
+            numpy.testing.assert_array_equal(envelope, expected)
+
+    def testBufferProtocol(self):
+        samples = numpy.array([1, -2, 3, -4, 5], dtype="<f4")
+        envelope = self._extract([memoryview(samples.tobytes())])
+        self.assertEqual(envelope.tolist(), [10])
+
+
+class TestAutoAligner(TestCase):
+
+    def testSharedExtraction(self):
+        clips = [mock.Mock(name="clip%d" % i) for i in range(3)]
+        audiotracks = {}
+        for clip, uri in zip(clips, ["file:///a", "file:///b", "file:///a"]):
+            audiotracks[clip] = mock.Mock(in_point=0, out_point=0)
+            audiotracks[clip].factory.uri = uri
+        callback = mock.Mock()
+        aligner = AutoAligner(clips, callback)
+
+        context = mock.Mock()
+        context.Queue.return_value.get_nowait.side_effect = queue.Empty
+        with mock.patch.object(autoaligner, "getAudioTrack",
+                               audiotracks.get), \
+                mock.patch.object(aligner, "_getEnvelopeCachePath",
+                                  lambda uri: uri + ".npy"), \
+                mock.patch.object(autoaligner, "load_envelope",
+                                  return_value=None), \
+                mock.patch.object(autoaligner, "cache_manager"), \
+                mock.patch.object(autoaligner, "GLib"), \
+                mock.patch.object(autoaligner.multiprocessing, "get_context",
+                                  return_value=context):
+            aligner.start()
+
+            pool = context.Pool.return_value
+            # The two clips of file:///a share an extraction.
+            self.assertEqual(
+                [c[0][1][1] for c in pool.apply_async.call_args_list],
+                ["file:///a", "file:///b"])
+            pool.close.assert_called_once_with()
+
+            with mock.patch.object(aligner, "_performShifts"):
+                for unused_args, kwargs in pool.apply_async.call_args_list:
+                    kwargs["callback"](numpy.zeros(10))
+                for (func, *args), unused_kwargs in \
+                        autoaligner.GLib.idle_add.call_args_list:
+                    func(*args)
+                aligner._performShifts.assert_called_once_with()
+        for clip in clips:
+            self.assertIsNotNone(aligner._clips[clip])
+        callback.assert_called_once_with()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from pitivi.utils import cache
+from pitivi.utils.cache import CacheManager
+
+
+class CacheManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        patcher = mock.patch.dict(os.environ,
+                                  {"PITIVI_USER_CACHE_DIR": self.cache_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.manager = CacheManager()
+
+    def _createEntry(self, store, name, size, last_access):
+        path = os.path.join(self.manager.getStoreDir(store), name)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (last_access, last_access))
+        return path
+
+    def testScanGroupsJournals(self):
+        self._createEntry("thumbs", "a", 10, 1000)
+        self._createEntry("thumbs", "a-wal", 5, 3000)
+        self._createEntry("waves", "b.wave", 20, 2000)
+
+        entries = self.manager.scan()
+        self.assertEqual([entry.size for entry in entries], [20, 15])
+        self.assertEqual(self.manager.stats("thumbs").entries, 1)
+        self.assertEqual(self.manager.stats().bytes, 35)
+
+    def testEvictLeastRecentlyUsed(self):
+        old = self._createEntry("thumbs", "old", 10, 1000)
+        new = self._createEntry("waves", "new.wave", 10, 2000)
+
+        self.assertEqual(self.manager.evict(15), 10)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def testEvictKeepsUsedEntries(self):
+        used = self._createEntry("thumbs", "used", 10, 1000)
+        unused = self._createEntry("thumbs", "unused", 10, 2000)
+        self.manager.touch(used)
+
+        self.manager.evict(0)
+        self.assertTrue(os.path.exists(used))
+        self.assertFalse(os.path.exists(unused))
+
+    def testAddedStoreScanned(self):
+        os.makedirs(os.path.join(self.cache_dir, "envelopes"))
+        with open(os.path.join(self.cache_dir, "envelopes", "a.npy"), "wb") as f:
+            f.write(b"x" * 10)
+        self.manager.addStore("envelopes")
+        self.assertEqual(self.manager.stats().bytes, 0)
+
+        self.manager.scan()
+        self.assertEqual(self.manager.stats("envelopes").bytes, 10)
+
+    @mock.patch.object(cache, "CACHE_USED_MAX_ENTRIES", 2)
+    def testUsedEntriesBounded(self):
+        first = self._createEntry("thumbs", "first", 10, 1000)
+        second = self._createEntry("thumbs", "second", 10, 2000)
+        third = self._createEntry("thumbs", "third", 10, 3000)
+        self.manager.touch(first)
+        self.manager.touch(second)
+        self.manager.touch(first)
+        self.manager.touch(third)
+
+        # Only the two most recently used entries are kept.
+        self.manager.evict(0)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+    def testHitRate(self):
+        self.manager.getStoreDir("thumbs")
+        self.manager.recordLookups("thumbs", hits=3, misses=1)
+        self.assertEqual(self.manager.stats().hit_rate, 0.75)
+
+    def testSingleEviction(self):
+        self.manager.threads = mock.Mock()
+        self.manager._startEviction()
+        self.manager._startEviction()
+        self.assertEqual(self.manager.threads.addThread.call_count, 1)
+
+        self.manager._evictionDone()
+        self.manager._startEviction()
+        self.assertEqual(self.manager.threads.addThread.call_count, 2)
+
+    def testStatsPublishedOnce(self):
+        self.manager.getStoreDir("thumbs")
+        with mock.patch("pitivi.utils.cache.GLib.timeout_add",
+                        return_value=1) as timeout_add:
+            for unused_i in range(10):
+                self.manager.recordLookups("thumbs", hits=1)
+            self.assertEqual(timeout_add.call_count, 1)
+
+            self.manager.settings = mock.Mock(cacheBytes=0, cacheEntries=0,
+                                              cacheHitRate=0.0)
+            self.manager._updateSettings()
+            self.assertEqual(self.manager.settings.cacheHitRate, 1.0)
+            self.manager.recordLookups("thumbs", misses=1)
+            self.assertEqual(timeout_add.call_count, 2)
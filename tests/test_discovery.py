@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import TestCase, mock
+
+from gi.repository import Gst
+from gi.repository import GstPbutils
+
+from pitivi.utils import discovery
+from pitivi.utils.discovery import DiscoveryCache
+
+
+@unittest.skipUnless(discovery.DISCOVERY_CACHE_SUPPORTED,
+                     "DiscovererInfo cannot be serialized")
+class TestDiscoveryCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        patcher = mock.patch.dict(os.environ,
+                                  {"PITIVI_USER_CACHE_DIR": self.tmp_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(self.tmp_dir, "tears_of_steel.webm")
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "samples", "tears_of_steel.webm"), self.path)
+        self.uri = Gst.filename_to_uri(self.path)
+        self.cache = DiscoveryCache()
+
+    def testGetSet(self):
+        self.assertIsNone(self.cache.get(self.uri))
+        info = GstPbutils.Discoverer.new(Gst.SECOND).discover_uri(self.uri)
+        self.cache.set(info)
+        self.cache.join()
+
+        cached = self.cache.get(self.uri)
+        self.assertEqual(cached.get_uri(), self.uri)
+        self.assertEqual(cached.get_duration(), info.get_duration())
+        self.assertEqual(len(cached.get_stream_list()),
+                         len(info.get_stream_list()))
+
+        # A modified file is discovered again.
+        os.utime(self.path, (0, 0))
+        self.assertIsNone(self.cache.get(self.uri))
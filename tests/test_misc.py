@@ -17,9 +17,16 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
-from pitivi.utils.misc import binary_search
+from unittest import mock
+
+from pitivi.utils import misc
+from pitivi.utils.misc import binary_search, hash_file, PathWalker
 
 
 class BinarySearchTest(unittest.TestCase):
@@ -41,3 +48,154 @@ class BinarySearchTest(unittest.TestCase):
         self.assertEqual(binary_search([10, 20, 30], 11), 0)
         self.assertEqual(binary_search([10, 20, 30], 24), 1)
         self.assertEqual(binary_search([10, 20, 30], 40), 2)
+
+
+class PathWalkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        for path in ("a.webm", "b.txt", "sub/c.ogg", "sub/deeper/d.webm"):
+            path = os.path.join(self.folder, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+        # Call the callback in the walker thread.
+        patcher = mock.patch.object(misc.GLib, "idle_add",
+                                    side_effect=lambda callback, uris:
+                                    callback(uris))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _names(self, uris):
+        return sorted(os.path.basename(misc.path_from_uri(uri))
+                      for uri in uris)
+
+    def testWalk(self):
+        batches = []
+        PathWalker([self.folder], batches.append).process()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(self._names(batches[0]),
+                         ["a.webm", "b.txt", "c.ogg", "d.webm"])
+
+        batches = []
+        PathWalker([misc.quote_uri(self.folder)], batches.append,
+                   ["video/webm", "audio/ogg"]).process()
+        self.assertEqual(self._names(batches[0]),
+                         ["a.webm", "c.ogg", "d.webm"])
+
+    @mock.patch.object(misc, "PATHWALKER_BATCH_SIZE", 1)
+    def testBackPressure(self):
+        batches = []
+
+        def callback(uris):
+            # Only one URI is allowed to be outstanding.
+            self.assertEqual(len(walker._outstanding), 1)
+            batches.append(uris)
+            walker.release(uris[0])
+
+        walker = PathWalker([self.folder], callback, max_outstanding=1)
+        walker.process()
+        self.assertEqual(len(batches), 4)
+
+    @mock.patch.object(misc, "PATHWALKER_BATCH_SIZE", 1)
+    def testDroppedUris(self):
+        batches = []
+        blocked = threading.Event()
+
+        def callback(uris):
+            batches.append(uris)
+            # The consumer drops every other URI, for example because it
+            # already has it, and releases it right away.
+            if len(batches) % 2:
+                for uri in uris:
+                    walker.release(uri)
+            else:
+                blocked.set()
+
+        walker = PathWalker([self.folder], callback, max_outstanding=1)
+        thread = threading.Thread(target=walker.process)
+        thread.start()
+        self.assertTrue(blocked.wait(5))
+        # The walker waits for the kept URI to be processed.
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(len(batches), 2)
+        walker.release(batches[1][0])
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self._names(sum(batches, [])),
+                         ["a.webm", "b.txt", "c.ogg", "d.webm"])
+
+    @mock.patch.object(misc, "PATHWALKER_BATCH_SIZE", 1)
+    def testAbort(self):
+        handed = threading.Event()
+        batches = []
+
+        def callback(uris):
+            batches.append(uris)
+            handed.set()
+
+        walker = PathWalker([self.folder], callback, max_outstanding=1)
+        thread = threading.Thread(target=walker.process)
+        thread.start()
+        self.assertTrue(handed.wait(5))
+        # The walker waits for the URI to be released.
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        walker.abort()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(batches), 1)
+
+
+class HashFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def _write(self, name, data):
+        path = os.path.join(self.folder, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def testContents(self):
+        header = bytes(range(256)) * 1024
+        paths = [self._write("empty", b""),
+                 self._write("a", header + b"a"),
+                 self._write("b", header + b"b"),
+                 self._write("c", header + b"a" * 2)]
+        hashes = [hash_file(path) for path in paths]
+        self.assertEqual(len(set(hashes)), len(hashes))
+        self.assertEqual(hash_file(self._write("copy", header + b"a")),
+                         hashes[1])
+
+    @mock.patch.object(misc, "HASH_FILE_FULL_SIZE", 1000)
+    @mock.patch.object(misc, "HASH_FILE_BLOCK_SIZE", 100)
+    @mock.patch.object(misc, "HASH_FILE_NB_BLOCKS", 3)
+    def testSampledBlocks(self):
+        data = bytearray(10000)
+        filehash = hash_file(self._write("data", data))
+        # The middle and the tail are sampled.
+        for offset in (4950, 9999):
+            changed = bytearray(data)
+            changed[offset] = 1
+            self.assertNotEqual(
+                hash_file(self._write("changed%d" % offset, changed)),
+                filehash)
+        changed = bytearray(data)
+        changed[2000] = 1
+        self.assertEqual(hash_file(self._write("unsampled", changed)),
+                         filehash)
+
+    def testMemoized(self):
+        path = self._write("a", b"a")
+        filehash = hash_file(path)
+        with mock.patch.object(misc.hashlib, "sha256") as sha256:
+            self.assertEqual(hash_file(path), filehash)
+            self.assertFalse(sha256.called)
+        # A modified file is hashed again.
+        self._write("a", b"b")
+        os.utime(path, ns=(0, 0))
+        self.assertNotEqual(hash_file(path), filehash)
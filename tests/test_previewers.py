@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# Pitivi video editor
+#
+#       tests/test_previewers.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase, mock
+
+import numpy
+
+from gi.repository import GES
+
+from pitivi.timeline import previewers
+from pitivi.timeline.previewers import estimate_keyframe_interval, \
+    levels_to_peaks, PixbufLRUCache, PreviewGeneratorManager, \
+    ThumbnailCache, WaveformPeaks, WaveformPeaksAccumulator
+
+
+class FakePixbuf(object):
+
+    def __init__(self, size):
+        self.size = size
+
+    def get_rowstride(self):
+        return self.size
+
+    def get_height(self):
+        return 1
+
+
+class FakeGenerator(object):
+
+    track_type = GES.TrackType.VIDEO
+
+    def __init__(self):
+        self.running = False
+        self._done_cb = None
+
+    def connect(self, unused_signal, callback):
+        self._done_cb = callback
+
+    def disconnect_by_func(self, unused_callback):
+        self._done_cb = None
+
+    def isVisible(self):
+        return True
+
+    def startGeneration(self):
+        self.running = True
+
+    def stopGeneration(self):
+        self.running = False
+        self._done_cb(self)
+
+
+class TestPreviewGeneratorManager(TestCase):
+
+    def setUp(self):
+        self.manager = PreviewGeneratorManager()
+        self.cpu_usage = 0
+        patcher = mock.patch.object(self.manager, "cpuUsage",
+                                    lambda: self.cpu_usage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testRefinementAfterFirstPass(self):
+        first, second, refinement = [FakeGenerator() for unused in range(3)]
+        self.manager.addPipeline(first)
+        self.manager.addPipeline(second)
+        self.manager.addRefinement(refinement)
+        self.assertTrue(first.running)
+        self.assertFalse(refinement.running)
+
+        first.stopGeneration()
+        self.assertTrue(second.running)
+        self.assertFalse(refinement.running)
+        second.stopGeneration()
+        self.assertTrue(refinement.running)
+
+    def testRefinementPreempted(self):
+        refinement, generator = FakeGenerator(), FakeGenerator()
+        self.manager.addRefinement(refinement)
+        self.assertTrue(refinement.running)
+
+        # The refinement gives its slot to the first pass of a clip.
+        self.manager.addPipeline(generator)
+        self.assertTrue(generator.running)
+        self.assertFalse(refinement.running)
+        generator.stopGeneration()
+        self.assertTrue(refinement.running)
+
+    def testRefinementWhenIdle(self):
+        refinement = FakeGenerator()
+        self.cpu_usage = 100
+        with mock.patch.object(previewers.GLib, "timeout_add",
+                               return_value=1) as timeout_add:
+            self.manager.addRefinement(refinement)
+        self.assertFalse(refinement.running)
+        timeout_add.assert_called_once_with(
+            previewers.THUMBNAILS_REFINE_RETRY_INTERVAL,
+            self.manager._refineRetryCb)
+
+        self.cpu_usage = 0
+        self.assertFalse(self.manager._refineRetryCb())
+        self.assertTrue(refinement.running)
+
+
+class TestPixbufLRUCache(TestCase):
+
+    def testEviction(self):
+        cache = PixbufLRUCache(100)
+        cache.add("a", FakePixbuf(40))
+        cache.add("b", FakePixbuf(40))
+        self.assertEqual(cache.bytes, 80)
+        # Using "a" makes "b" the least recently used one.
+        self.assertIsNotNone(cache.get("a"))
+        cache.add("c", FakePixbuf(40))
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.bytes, 80)
+
+    def testReplace(self):
+        cache = PixbufLRUCache(100)
+        cache.add("a", FakePixbuf(40))
+        cache.add("a", FakePixbuf(10))
+        self.assertEqual(cache.bytes, 10)
+        cache.remove("a")
+        self.assertEqual(cache.bytes, 0)
+        self.assertIsNone(cache.get("a"))
+
+
+class TestThumbnailCache(TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        for patcher in (
+                mock.patch.dict(os.environ,
+                                {"PITIVI_USER_CACHE_DIR": cache_dir}),
+                mock.patch.object(previewers, "hash_file",
+                                  return_value="thumbnail-cache-test"),
+                mock.patch.object(previewers, "decoded_thumbs",
+                                  PixbufLRUCache(1000)),
+                # The thumbnails are stored as their size instead of JPEGs.
+                mock.patch.object(ThumbnailCache, "_compress",
+                                  lambda self, pixbuf: str(pixbuf.size).encode()),
+                mock.patch.object(ThumbnailCache, "_loadJpeg",
+                                  lambda self, jpeg: FakePixbuf(int(jpeg)))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.cache = ThumbnailCache("file:///tmp/thumbnail-cache-test.webm")
+
+    def testGetRange(self):
+        times = list(range(0, 100, 10)) + [15]
+        self.cache.setItems([(time, FakePixbuf(time + 1)) for time in times])
+        self.cache.commit()
+        # Some thumbnails have to be decoded again.
+        previewers.decoded_thumbs.remove((self.cache._filehash, 10))
+        previewers.decoded_thumbs.remove((self.cache._filehash, 50))
+
+        # The end is excluded and only the multiples of step are returned.
+        pixbufs = self.cache.getRange(10, 70, 20)
+        self.assertEqual(sorted(pixbufs), [10, 30, 50])
+        for time, pixbuf in pixbufs.items():
+            self.assertEqual(pixbuf.size, self.cache.getPixbuf(time).size)
+            self.assertEqual(pixbuf.size, time + 1)
+
+        self.assertEqual(self.cache.getRange(100, 200, 10), {})
+        self.assertEqual(sorted(self.cache.getRange(15, 16, 10)), [15])
+
+
+class TestWaveformPeaks(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".wave")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def testSaveLoad(self):
+        peaks = [[1, 50, 100], [3, 50, 0]]
+        WaveformPeaks.save(self.path, peaks, 10)
+        waveform = WaveformPeaks.load(self.path)
+        self.assertEqual(waveform.interval, 10)
+        self.assertEqual(waveform.channels.tolist(), peaks)
+        self.assertEqual(waveform.nb_peaks, 3)
+        # The average of the channels is stored, not computed when loading.
+        self.assertIsInstance(waveform.mono, numpy.memmap)
+        mins, unused_maxs, unused_rms = waveform.getEnvelope(0, 3, 3)
+        self.assertEqual(mins.tolist(), [2, 50, 50])
+
+    def testInt16(self):
+        WaveformPeaks.save(self.path, [[0, 50, 100]], 10, numpy.int16)
+        waveform = WaveformPeaks.load(self.path)
+        self.assertEqual(waveform.channels.dtype, numpy.int16)
+        mins, unused_maxs, unused_rms = waveform.getEnvelope(0, 3, 3)
+        numpy.testing.assert_allclose(mins, [0, 50, 100], atol=0.01)
+
+    def testInvalidFile(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a wave file")
+        self.assertIsNone(WaveformPeaks.load(self.path))
+
+    def testPyramid(self):
+        peaks = numpy.arange(4096, dtype=numpy.float32)
+        WaveformPeaks.save(self.path, [peaks], 10)
+        waveform = WaveformPeaks.load(self.path)
+        self.assertEqual([len(level[0]) for level in waveform.levels],
+                         [1024, 256])
+
+        mins, maxs, rms = waveform.getEnvelope(0, 4096, 300)
+        self.assertEqual(len(mins), 256)
+        self.assertEqual(mins[1], 16)
+        self.assertEqual(maxs[1], 31)
+        numpy.testing.assert_allclose(
+            rms[1], numpy.sqrt(numpy.mean(peaks[16:32] ** 2)), rtol=1e-5)
+
+        # Small ranges are read from the peaks themselves.
+        mins, maxs, rms = waveform.getEnvelope(10, 20, 100)
+        self.assertEqual(mins.tolist(), list(range(10, 20)))
+
+
+class TestWaveformPeaksAccumulator(TestCase):
+
+    def testPeaks(self):
+        accumulator = WaveformPeaksAccumulator(3, 2, 4)
+        samples = numpy.array([[1, 0.5]] * 4 + [[0.5, 0]] * 4 + [[0, 1]] * 2,
+                              dtype=numpy.float32)
+        # Windows can span buffers.
+        accumulator.addSamples(samples[:3].ravel())
+        accumulator.addSamples(samples[3:].ravel())
+        self.assertEqual(accumulator.position, 2)
+        peaks = accumulator.finish()
+        self.assertEqual(accumulator.position, 3)
+        numpy.testing.assert_allclose(peaks, [[100, 50, 0], [50, 0, 100]])
+
+    def testExtraSamples(self):
+        accumulator = WaveformPeaksAccumulator(2, 1, 2)
+        samples = numpy.zeros(10, dtype=numpy.float32)
+        samples[:4] = [1, 1, 0.5, 0.5]
+        accumulator.addSamples(samples)
+        # The samples after the last peak are ignored, not averaged in.
+        numpy.testing.assert_allclose(accumulator.finish(), [[100, 50]])
+
+    def testPartialWindow(self):
+        accumulator = WaveformPeaksAccumulator(2, 1, 4)
+        accumulator.addSamples(numpy.array([1, 1, 1, 1, 0.5, 0.5],
+                                           dtype=numpy.float32))
+        numpy.testing.assert_allclose(accumulator.finish(), [[100, 50]])
+
+
+class TestLevelsToPeaks(TestCase):
+
+    def testConversion(self):
+        levels = numpy.array([[-numpy.inf, 0, -20, 0, 0, -40]],
+                             dtype=numpy.float32)
+        numpy.testing.assert_allclose(levels_to_peaks(levels),
+                                      [[0, 0, 10, 10, 10, 1]], rtol=1e-5)
+
+
+class TestEstimateKeyframeInterval(TestCase):
+
+    def testInterval(self):
+        self.assertIsNone(estimate_keyframe_interval([]))
+        self.assertIsNone(estimate_keyframe_interval([2, 2]))
+        # A scene cut adds a keyframe without changing the estimate.
+        self.assertEqual(
+            estimate_keyframe_interval([8, 0, 4, 4, 10, 14, 18]), 4)
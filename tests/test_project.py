@@ -22,7 +22,7 @@ import os
 import tempfile
 import time
 
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from gi.repository import GES
 from gi.repository import GLib
@@ -391,6 +391,19 @@ class TestProjectLoading(TestCase):
         self.assertTrue(result[2], "Asset re-adding failed")
 
 
+class TestProjectAddUris(TestCase):
+
+    def testRejectedUris(self):
+        project = _createRealProject()
+        uris = ["file:///tmp/a b.webm", "file:///tmp/c.webm"]
+        with mock.patch.object(project, "create_asset",
+                               side_effect=[False, True]) as create_asset:
+            rejected = project.addUris(uris)
+        self.assertEqual(create_asset.call_count, 2)
+        # The URIs the project already has are returned, quoted.
+        self.assertEqual(rejected, ["file:///tmp/a%20b.webm"])
+
+
 class TestExportSettings(TestCase):
 
     """Test the project.MultimediaSettings class."""
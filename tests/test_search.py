@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+from unittest import TestCase
+
+from pitivi.utils.search import SearchIndex
+
+
+class TestSearchIndex(TestCase):
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add(1, "Holiday.webm", "Video: 1920x1080")
+        self.index.add(2, "holiday-beach.ogg", "Audio: Stereo")
+        self.index.add(3, "Interview.mov", "Video: 1280x720")
+
+    def testEmptyQuery(self):
+        self.assertIsNone(self.index.search(""))
+        self.assertTrue(self.index.matches(1))
+
+    def testShortQuery(self):
+        self.assertEqual(self.index.search("ie"), {3})
+        self.assertEqual(self.index.search("o:"), {1, 2, 3})
+
+    def testCaseInsensitive(self):
+        self.assertEqual(self.index.search("HOLIDAY"), {1, 2})
+        self.assertEqual(self.index.search("video: 1"), {1, 3})
+        self.assertTrue(self.index.matches(3))
+        self.assertFalse(self.index.matches(2))
+
+    def testNoMatch(self):
+        self.assertEqual(self.index.search("sunset"), set())
+        # The trigrams match, but not the substring.
+        self.assertEqual(self.index.search("holiday.ogg"), set())
+
+    def testNarrowing(self):
+        self.assertEqual(self.index.search("hol"), {1, 2})
+        self.assertEqual(self.index.search("holiday-"), {2})
+        self.assertEqual(self.index.search("holiday"), {1, 2})
+        self.assertEqual(self.index.search("view"), {3})
+
+    def testUpdates(self):
+        self.assertEqual(self.index.search("holiday"), {1, 2})
+        self.index.add(4, "Holiday 2.mkv")
+        self.index.add(5, "Party.mkv")
+        self.index.remove(1)
+        self.index.remove(42)
+        self.assertEqual(self.index.search("holiday"), {2, 4})
+        self.assertEqual(self.index.search("holiday 2"), {4})
+
+        self.index.add(2, "beach.ogg")
+        self.assertEqual(self.index.search("holiday"), {4})
+        self.assertEqual(len(self.index), 4)
+
+        self.index.clear()
+        self.assertEqual(self.index.search("holiday"), set())
+        self.assertEqual(len(self.index), 0)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+import os
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase, mock
+
+from gi.repository import GdkPixbuf
+from gi.repository import Gst
+
+from pitivi.utils import thumbnailer
+from pitivi.utils.thumbnailer import generate_thumbnail, get_thumbnail_path, \
+    has_failed, ThumbnailerPool
+
+
+class TestThumbnailer(TestCase):
+
+    def setUp(self):
+        Gst.init(None)
+        self.thumbnails_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.thumbnails_dir)
+        patcher = mock.patch.object(thumbnailer, "get_thumbnails_dir",
+                                    return_value=self.thumbnails_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "samples", "tears_of_steel.webm")
+        self.uri = Gst.filename_to_uri(self.path)
+
+    def _thumbnail(self, uri):
+        done = threading.Event()
+        results = []
+
+        def generated(uri, pixbuf_128, pixbuf_64):
+            results.append((uri, pixbuf_128, pixbuf_64))
+            done.set()
+
+        pool = ThumbnailerPool(generated, 2)
+        pool.add([uri])
+        done.wait(30)
+        return results
+
+    def testGenerateThumbnail(self):
+        pixbuf = generate_thumbnail(self.uri)
+        self.assertEqual(pixbuf.get_width(), 128)
+        self.assertLessEqual(pixbuf.get_height(), 128)
+
+    def testPool(self):
+        results = self._thumbnail(self.uri)
+        self.assertEqual(len(results), 1)
+        unused_uri, pixbuf_128, pixbuf_64 = results[0]
+        self.assertEqual(pixbuf_64.get_width(), pixbuf_128.get_width() // 2)
+
+        saved = GdkPixbuf.Pixbuf.new_from_file(get_thumbnail_path(self.uri))
+        self.assertEqual(saved.get_option("tEXt::Thumb::URI"), self.uri)
+        self.assertEqual(saved.get_option("tEXt::Thumb::MTime"),
+                         str(int(os.path.getmtime(self.path))))
+
+    def testFailure(self):
+        fd, path = tempfile.mkstemp(dir=self.thumbnails_dir)
+        os.write(fd, b"not a media file")
+        os.close(fd)
+        uri = Gst.filename_to_uri(path)
+        callback = mock.Mock()
+        pool = ThumbnailerPool(callback, 1)
+        pool._thumbnail(uri)
+        self.assertFalse(callback.called)
+        self.assertTrue(has_failed(uri, os.path.getmtime(path)))